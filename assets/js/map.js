@@ -0,0 +1,21 @@
+// Markers of the map: the clusters computed by MapChart are drawn with their number of pins
+window.cartographe = Object.assign({}, window.cartographe, {
+    map: {
+        point_to_layer: function (feature, latlng) {
+            if (!feature.properties || !feature.properties.cluster) {
+                return L.marker(latlng);
+            }
+
+            const count = feature.properties.point_count;
+            const size = count < 10 ? "small" : count < 100 ? "medium" : "large";
+
+            return L.marker(latlng, {
+                icon: L.divIcon({
+                    html: "<div><span>" + count + "</span></div>",
+                    className: "map-cluster map-cluster-" + size,
+                    iconSize: L.point(40, 40)
+                })
+            });
+        }
+    }
+});
@@ -0,0 +1,42 @@
+// Changes of the network graph sent by dashboard_update, applied to the elements displayed by the browser
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    network: {
+        apply_delta: function (delta, elements) {
+            if (!delta) {
+                return window.dash_clientside.no_update;
+            }
+
+            if (delta.full || !elements) {
+                return delta.elements;
+            }
+
+            const removed = new Set(delta.removed);
+            // Identifier: element added or updated
+            const changed = new Map(delta.elements.map(element => [element.data.id, element]));
+            const result = [];
+
+            for (const element of elements) {
+                const data = element.data;
+
+                // The edges of a removed node go with it
+                if (removed.has(data.id) || removed.has(data.source) || removed.has(data.target)) {
+                    continue;
+                }
+
+                if (changed.has(data.id)) {
+                    result.push(changed.get(data.id));
+                    changed.delete(data.id);
+                } else {
+                    result.push(element);
+                }
+            }
+
+            // The new elements, the nodes first since the edges refer to them
+            for (const element of changed.values()) {
+                result.push(element);
+            }
+
+            return result;
+        }
+    }
+});
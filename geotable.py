@@ -0,0 +1,10 @@
+# -*- coding: utf-8 -*-
+
+from sys import argv, exit
+
+from lib.geotable import main
+
+
+if __name__ == '__main__':
+    """Export the GeoLite2 City database to interval arrays, check or benchmark the export"""
+    exit(main(argv[1:]))
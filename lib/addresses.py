@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+from socket import inet_pton, AF_INET, AF_INET6
+from ipaddress import ip_network
+from psutil import net_if_addrs
+
+from . import logger
+from . import config
+
+config.load_config()
+
+
+# Ranges of addresses never found in a GeoIP database (RFC 6890)
+SPECIAL_NETWORKS = [
+    ("0.0.0.0/8", "unspecified"),
+    ("10.0.0.0/8", "LAN"),
+    ("100.64.0.0/10", "LAN"),
+    ("127.0.0.0/8", "loopback"),
+    ("169.254.0.0/16", "link-local"),
+    ("172.16.0.0/12", "LAN"),
+    ("192.0.0.0/24", "reserved"),
+    ("192.0.2.0/24", "documentation"),
+    ("192.168.0.0/16", "LAN"),
+    ("198.18.0.0/15", "reserved"),
+    ("198.51.100.0/24", "documentation"),
+    ("203.0.113.0/24", "documentation"),
+    ("224.0.0.0/4", "multicast"),
+    ("240.0.0.0/4", "reserved"),
+    ("255.255.255.255/32", "broadcast"),
+    ("::/128", "unspecified"),
+    ("::1/128", "loopback"),
+    ("100::/64", "reserved"),
+    ("2001:db8::/32", "documentation"),
+    ("fc00::/7", "LAN"),
+    ("fe80::/10", "link-local"),
+    ("ff00::/8", "multicast")]
+
+
+class AddressClassifier():
+    """Prefix table tagging the local and special addresses without any database"""
+
+    tables = None
+    prefixlens = None
+
+    def __init__(self):
+        """Build the table from the special ranges, the site-local subnets and the broadcast addresses of the interfaces"""
+        # Version: {prefix length: {network address >> host bits: category}}
+        self.tables = {4: {}, 6: {}}
+        # Version: prefix lengths of the table, most specific first
+        self.prefixlens = {4: [], 6: []}
+
+        for (network, category) in SPECIAL_NETWORKS:
+            self.add(network, category)
+
+        subnets = config.get("site_local_subnets")
+
+        if subnets is not None:
+            for subnet in subnets if type(subnets) is list else [subnets]:
+                self.add(subnet, "LAN")
+
+        # Directed broadcasts of the subnets of this host
+        for addresses in net_if_addrs().values():
+            for address in addresses:
+                if address.family == AF_INET and address.broadcast:
+                    self.add(f"{address.broadcast}/32", "broadcast")
+
+    def add(self, network, category):
+        """Add a range of addresses to the table"""
+        try:
+            network = ip_network(network, strict=False)
+        except ValueError as e:
+            logger.log.error(f"Invalid subnet in the site_local_subnets setting ({network}): {e}")
+            return
+
+        table = self.tables[network.version]
+        prefix = int(network.network_address) >> (network.max_prefixlen - network.prefixlen)
+        table.setdefault(network.prefixlen, {})[prefix] = category
+        self.prefixlens[network.version] = sorted(table.keys(), reverse=True)
+
+    def classify(self, ip):
+        """Return the category of an address (LAN, multicast...), None for a public address"""
+        try:
+            if ":" in ip:
+                version, bits, value = 6, 128, int.from_bytes(inet_pton(AF_INET6, ip.split('%')[0]), "big")
+            else:
+                version, bits, value = 4, 32, int.from_bytes(inet_pton(AF_INET, ip), "big")
+        except OSError:
+            return None
+
+        table = self.tables[version]
+
+        for prefixlen in self.prefixlens[version]:
+            category = table[prefixlen].get(value >> (bits - prefixlen))
+
+            if category is not None:
+                return category
+
+        return None
+
+
+def get_subnet(ip):
+    """Return the /24 network of an IPv4 address or the /48 network of an IPv6 one"""
+    try:
+        return str(ip_network(f"{ip.split('%')[0]}/{48 if ':' in ip else 24}", strict=False))
+    except ValueError:
+        return ip
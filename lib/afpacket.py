@@ -0,0 +1,353 @@
+# -*- coding: utf-8 -*-
+
+import socket
+from os import name
+from ctypes import CDLL, Structure, POINTER, byref, string_at, create_string_buffer, addressof, c_uint, c_int, c_uint32, c_ushort, c_void_p, c_char_p
+from ctypes.util import find_library
+from subprocess import run, PIPE
+from mmap import mmap, MAP_SHARED, PROT_READ, PROT_WRITE
+from struct import Struct
+from time import monotonic, time_ns
+from datetime import datetime
+
+from . import logger
+from . import config
+from . import pcap
+from .sniffer import Sniffer
+
+config.load_config()
+
+
+# linux/if_ether.h, linux/if_packet.h, linux/if_arp.h
+ETH_P_ALL = 0x0003
+SOL_PACKET = 263
+PACKET_RX_RING = 5
+PACKET_VERSION = 10
+TPACKET_V3 = 2
+TP_STATUS_KERNEL = 0
+TP_STATUS_USER = 1
+ARPHRD_ETHER = 1
+ARPHRD_LOOPBACK = 772
+ARPHRD_NONE = 65534
+PACKET_OUTGOING = 4
+SO_ATTACH_FILTER = 26
+PCAP_NETMASK_UNKNOWN = 0xffffffff
+# pcap/dlt.h: link type of raw IP given to libpcap, LINKTYPE_RAW in the capture files
+DLT_RAW = 12
+
+# tp_block_size, tp_block_nr, tp_frame_size, tp_frame_nr, tp_retire_blk_tov, tp_sizeof_priv, tp_feature_req_word
+TPACKET_REQ3 = Struct("IIIIIII")
+# block_status, num_pkts, offset_to_first_pkt (after version and offset_to_priv)
+TPACKET_BLOCK_DESC = Struct("III")
+# tp_next_offset, tp_sec, tp_nsec, tp_snaplen, tp_len, tp_status, tp_mac
+TPACKET3_HDR = Struct("IIIIIIH")
+# Offset of sll_pkttype: aligned size of tpacket3_hdr then sll_family, sll_protocol, sll_ifindex, sll_hatype
+TPACKET3_PKTTYPE = 48 + 10
+BLOCK_SIZE = 1024 * 1024
+FRAME_SIZE = 2048
+
+
+class RawSniffer(Sniffer):
+    """Linux sniffer reading the frames from an AF_PACKET socket, without tshark"""
+
+    socket = None
+    ring = None
+    block_count = None
+    block_index = None
+    linktype = None
+    writer = None
+    file_start = None
+    buffer = None
+    loopback = None
+
+    def __init__(self, queue, interface, fields, fix_files=False):
+        """Initialize an AF_PACKET based sniffer"""
+        Sniffer.__init__(self, queue, interface, fields, fix_files=fix_files)
+
+        # Number of 1 MB blocks of the TPACKET_V3 ring, 0: read the frames one by one
+        self.block_count = config.get_int("afpacket_ring_size", 0)
+        self.ready = (name != "nt" and hasattr(socket, "AF_PACKET"))
+
+        if self.ready:
+            self.state = "Ready"
+        else:
+            self.state = "Not ready"
+            logger.log.error(f"The AF_PACKET capture backend is only available on Linux, the {self.interface} interface cannot be sniffed.")
+
+    def open(self):
+        """Open the packet socket and the capture file, return the file descriptor of the socket"""
+        try:
+            # No frame is received before the filter is attached and the socket is bound to the interface
+            self.socket = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, 0)
+            self.attach_filter()
+            self.socket.bind((self.interface, ETH_P_ALL))
+            self.socket.setblocking(False)
+
+            if self.block_count > 0:
+                self.open_ring()
+            else:
+                # Absorb the bursts between two reads
+                self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 8 * 1024 * 1024)
+
+        except Exception as e:
+            logger.log.error(f"The AF_PACKET socket cannot listen to the {self.interface} interface: {e}")
+            self.state = "Failed"
+            self.close_socket()
+            return None
+
+        # Loopback interfaces have a fake Ethernet header, tunnels have none
+        hatype = self.socket.getsockname()[3]
+        # Frames sent on a loopback interface are received a second time
+        self.loopback = (hatype == ARPHRD_LOOPBACK)
+        self.buffer = bytearray(65536)
+
+        if hatype in (ARPHRD_ETHER, ARPHRD_LOOPBACK):
+            self.linktype = pcap.LINKTYPE_ETHERNET
+        else:
+            if hatype != ARPHRD_NONE:
+                logger.log.warning(f"The link layer of the {self.interface} interface (ARPHRD {hatype}) is not supported, its frames are decoded as raw IP.")
+            self.linktype = pcap.LINKTYPE_RAW
+
+        self.open_file()
+        self.state = "Running"
+        logger.log.info(f"Sniffing the {self.interface} interface (AF_PACKET{', TPACKET_V3 ring' if self.ring is not None else ''}).")
+        self.fd = self.socket.fileno()
+
+        return self.fd
+
+    def attach_filter(self):
+        """Compile the capture filter and attach it to the socket, the kernel drops the other frames"""
+        capture_filter = self.get_capture_filter()
+
+        if capture_filter is None:
+            return
+
+        # The socket is not bound yet, the link layer is read from sysfs: the frames of tunnels have no header
+        hatype = get_hardware_type(self.interface)
+        linktype = pcap.LINKTYPE_ETHERNET if hatype in (None, ARPHRD_ETHER, ARPHRD_LOOPBACK) else DLT_RAW
+        instructions = compile_filter(capture_filter, linktype, self.interface)
+
+        if instructions is None:
+            logger.log.error(f"The capture filter of the {self.interface} interface ({capture_filter}) cannot be compiled, the interface is sniffed without filter.")
+            return
+
+        # struct sock_fprog {unsigned short len; struct sock_filter *filter;}
+        buffer = create_string_buffer(instructions)
+        program = SockFprog(len(instructions) // 8, addressof(buffer))
+        self.socket.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, bytes(program))
+        logger.log.info(f"Capture filter of the {self.interface} interface: {capture_filter}")
+
+    def open_ring(self):
+        """Share a TPACKET_V3 ring of blocks with the kernel"""
+        self.socket.setsockopt(SOL_PACKET, PACKET_VERSION, TPACKET_V3)
+        # The kernel hands over a block when it is full or after 100 ms
+        request = TPACKET_REQ3.pack(BLOCK_SIZE, self.block_count, FRAME_SIZE,
+                                    BLOCK_SIZE // FRAME_SIZE * self.block_count, 100, 0, 0)
+        self.socket.setsockopt(SOL_PACKET, PACKET_RX_RING, request)
+        self.ring = mmap(self.socket.fileno(), BLOCK_SIZE * self.block_count, MAP_SHARED, PROT_READ | PROT_WRITE)
+        self.block_index = 0
+
+    def open_file(self):
+        """Start a new capture file: <start>__<interface>.pcap"""
+        self.file_start = monotonic()
+        self.file_path = self.directory.get_file_path(int(datetime.now().timestamp()), None, self.interface)
+        self.writer = pcap.PcapWriter(self.file_path, self.linktype)
+
+    def receive(self):
+        """Read the available frames and send them to the analyser as a single batch"""
+        if self.ring is not None:
+            packets = self.receive_ring()
+        else:
+            packets = self.receive_socket()
+
+        if packets is None:
+            return False
+
+        self.queue.put(packets)
+        self.counter.add(len(packets))
+
+        return True
+
+    def receive_socket(self):
+        """Read the frames waiting in the socket one by one"""
+        packets = []
+        view = memoryview(self.buffer)
+
+        try:
+            for index in range(self.queue.batch_size):
+                try:
+                    length, address = self.socket.recvfrom_into(self.buffer)
+                except BlockingIOError:
+                    break
+                except OSError as e:
+                    logger.log.error(f"The AF_PACKET socket of the {self.interface} interface failed: {e}")
+                    return None
+
+                if self.loopback and address[2] == PACKET_OUTGOING:
+                    continue
+
+                timestamp = time_ns()
+                frame = view[:length]
+                self.writer.write(timestamp // 1000000000, timestamp % 1000000000, frame, length)
+                addresses = pcap.decode(self.linktype, frame)
+                frame.release()
+
+                if addresses is not None:
+                    packets.append(pcap.packet_fields(addresses, length, timestamp / 1000000000, self.interface))
+
+        finally:
+            view.release()
+
+        return packets
+
+    def receive_ring(self):
+        """Read the frames of the blocks released by the kernel"""
+        packets = []
+        view = memoryview(self.ring)
+
+        try:
+            while True:
+                block = self.block_index * BLOCK_SIZE
+                status, count, offset = TPACKET_BLOCK_DESC.unpack_from(view, block + 8)
+
+                if not status & TP_STATUS_USER:
+                    break
+
+                offset += block
+
+                for index in range(count):
+                    next_offset, seconds, nanoseconds, snaplen, length, frame_status, mac = TPACKET3_HDR.unpack_from(view, offset)
+
+                    if self.loopback and view[offset + TPACKET3_PKTTYPE] == PACKET_OUTGOING:
+                        offset += next_offset
+                        continue
+
+                    frame = view[offset + mac:offset + mac + snaplen]
+                    self.writer.write(seconds, nanoseconds, frame, length)
+                    addresses = pcap.decode(self.linktype, frame)
+                    frame.release()
+
+                    if addresses is not None:
+                        packets.append(pcap.packet_fields(addresses, length, seconds + nanoseconds / 1000000000, self.interface))
+
+                    offset += next_offset
+
+                # Give the block back to the kernel
+                TPACKET_BLOCK_DESC.pack_into(view, block + 8, TP_STATUS_KERNEL, 0, 0)
+                self.block_index = (self.block_index + 1) % self.block_count
+
+        finally:
+            view.release()
+
+        return packets
+
+    def rotate(self):
+        """Start a new capture file when the current one is too big or too old"""
+        if self.writer is None:
+            return
+
+        size = self.directory.segment_size
+        duration = self.directory.segment_duration
+
+        if (size is not None and self.writer.size >= size * 1024) or \
+                (duration is not None and monotonic() - self.file_start >= duration):
+            self.writer.close()
+            self.directory.close(self.file_path)
+            self.open_file()
+
+    def close_socket(self):
+        """Unmap the ring and close the packet socket"""
+        if self.ring is not None:
+            self.ring.close()
+            self.ring = None
+
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+
+    def close(self):
+        """Close the packet socket and add the end timestamp to the name of the capture file"""
+        if self.socket is None:
+            return
+
+        self.close_socket()
+
+        if self.running:
+            logger.log.error(f"The AF_PACKET socket stopped listening to the {self.interface} interface unexpectedly.")
+            self.running = False
+            self.state = "Failed"
+        else:
+            self.state = "Stopped"
+
+        logger.log.info(f"Stop sniffing the {self.interface} interface.")
+
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+            self.directory.close(self.file_path)
+
+
+class SockFprog(Structure):
+    _fields_ = [("len", c_ushort), ("filter", c_void_p)]
+
+
+class BpfProgram(Structure):
+    _fields_ = [("bf_len", c_uint), ("bf_insns", c_void_p)]
+
+
+def get_hardware_type(interface):
+    """Return the ARPHRD type of an interface, None if it cannot be read"""
+    try:
+        with open(f"/sys/class/net/{interface}/type") as file:
+            return int(file.read())
+    except (OSError, ValueError):
+        return None
+
+
+def compile_filter(expression, linktype, interface):
+    """Compile a BPF expression with libpcap, or tcpdump if libpcap is not installed, return the instructions or None"""
+    library = find_library("pcap")
+
+    if library is not None:
+        try:
+            libpcap = CDLL(library)
+            libpcap.pcap_open_dead.restype = c_void_p
+            libpcap.pcap_open_dead.argtypes = [c_int, c_int]
+            libpcap.pcap_compile.argtypes = [c_void_p, POINTER(BpfProgram), c_char_p, c_int, c_uint32]
+            libpcap.pcap_geterr.restype = c_char_p
+            libpcap.pcap_geterr.argtypes = [c_void_p]
+            libpcap.pcap_freecode.argtypes = [POINTER(BpfProgram)]
+            libpcap.pcap_close.argtypes = [c_void_p]
+
+            handle = libpcap.pcap_open_dead(linktype, 262144)
+            program = BpfProgram()
+
+            try:
+                if libpcap.pcap_compile(handle, byref(program), expression.encode(), 1, PCAP_NETMASK_UNKNOWN) != 0:
+                    logger.log.error(f"Invalid capture filter ({expression}): {libpcap.pcap_geterr(handle).decode()}")
+                    return None
+
+                # struct bpf_insn {u_short code; u_char jt; u_char jf; bpf_u_int32 k;}
+                instructions = string_at(program.bf_insns, program.bf_len * 8)
+                libpcap.pcap_freecode(byref(program))
+                return instructions
+
+            finally:
+                libpcap.pcap_close(handle)
+
+        except (OSError, AttributeError) as e:
+            logger.log.warning(f"The libpcap library ({library}) cannot be used to compile the capture filter: {e}")
+
+    # tcpdump prints the number of instructions then one 'code jt jf k' line per instruction
+    try:
+        output = run(["tcpdump", "-i", interface, "-ddd", expression], stdout=PIPE, stderr=PIPE, check=True).stdout.decode()
+    except Exception as e:
+        logger.log.warning(f"Neither libpcap nor tcpdump can compile the capture filter: {e}")
+        return None
+
+    instruction = Struct("HBBI")
+    lines = output.split()
+    count = int(lines[0])
+    values = list(map(int, lines[1:1 + count * 4]))
+
+    return b"".join(instruction.pack(*values[index:index + 4]) for index in range(0, count * 4, 4))
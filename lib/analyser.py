@@ -1,31 +1,106 @@
 # -*- coding: utf-8 -*-
 
-from threading import Thread
+from time import time, monotonic
+from array import array
+from gc import disable, enable, isenabled
+from threading import Thread, Lock
+from concurrent.futures import ThreadPoolExecutor
 from logging import basicConfig, debug, info, warning, error, critical
 
-from queue import Queue
-from geoip2.database import Reader
+from queue import Queue, Empty
 
 from . import config
 from . import logger
+from . import geoip
+from . import flows
+from . import addresses
+from . import geotable
+from . import checkpoint
+from . import history
+from . import sketches
+from . import cardinality
+from . import scans
 
 
 class Analyser(Thread):
 
+    # Tshark fields read by extract_data, the sniffer only asks tshark for these ones
+    fields = ["frame.time_epoch", "frame.len",
+              "ip.src", "ip.dst", "ip.src_host", "ip.dst_host",
+              "ipv6.src", "ipv6.dst", "ipv6.src_host", "ipv6.dst_host",
+              "tcp.srcport", "tcp.dstport", "udp.srcport", "udp.dstport"]
     endpoints = None
-    conversations = None
+    flows = None
+    top_talkers = None
+    top_conversations = None
+    cardinality = None
+    scans = None
+    flow_update_interval = None
+    last_flow_update = None
+    endpoint_timeout = None
+    conversation_timeout = None
+    now = None
+    clock = None
     sniffers_queue = None
     application_queue = None
     running = None
-
-    def __init__(self, sniffers_queue, application_queue):
+    name = None
+    packets = None
+    estimated_packets = None
+    geoip = None
+    classifier = None
+    geotable = None
+    enrichment_pool = None
+    enrichment_lock = None
+    enriched_events = None
+    pending_lookups = None
+    new_endpoints = None
+    checkpoint = None
+    history = None
+
+    def __init__(self, sniffers_queue, application_queue, store_name="analyser"):
         """Initialize an packet analyser"""
         Thread.__init__(self, daemon=True)
         self.sniffers_queue = sniffers_queue
         self.application_queue = application_queue
         self.endpoints = {}
-        self.conversations = {}
+        self.flows = flows.FlowTable()
+        # Heaviest endpoints and conversations by bytes since the start, in a bounded memory
+        sketch_size = config.get_int("top_talkers_counters", 512)
+        self.top_talkers = sketches.FrequentItems(sketch_size)
+        self.top_conversations = sketches.FrequentItems(sketch_size)
+        # Distinct external endpoints per minute and per hour
+        self.cardinality = cardinality.EndpointCardinality()
+        # Sources contacting many distinct destinations or ports, an alert is sent to the application
+        self.scans = scans.ScanDetector()
+        # Seconds between two updates of the counters of the flows sent to the application
+        self.flow_update_interval = config.get_int("flow_update_interval", 5)
+        self.last_flow_update = monotonic()
+        # Seconds without packets after which an endpoint or a conversation is forgotten, None: never
+        self.endpoint_timeout = config.get_int("endpoint_idle_timeout")
+        self.conversation_timeout = config.get_int("conversation_idle_timeout")
+        # Most recent packet timestamp, the idle times are measured in capture time so that replays age alike
+        self.clock = 0.0
         self.running = False
+        self.name = "Analyser"
+        self.packets = 0
+        self.estimated_packets = 0
+        self.geoip = geoip.GeoIPDatabase(config.get("geolite2_city_database"))
+        # Local and special addresses are tagged without looking them up
+        self.classifier = addresses.AddressClassifier()
+        self.geotable = self.load_geotable()
+        # The new endpoints are located by these workers, the packets are analysed meanwhile
+        self.enrichment_pool = ThreadPoolExecutor(max_workers=config.get_int("geoip_workers", 2), thread_name_prefix="GeoIP")
+        self.enrichment_lock = Lock()
+        self.enriched_events = []
+        # Batches of endpoints submitted to the workers and not located yet
+        self.pending_lookups = []
+        # Endpoints of the current batch of packets, located together
+        self.new_endpoints = []
+        # The endpoints and the conversations survive a restart
+        self.checkpoint = checkpoint.Checkpoint(store_name)
+        # The counters of the flows are kept on disk per time bucket
+        self.history = history.FlowHistory(store_name)
         logger.log.info("Analyser ready.")
 
     def analyse(self):
@@ -36,164 +111,387 @@ class Analyser(Thread):
     def run(self):
         """Get the packet sniffed and extract the data"""
         logger.log.info("Analyser running.")
+        events = self.restore()
+        if len(events) > 0:
+            self.application_queue.put(events)
+
         while self.running or not self.sniffers_queue.empty():
-            packet = self.sniffers_queue.get()
-            self.extract_data(packet)
+            try:
+                packets = self.sniffers_queue.get(timeout=1)
+            except Empty:
+                # Do not keep the located endpoints and the flow counters waiting for the next packets
+                events = self.get_pending_events()
+                if len(events) > 0:
+                    self.application_queue.put(events)
+                continue
+
+            # The events of a batch of packets are sent as a single batch
+            self.application_queue.put(self.analyse_packets(packets))
             self.sniffers_queue.task_done()
+
+        self.close()
         logger.log.info("Analyser stoped.")
 
+    def analyse_packets(self, packets):
+        """Extract the data of a batch of packets, return the resulting events"""
+        events = []
+        # Packets without timestamp are dated by their arrival in the analyser
+        self.now = time()
+
+        for packet in packets:
+            self.extract_data(packet, events)
+            # A sampled packet stands for sample_weight packets of the capture
+            self.estimated_packets += packet.get("sample_weight", 1)
+
+        self.packets += len(packets)
+        self.enrich_new_endpoints()
+
+        return events + self.get_pending_events()
+
     def stop(self):
         """Stop analyzing the packets"""
         self.running = False
 
-    def extract_data(self, packet):
-        """Extract all the data from the packet and the databases"""
+    def get_counters(self):
+        """Return the counters of the analyser as (name, value) pairs"""
+        counters = [("Packets analysed", self.packets),
+                    ("Packets captured (estimated)", self.estimated_packets),
+                    ("Endpoints", len(self.endpoints)),
+                    ("Endpoints waiting for their location", sum(len(batch) for batch in self.pending_lookups)),
+                    ("Conversations", len(self.flows))]
 
-        src, dst = {}, {}
+        if self.checkpoint.is_enabled():
+            counters += self.checkpoint.get_counters()
 
-        for (index, value) in [
-                ("ip_addr", "ip.src"),
-                ("hostname", "ip.src_host")]:
-            try:
-                src[index] = packet["_source"]["layers"]["ip"][value]
-            except:
-                src[index] = None
+        if self.history.is_enabled():
+            counters += self.history.get_counters()
 
-        for (index, value) in [
-                ("ip_addr", "ip.dst"),
-                ("hostname", "ip.dst_host")]:
-            try:
-                dst[index] = packet["_source"]["layers"]["ip"][value]
-            except:
-                dst[index] = None
-
-        for data in (src, dst):
-            if data["ip_addr"] and data["ip_addr"] not in self.endpoints.keys():
-                data.update(self.get_ip_info(data["ip_addr"]))
-                self.endpoints[data["ip_addr"]] = data
-                self.application_queue.put(("endpoint", data))
-
-        if src["ip_addr"] and dst["ip_addr"] and (src["ip_addr"], dst["ip_addr"]) not in self.conversations.keys():
-            data = {
-                "ip_src": src["ip_addr"],
-                "ip_dst": dst["ip_addr"]
-            }
-            self.conversations[(src["ip_addr"], dst["ip_addr"])] = data
-            self.application_queue.put(("conversation", data))
+        if self.scans.is_enabled():
+            counters += self.scans.get_counters()
+
+        return counters
+
+    def extract_data(self, packet, events):
+        """Extract all the data from the packet and the databases"""
+
+        layer = "ip" if "ip.src" in packet else "ipv6"
+        src = packet.get(f"{layer}.src")
+        dst = packet.get(f"{layer}.dst")
+        timestamp = float(packet.get("frame.time_epoch", self.now))
+        interface = packet.get("frame.interface_name")
+
+        if timestamp > self.clock:
+            self.clock = timestamp
+
+        for (ip, hostname) in [(src, packet.get(f"{layer}.src_host")),
+                               (dst, packet.get(f"{layer}.dst_host"))]:
+            if not ip:
+                continue
+
+            endpoint = self.endpoints.get(ip)
+
+            if endpoint is None:
+                # The endpoint is displayed right away, the location of a public one follows in an endpoint_enriched event
+                endpoint = Endpoint(ip, hostname)
+                endpoint.category = self.classifier.classify(ip)
+                self.endpoints[ip] = endpoint
+                events.append(("endpoint", endpoint))
+                if endpoint.category is None:
+                    self.enrich(endpoint)
+
+            if timestamp > endpoint.last_seen:
+                endpoint.last_seen = timestamp
+
+            if endpoint.category is None:
+                self.cardinality.add(endpoint, interface, timestamp)
+
+        if src and dst:
+            weight = packet.get("sample_weight", 1)
+            length = int(packet.get("frame.len", 0))
+            (index, new) = self.flows.add(src, dst, length, timestamp, weight)
+            volume = length * weight
+            self.top_talkers.add(src, volume)
+            self.top_talkers.add(dst, volume)
+            self.top_conversations.add(self.flows.keys[index], volume)
+
+            if self.scans.is_enabled():
+                self.detect_scan(packet, src, dst, timestamp, events)
+
+            if new:
+                # Both directions of a flow share the same edge, it points from the first sender to its peer
+                data = {
+                    "id": flows.get_flow_id(*self.flows.keys[index]),
+                    "ip_src": src,
+                    "ip_dst": dst
+                }
+                events.append(("conversation", data))
+
+    def detect_scan(self, packet, src, dst, timestamp, events):
+        """Count the destination and the port of a packet sent by its source, a reply of a service is not counted"""
+        port = packet.get("tcp.dstport")
+        source_port = packet.get("tcp.srcport")
+
+        if port is None:
+            port = packet.get("udp.dstport")
+            source_port = packet.get("udp.srcport")
+
+        if port is not None:
+            port = int(port)
+            # A service answers from its well known port to the ephemeral port of each client
+            if source_port is not None and port > int(source_port):
+                return
+
+        for alert in self.scans.add(src, dst, port, timestamp):
+            events.append(("scan_alert", alert))
+
+    def load_geotable(self):
+        """Return the GeoIP interval table if it is set and exported, None to locate the endpoints one by one"""
+        directory = config.get("geoip_table_path")
+
+        if directory is None:
+            return None
+
+        if geotable.numpy is None:
+            logger.log.warning("NumPy is not installed, the GeoIP interval table is not used.")
+            return None
+
+        try:
+            return geotable.GeoTable(directory)
+        except Exception as e:
+            logger.log.error(f"The GeoIP interval table {directory} cannot be loaded, export it with 'python geotable.py export': {e}")
+            return None
+
+    def enrich(self, endpoint):
+        """Locate a new endpoint with the other new endpoints of the batch"""
+        self.new_endpoints.append(endpoint)
+
+    def enrich_new_endpoints(self):
+        """Ask a worker to locate the new endpoints of the batch"""
+        if len(self.new_endpoints) == 0:
+            return
+
+        with self.enrichment_lock:
+            self.pending_lookups.append(self.new_endpoints)
+
+        self.enrichment_pool.submit(self.enrich_endpoints, self.new_endpoints)
+        self.new_endpoints = []
+
+    def enrich_endpoints(self, endpoints):
+        """Locate endpoints, run by the workers"""
+        try:
+            ips = [endpoint.ip_addr for endpoint in endpoints]
+            # A single vectorised search when the database is exported as an interval table
+            if self.geotable is not None:
+                locations = self.geotable.lookup_many(ips)
+            else:
+                locations = [self.get_ip_info(ip) for ip in ips]
+        except Exception as e:
+            logger.log.error(f"The location of {len(endpoints)} endpoints cannot be found: {e}")
+            locations = [None] * len(endpoints)
+
+        with self.enrichment_lock:
+            self.pending_lookups.remove(endpoints)
+
+            for (endpoint, location) in zip(endpoints, locations):
+                if location is not None:
+                    endpoint.location = location
+                    # The endpoint may have expired during the lookup
+                    if self.endpoints.get(endpoint.ip_addr) is endpoint:
+                        self.enriched_events.append(("endpoint_enriched", endpoint))
+
+    def get_pending_events(self):
+        """Return the events produced beside the packets: located endpoints and flow counters"""
+        events = self.get_enriched_events()
+
+        for (data_type, endpoint) in events:
+            self.cardinality.add_location(endpoint)
+
+        if monotonic() - self.last_flow_update >= self.flow_update_interval:
+            self.last_flow_update = monotonic()
+            updates = self.flows.get_updates()
+            if len(updates) > 0:
+                events.append(("flow_update", updates))
+                self.history.add(updates)
+                events.append(("heavy_hitters", (self.top_talkers.copy(), self.top_conversations.copy())))
+            events += self.expire()
+            self.history.flush(self.clock)
+            self.history.write_sketches(self.cardinality.seal(self.clock))
+            updates = self.cardinality.get_updates()
+            if len(updates) > 0:
+                events.append(("cardinality", updates))
+
+        if self.checkpoint.is_due():
+            self.checkpoint.save(self.get_state())
+
+        return events
+
+    def get_state(self):
+        """Return the endpoints and the conversations as columns, the snapshot of a checkpoint"""
+        endpoints = list(self.endpoints.values())
+        # Each location is written once, the endpoints refer to its position
+        locations = []
+        positions = {id(None): -1}
+
+        for endpoint in endpoints:
+            if id(endpoint.location) not in positions:
+                positions[id(endpoint.location)] = len(locations)
+                locations.append(endpoint.location)
+
+        # -1: not found, -2: the lookup was running, the endpoint is located again after a restore
+        with self.enrichment_lock:
+            pending = {endpoint.ip_addr for batch in self.pending_lookups for endpoint in batch}
+
+        return {"clock": self.clock,
+                "ip_addr": [endpoint.ip_addr for endpoint in endpoints],
+                "hostname": [endpoint.hostname for endpoint in endpoints],
+                "category": [endpoint.category for endpoint in endpoints],
+                "last_seen": array("d", [endpoint.last_seen for endpoint in endpoints]),
+                "location": array("l", [-2 if endpoint.ip_addr in pending else positions[id(endpoint.location)]
+                                      for endpoint in endpoints]),
+                "locations": locations,
+                "flows": self.flows.get_state(),
+                "history": self.history.get_state()}
+
+    def close(self):
+        """Write the last flow records and the last snapshot before stopping"""
+        # The queued lookups are dropped, the endpoints still waiting for them are located again after a restore
+        self.enrichment_pool.shutdown(wait=False, cancel_futures=True)
+        self.history.add(self.flows.get_updates())
+        self.history.close()
+        # The current buckets are written too, they are merged with the rest of their counts after a restart
+        self.history.write_sketches(self.cardinality.seal(self.clock, force=True))
+
+        if self.checkpoint.is_enabled():
+            self.checkpoint.save(self.get_state(), wait=True)
+
+    def restore(self):
+        """Load the endpoints and the conversations of the last checkpoint, return the events displaying them"""
+        # The collector would scan the new objects again and again, it doubles the time of a restore
+        collecting = isenabled()
+        disable()
+
+        try:
+            state = self.checkpoint.load()
+            events = [] if state is None else self.restore_state(state)
+        finally:
+            if collecting:
+                enable()
+
+        if state is not None:
+            logger.log.info(f"{len(self.endpoints)} endpoints and {len(self.flows)} conversations restored.")
+
+        return events
+
+    def restore_state(self, state):
+        """Rebuild the endpoints and the conversations of a checkpoint, the located endpoints share their locations again"""
+        events = []
+        enriched_events = []
+        locations = state["locations"]
+
+        for (ip, hostname, category, last_seen, location) in zip(state["ip_addr"], state["hostname"], state["category"],
+                                                                state["last_seen"], state["location"]):
+            endpoint = Endpoint(ip, hostname)
+            endpoint.category = category
+            endpoint.last_seen = last_seen
+            self.endpoints[ip] = endpoint
+            events.append(("endpoint", endpoint))
+
+            if location >= 0:
+                endpoint.location = locations[location]
+                enriched_events.append(("endpoint_enriched", endpoint))
+            # The lookup was still running when the snapshot was taken
+            elif location == -2:
+                self.enrich(endpoint)
+
+        self.enrich_new_endpoints()
+        self.clock = max(self.clock, state["clock"])
+        self.flows.set_state(state["flows"])
+        events += enriched_events
+        # The edges point from the first address of the pair, the first sender is not kept
+        events += [("conversation", {"id": flows.get_flow_id(a, b), "ip_src": a, "ip_dst": b}) for (a, b) in self.flows.keys]
+
+        if len(self.flows) > 0:
+            updates = self.flows.get_updates()
+            events.append(("flow_update", updates))
+
+            # The counters not written when the snapshot was taken are written now, a snapshot without them is taken
+            # as written already
+            if state.get("history") is not None:
+                self.history.restore(state["history"], updates)
+            else:
+                self.history.mark_recorded(updates)
+
+        return events
+
+    def expire(self):
+        """Forget the conversations and the endpoints idle for too long, return the removal events"""
+        events = []
+
+        if self.conversation_timeout is not None:
+            expired = self.flows.expire(self.clock - self.conversation_timeout)
+            self.history.forget(expired)
+            if len(expired) > 0:
+                events.append(("conversations_expired", [flows.get_flow_id(*key) for key in expired]))
+
+        if self.endpoint_timeout is not None:
+            cutoff = self.clock - self.endpoint_timeout
+            expired = [ip for (ip, endpoint) in self.endpoints.items() if endpoint.last_seen < cutoff]
+            for ip in expired:
+                del self.endpoints[ip]
+            if len(expired) > 0:
+                events.append(("endpoints_expired", expired))
+
+        return events
+
+    def get_enriched_events(self):
+        """Return the endpoint_enriched events of the lookups finished since the last call"""
+        with self.enrichment_lock:
+            events = self.enriched_events
+            self.enriched_events = []
+
+        return events
 
     def get_ip_info(self, ip):
-        """Search for data through a free GeoIP2 database"""
+        """Search for the location of an address through a free GeoIP2 database"""
+        return self.geoip.lookup(ip)
 
-        # Example : {'city_confidence': None, 'city_name': 'Dublin', 'continent_code': 'EU', 'continent_name': 'Europe', 'country_confidence': None, 'is_country_in_european_union': True, 'country_code': 'IE', 'country_name': 'Ireland', 'local_average_income': None, 'coordinates_accuracy_radius': 1000, 'latitude': 53.3331, 'longitude': -6.2489, 'metro_code': None, 'population_density': None, 'time_zone': 'Europe/Dublin', 'postal_code': 'D02', 'registered_country_confidence': None, 'is_registered_country_in_european_union': False, 'registered_country_code': 'US', 'registered_country_name': 'United States', 'represented_country_confidence': None, 'is_represented_country_in_european_union': False, 'represented_country_code': None, 'represented_country_name': None, 'represented_country_type': None, 'subdivisions': [{'subdivision_confidence': None, 'subdivision_code': 'L', 'subdivision_name': 'Leinster'}], 'as': None, 'connection_type': None, 'domain': None, 'is_anonymous': False, 'is_anonymous_proxy': False, 'is_anonymous_vpn': False, 'is_hosting_provider': False, 'is_legitimate_proxy': False, 'is_public_proxy': False, 'is_satellite_provider': False, 'is_tor_exit_node': False, 'isp': None, 'organization': None, 'static_ip_score': None, 'user_count': None, 'user_type': None, 'is_multicast': False, 'is_private': False, 'is_unspecified': False, 'is_reserved': False, 'is_loopback': False, 'is_link_local': False, 'with_prefixlen': IPv4Network('52.48.0.0/14'), 'compressed': '52.48.0.0/14', 'exploded': '52.48.0.0/14', 'with_netmask': '52.48.0.0/255.252.0.0', 'with_hostmask': '52.48.0.0/0.3.255.255', 'num_addresses': 262144, 'prefixlen': 14, 'network_address_version': 4, 'network_address_max_prefixlen': 32, 'network_address_compressed': '52.48.0.0', 'network_address_exploded': '52.48.0.0', 'network_address_reverse_pointer': '0.0.48.52.in-addr.arpa', 'network_address_is_multicast': False, 'network_address_is_private': False, 'network_address_is_global': True, 'network_address_is_unspecified': False, 'network_address_is_reserved': False, 'network_address_is_loopback': False, 'network_address_is_link_local': False, 'broadcast_address_version': 4, 'broadcast_address_max_prefixlen': 32, 'broadcast_address_compressed': '52.51.255.255', 'broadcast_address_exploded': '52.51.255.255', 'broadcast_address_reverse_pointer': '255.255.51.52.in-addr.arpa', 'broadcast_address_is_multicast': False, 'broadcast_address_is_private': False, 'broadcast_address_is_global': True, 'broadcast_address_is_unspecified': False, 'broadcast_address_is_reserved': False, 'broadcast_address_is_loopback': False, 'broadcast_address_is_link_local': False, 'hostmask_version': 4, 'hostmask_max_prefixlen': 32, 'hostmask_compressed': '0.3.255.255', 'hostmask_exploded': '0.3.255.255', 'hostmask_reverse_pointer': '255.255.3.0.in-addr.arpa', 'hostmask_is_multicast': False, 'hostmask_is_private': True, 'hostmask_is_global': False, 'hostmask_is_unspecified': False, 'hostmask_is_reserved': False, 'hostmask_is_loopback': False, 'hostmask_is_link_local': False, 'netmask_version': 4, 'netmask_max_prefixlen': 32, 'netmask_compressed': '255.252.0.0', 'netmask_exploded': '255.252.0.0', 'netmask_reverse_pointer': '0.0.252.255.in-addr.arpa', 'netmask_is_multicast': False, 'netmask_is_private': True, 'netmask_is_global': False, 'netmask_is_unspecified': False, 'netmask_is_reserved': True, 'netmask_is_loopback': False, 'netmask_is_link_local': False}
-        data = {}
 
-        database_path = config.get("geolite2_city_database")
+class Endpoint():
+    """Address seen in the packets, its location is shared with the other endpoints of its network"""
 
-        if database_path is None:
-            return {}
+    __slots__ = ("ip_addr", "hostname", "category", "location", "last_seen")
 
-        with Reader(database_path) as database:
-            try:
-                geoip2_city = database.city(ip)
-            except:
-                return {}
-
-            geoip2_records_city = geoip2_city.city
-            data["city_confidence"] = geoip2_records_city.confidence
-            data["city_name"] = geoip2_records_city.name
-
-            geoip2_records_continent = geoip2_city.continent
-            data["continent_code"] = geoip2_records_continent.code
-            data["continent_name"] = geoip2_records_continent.name
-
-            geoip2_records_country = geoip2_city.country
-            data["country_confidence"] = geoip2_records_country.confidence
-            data["is_country_in_european_union"] = geoip2_records_country.is_in_european_union
-            data["country_code"] = geoip2_records_country.iso_code
-            data["country_name"] = geoip2_records_country.name
-
-            geoip2_records_location = geoip2_city.location
-            data["local_average_income"] = geoip2_records_location.average_income
-            data["coordinates_accuracy_radius"] = geoip2_records_location.accuracy_radius
-            data["latitude"] = geoip2_records_location.latitude
-            data["longitude"] = geoip2_records_location.longitude
-            data["metro_code"] = geoip2_records_location.metro_code
-            data["population_density"] = geoip2_records_location.population_density
-            data["time_zone"] = geoip2_records_location.time_zone
-
-            geoip2_records_postal = geoip2_city.postal
-            data["postal_code"] = geoip2_records_postal.code
-
-            geoip2_records_registered_country = geoip2_city.registered_country
-            data["registered_country_confidence"] = geoip2_records_registered_country.confidence
-            data["is_registered_country_in_european_union"] = geoip2_records_registered_country.is_in_european_union
-            data["registered_country_code"] = geoip2_records_registered_country.iso_code
-            data["registered_country_name"] = geoip2_records_registered_country.name
-
-            geoip2_records_represented_country = geoip2_city.represented_country
-            data["represented_country_confidence"] = geoip2_records_represented_country.confidence
-            data["is_represented_country_in_european_union"] = geoip2_records_represented_country.is_in_european_union
-            data["represented_country_code"] = geoip2_records_represented_country.iso_code
-            data["represented_country_name"] = geoip2_records_represented_country.name
-            data["represented_country_type"] = geoip2_records_represented_country.type
-
-            data["subdivisions"] = []
-            for geoip2_records_subdivision in geoip2_city.subdivisions:
-                data["subdivisions"].append({
-                    "subdivision_confidence": geoip2_records_subdivision.confidence,
-                    "subdivision_code": geoip2_records_subdivision.iso_code,
-                    "subdivision_name": geoip2_records_subdivision.name})
-
-            geoip2_records_traits = geoip2_city.traits
-            data["as"] = geoip2_records_traits.autonomous_system_organization
-            data["connection_type"] = geoip2_records_traits.connection_type
-            data["domain"] = geoip2_records_traits.domain
-            data["is_anonymous"] = geoip2_records_traits.is_anonymous
-            data["is_anonymous_proxy"] = geoip2_records_traits.is_anonymous_proxy
-            data["is_anonymous_vpn"] = geoip2_records_traits.is_anonymous_vpn
-            data["is_hosting_provider"] = geoip2_records_traits.is_hosting_provider
-            data["is_legitimate_proxy"] = geoip2_records_traits.is_legitimate_proxy
-            data["is_public_proxy"] = geoip2_records_traits.is_public_proxy
-            data["is_satellite_provider"] = geoip2_records_traits.is_satellite_provider
-            data["is_tor_exit_node"] = geoip2_records_traits.is_tor_exit_node
-            data["isp"] = geoip2_records_traits.isp
-            data["organization"] = geoip2_records_traits.organization
-            data["static_ip_score"] = geoip2_records_traits.static_ip_score
-            data["user_count"] = geoip2_records_traits.user_count
-            data["user_type"] = geoip2_records_traits.user_type
-
-            ipaddress = geoip2_records_traits.network
-            data["is_multicast"] = ipaddress.is_multicast
-            data["is_private"] = ipaddress.is_private
-            data["is_unspecified"] = ipaddress.is_unspecified
-            data["is_reserved"] = ipaddress.is_reserved
-            data["is_loopback"] = ipaddress.is_loopback
-            data["is_link_local"] = ipaddress.is_link_local
-            data["with_prefixlen"] = ipaddress.with_prefixlen
-            data["compressed"] = ipaddress.compressed
-            data["exploded"] = ipaddress.exploded
-            data["with_netmask"] = ipaddress.with_netmask
-            data["with_hostmask"] = ipaddress.with_hostmask
-            data["num_addresses"] = ipaddress.num_addresses
-            data["prefixlen"] = ipaddress.prefixlen
-
-            for (name, address) in [
-                    ("network_address", ipaddress.network_address),
-                    ("broadcast_address", ipaddress.broadcast_address),
-                    ("hostmask", ipaddress.hostmask),
-                    ("netmask", ipaddress.netmask)]:
-                data[f"{name}_version"] = address.version
-                data[f"{name}_max_prefixlen"] = address.max_prefixlen
-                data[f"{name}_version"] = address.version
-                data[f"{name}_compressed"] = address.compressed
-                data[f"{name}_exploded"] = address.exploded
-                data[f"{name}_reverse_pointer"] = address.reverse_pointer
-                data[f"{name}_is_multicast"] = address.is_multicast
-                data[f"{name}_is_private"] = address.is_private
-                data[f"{name}_is_global"] = address.is_global
-                data[f"{name}_is_unspecified"] = address.is_unspecified
-                data[f"{name}_is_reserved"] = address.is_reserved
-                data[f"{name}_is_loopback"] = address.is_loopback
-                data[f"{name}_is_link_local"] = address.is_link_local
+    def __init__(self, ip_addr, hostname=None):
+        self.ip_addr = ip_addr
+        self.hostname = hostname
+        # LAN, loopback, link-local, multicast, broadcast..., None for a public address
+        self.category = None
+        self.location = None
+        self.last_seen = 0.0
+
+    def get(self, key, default=None):
+        """Return an attribute of the endpoint or of its location"""
+        if key in self.__slots__:
+            return getattr(self, key)
+
+        if self.location is None:
+            return default
+
+        return self.location.get(key, default)
+
+    def get_version(self):
+        """Return the version of the IP address"""
+        return 6 if ":" in self.ip_addr else 4
+
+    def get_map_data(self):
+        """Return the fields displayed by the map"""
+        data = {"ip_addr": self.ip_addr,
+                "hostname": self.hostname,
+                "version": self.get_version()}
+
+        for key in ["continent_name", "country_name", "city_name"]:
+            value = self.get(key)
+            if value is not None:
+                data[key] = value
 
         return data
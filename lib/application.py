@@ -5,24 +5,31 @@ from psutil import sensors_battery, Process, virtual_memory, cpu_percent, disk_u
 from socket import AF_INET
 from datetime import timedelta, datetime
 from json import loads, dumps
+from math import sin, sinh, atan, log, pi, radians, degrees
 from pathlib import Path
 
 from plotly.graph_objects import Figure, Indicator
 from dash import Dash, callback_context, no_update
-from dash.dependencies import Output, Input, State
-from dash_html_components import Main, Div, Span, P, H2, Table, A, Br, Img
+from dash.dependencies import Output, Input, State, ClientsideFunction
+from dash_html_components import Main, Div, Span, P, H2, Table, A, Br, Img, Button
 from dash_bootstrap_components import Nav, NavLink, NavItem, Navbar, NavbarBrand, NavbarToggler, Toast
-from dash_core_components import Interval, Graph, Location
+from dash_core_components import Interval, Graph, Location, Dropdown, Store, Input as TextInput
 from dash_cytoscape import Cytoscape, load_extra_layouts
 from dash_leaflet import GeoJSON, Map, TileLayer
 from dash_leaflet.express import geojson_to_geobuf, dicts_to_geojson
-from dash_extensions.javascript import arrow_function
+from dash_extensions.javascript import arrow_function, Namespace
 from dash_table import DataTable
 from dash.exceptions import PreventUpdate
-from threading import Thread
+from threading import Thread, Lock
+from collections import OrderedDict
+from queue import Empty
 
 from . import config
 from . import logger
+from . import captures
+from . import flows
+from . import history
+from . import addresses
 
 config.load_config()
 
@@ -35,11 +42,53 @@ class NetworkChart():
 
     layout = None
     classes = None
+    nodes = None
+    edges = None
+    last_seen = None
+    new_edges = None
+    clock = None
     last_update = None
+    version = None
+    changes = None
+    max_changes = None
+    oldest_version = None
+    session = None
+    lock = None
+    groups = None
+    budget = None
+    views = None
 
     def __init__(self):
         """Create an empty network graph"""
         self.classes = []
+        # Address: node element
+        self.nodes = {}
+        # Flow identifier: edge element
+        self.edges = {}
+        # Element identifier: timestamp of its last packet, read by the time window of the dashboard
+        self.last_seen = {}
+        # Address: identifiers of its edges not counted yet, displayed with the node whatever the time window
+        self.new_edges = {}
+        # Most recent packet timestamp
+        self.clock = 0.0
+        # Increased by each change of an element, a browser is only sent the elements changed since the version it displays
+        self.version = 0
+        # Element identifier: version of its last change, added, updated or removed, the least recently changed first
+        self.changes = OrderedDict()
+        # Changes remembered, a browser further behind is sent the whole graph again
+        self.max_changes = config.get_int("network_delta_changes", 50000)
+        # Changes up to this version are forgotten
+        self.oldest_version = 0
+        # The versions of a graph are not compared with the ones of a previous run
+        self.session = datetime.now().timestamp()
+        # The charts are updated by the application thread and read by the web server ones
+        self.lock = Lock()
+        # Address: {grouping: name of its group}
+        self.groups = {}
+        # Elements laid out by a browser at most, the nodes are grouped beyond
+        self.budget = config.get_int("network_element_budget", 2000)
+        # (window, grouping, expanded groups, version): elements of a grouped graph sent to a browser, the most recent last
+        self.views = OrderedDict()
         # Load the extended set of network layouts
         load_extra_layouts()
 
@@ -101,6 +150,23 @@ class NetworkChart():
                 {'selector': 'edge:active', 'style': {
                     'target-label': 'data(weight)',
                 }},
+                # Both ends of the conversation sent packets
+                {'selector': 'edge.bidirectional', 'style': {
+                    'source-arrow-shape': 'triangle',
+                }},
+                # Group of endpoints, tapped to show or hide its endpoints
+                {'selector': 'node.group', 'style': {
+                    'content': 'data(label)',
+                    'shape': 'round-rectangle',
+                    'border-opacity': 1,
+                    'border-width': '1px',
+                    'border-color': '#555',
+                }},
+                # Conversations between two groups, thicker with more packets
+                {'selector': 'edge.aggregate', 'style': {
+                    'width': 'mapData(weight, 1, 100000, 2, 12)',
+                    'target-arrow-shape': 'none',
+                }},
             ]
         )
 
@@ -112,49 +178,412 @@ class NetworkChart():
                                                                'background-opacity': 0}}
             self.layout.stylesheet.append(selector)
 
-    def add_node(self, data):
+    def add_node(self, endpoint):
         """Add a new node to the graph"""
-        node = {'data': {'id': data["ip_addr"],
-                         'label': data["hostname"],
+        node = {'data': {'id': endpoint.ip_addr,
+                         'label': endpoint.hostname,
                          'parent': None},
                 'classes': "computer"}
-        if data["ip_addr"].split('.')[-1] == '1':
+        if endpoint.ip_addr.split('.')[-1] == '1':
             node["classes"] = "router"
         for name in self.classes:
-            if name in data["hostname"]:
+            if endpoint.hostname is not None and name in endpoint.hostname:
                 node["classes"] = name
+        # The local and special endpoints are never located, they are grouped by category
+        groups = {"subnet": addresses.get_subnet(endpoint.ip_addr),
+                  "as": endpoint.category or "Unknown AS",
+                  "country": endpoint.category or "Unknown country"}
+
+        with self.lock:
+            self.groups[endpoint.ip_addr] = groups
+
         self.add_element(node)
 
+    def locate_node(self, endpoint):
+        """Move a located node to the groups of its AS and its country"""
+        location = endpoint.location
+        groups = self.groups.get(endpoint.ip_addr)
+
+        if groups is None or location is None:
+            return
+
+        with self.lock:
+            if location.autonomous_system_organization is not None:
+                groups["as"] = location.autonomous_system_organization
+            if location.country_code is not None:
+                groups["country"] = location.country_name or location.country_code
+            self.record_change(endpoint.ip_addr)
+
     def add_edge(self, data):
         """Add an edge between two nodes"""
-        edge = {'data': {'source': data["ip_src"],
+        edge = {'data': {'id': data["id"],
+                         'source': data["ip_src"],
                          'target': data["ip_dst"],
                          'weight': None},
                 'classes': None}
         self.add_element(edge)
 
-    def add_compound(self, data):
-        """Not used yet"""
-        node = {'data': {'id': None, 'label': None,
-                         'parent': None, 'color': None}, 'classes': None}
-        self.add_element(compound)
+    def update_edges(self, flows_data):
+        """Weight the edges with the number of packets of their flow"""
+        with self.lock:
+            for flow in flows_data:
+                edge = self.edges.get(flows.get_flow_id(flow["ip_a"], flow["ip_b"]))
+
+                if edge is None:
+                    continue
+
+                # A new dict: the elements already handed to the web server are not modified
+                edge = dict(edge, data=dict(edge["data"]))
+                edge["data"]["weight"] = flow["packets_ab"] + flow["packets_ba"]
+                edge["data"]["bytes"] = flow["bytes_ab"] + flow["bytes_ba"]
+
+                if flow["packets_ab"] > 0 and flow["packets_ba"] > 0:
+                    edge["classes"] = "bidirectional"
+
+                self.edges[edge["data"]["id"]] = edge
+                self.forget_new_edge(edge)
+
+                # An endpoint is active as long as one of its conversations is
+                for id_ in (edge["data"]["id"], flow["ip_a"], flow["ip_b"]):
+                    self.last_seen[id_] = max(self.last_seen.get(id_, 0.0), flow["last_seen"])
+                    self.record_change(id_)
+                self.clock = max(self.clock, flow["last_seen"])
+
+        self.last_update = datetime.now().timestamp()
+
+    def remove_nodes(self, ips):
+        """Remove the nodes of expired endpoints and their remaining edges"""
+        ips = set(ips)
+
+        with self.lock:
+            for (id_, edge) in list(self.edges.items()):
+                if edge["data"]["source"] in ips or edge["data"]["target"] in ips:
+                    del self.edges[id_]
+                    self.last_seen.pop(id_, None)
+                    self.forget_new_edge(edge)
+                    self.record_change(id_)
+
+            for ip in ips:
+                self.nodes.pop(ip, None)
+                self.last_seen.pop(ip, None)
+                self.groups.pop(ip, None)
+                self.record_change(ip)
+
+        self.last_update = datetime.now().timestamp()
+
+    def remove_edges(self, ids):
+        """Remove the edges of expired conversations"""
+        with self.lock:
+            for id_ in ids:
+                edge = self.edges.pop(id_, None)
+                self.last_seen.pop(id_, None)
+                self.record_change(id_)
+
+                if edge is not None:
+                    self.forget_new_edge(edge)
+
+        self.last_update = datetime.now().timestamp()
 
     def add_element(self, element):
-        self.layout.elements.append(element)
+        with self.lock:
+            if "source" in element["data"]:
+                self.edges[element["data"]["id"]] = element
+                if element["data"]["id"] not in self.last_seen:
+                    for id_ in (element["data"]["source"], element["data"]["target"]):
+                        self.new_edges.setdefault(id_, set()).add(element["data"]["id"])
+            else:
+                self.nodes[element["data"]["id"]] = element
+            self.record_change(element["data"]["id"])
         self.last_update = datetime.now().timestamp()
 
-    def get_data(self):
-        return self.layout.elements
+    def forget_new_edge(self, edge):
+        """Remove an edge from the new edges of its nodes, once counted or removed"""
+        for id_ in (edge["data"]["source"], edge["data"]["target"]):
+            edges = self.new_edges.get(id_)
+
+            if edges is not None:
+                edges.discard(edge["data"]["id"])
+                if len(edges) == 0:
+                    del self.new_edges[id_]
+
+    def record_change(self, id_):
+        """Give a new version to an element, forget the oldest change once there are too many"""
+        self.version += 1
+        self.changes[id_] = self.version
+        self.changes.move_to_end(id_)
+
+        if len(self.changes) > self.max_changes:
+            (id_, self.oldest_version) = self.changes.popitem(last=False)
+
+    def get_data(self, window=None):
+        """Return the elements of the graph, only the ones active during the last window minutes if set"""
+        if window is None:
+            return list(self.nodes.values()) + list(self.edges.values())
+
+        cutoff = self.clock - window * 60
+        # The elements not counted yet are new
+        nodes = [node for (id_, node) in self.nodes.items() if self.last_seen.get(id_, cutoff) >= cutoff]
+        ids = {node["data"]["id"] for node in nodes}
+        edges = [edge for (id_, edge) in self.edges.items()
+                 if self.last_seen.get(id_, cutoff) >= cutoff and edge["data"]["source"] in ids and edge["data"]["target"] in ids]
+
+        return nodes + edges
+
+    def get_node_ids(self, window):
+        """Return the addresses of the nodes active during the last window minutes"""
+        with self.lock:
+            cutoff = self.clock - window * 60
+            return {id_ for id_ in self.nodes if self.last_seen.get(id_, cutoff) >= cutoff}
+
+    def is_visible(self, element, cutoff):
+        """Return True if an element is displayed with a time window starting at cutoff (None: no window)"""
+        if cutoff is None:
+            return True
+
+        data = element["data"]
+
+        if self.last_seen.get(data["id"], cutoff) < cutoff:
+            return False
+
+        if "source" in data:
+            return all(id_ in self.nodes and self.last_seen.get(id_, cutoff) >= cutoff for id_ in (data["source"], data["target"]))
+
+        return True
+
+    def count_elements(self, cutoff):
+        """Return the number of elements displayed with a time window starting at cutoff (None: no window)"""
+        if cutoff is None:
+            return len(self.nodes) + len(self.edges)
+
+        return sum(1 for id_ in self.nodes if self.last_seen.get(id_, cutoff) >= cutoff) + \
+            sum(1 for edge in self.edges.values() if self.is_visible(edge, cutoff))
+
+    def get_delta(self, state, window=None, grouping="subnet", expanded=()):
+        """Return the changes of the graph since the state of a browser, and its new state
+
+        The changes are {"full": True, "elements": [...]} to replace every element, or {"full": False, "elements": [...],
+        "removed": [...]}: the elements added or updated and the identifiers of the ones removed, None if there is none.
+        Beyond the element budget the nodes are shown by group (subnet, as or country), the groups expanded included.
+        The state, {"session", "version", "window", "cutoff", "grouping", "expanded"}, is kept by the browser and
+        given back at its next update, its grouping is None while the graph is not grouped."""
+        with self.lock:
+            cutoff = self.clock - window * 60 if window else None
+
+            if self.count_elements(cutoff) <= self.budget:
+                return self.get_changes(state, window, cutoff)
+
+            # The first groups expanded get the room left by the budget
+            expanded = list(expanded)
+            new_state = {"session": self.session, "version": self.version, "window": window, "cutoff": cutoff,
+                         "grouping": grouping, "expanded": expanded}
+            view = self.get_view(window, cutoff, grouping, expanded)
+            previous = None
+
+            if state is not None and state["session"] == self.session and state.get("grouping") is not None:
+                previous = self.views.get((state["window"], state["grouping"], tuple(state["expanded"]), state["version"]))
+
+        # The grouped graph is never larger than the budget, sending it again is bounded
+        if previous is None:
+            return ({"full": True, "elements": list(view.values()), "removed": []}, new_state)
+
+        elements = [element for (id_, element) in view.items() if previous.get(id_) != element]
+        removed = [id_ for id_ in previous if id_ not in view]
+
+        if len(elements) == 0 and len(removed) == 0:
+            return (None, new_state)
+
+        return ({"full": False, "elements": elements, "removed": removed}, new_state)
+
+    def get_changes(self, state, window, cutoff):
+        """Return the elements changed since the state of a browser, read from the change log, and its new state"""
+        new_state = {"session": self.session, "version": self.version, "window": window, "cutoff": cutoff,
+                     "grouping": None, "expanded": []}
+
+        # First display, new time window, grouped graph displayed, browser too far behind or application restarted
+        if state is None or state["session"] != self.session or state["window"] != window or \
+                state.get("grouping") is not None or not self.oldest_version <= state["version"] <= self.version:
+            return ({"full": True, "elements": self.get_data(window), "removed": []}, new_state)
+
+        ids = set()
+
+        for (id_, version) in reversed(self.changes.items()):
+            if version <= state["version"]:
+                break
+            ids.add(id_)
+
+        # The elements without packets since the new start of the window leave it
+        if cutoff is not None and state["cutoff"] is not None and cutoff > state["cutoff"]:
+            ids.update(id_ for (id_, last_seen) in self.last_seen.items() if state["cutoff"] <= last_seen < cutoff)
+
+        # A node entering the window brings its edges not counted yet, they have no time of their own
+        if cutoff is not None:
+            for id_ in [id_ for id_ in ids if id_ in self.new_edges]:
+                ids.update(self.new_edges[id_])
+
+        if len(ids) == 0:
+            return (None, new_state)
+
+        elements = []
+        removed = []
+
+        for id_ in ids:
+            element = self.nodes.get(id_) or self.edges.get(id_)
+
+            if element is not None and self.is_visible(element, cutoff):
+                elements.append(element)
+            else:
+                removed.append(id_)
+
+        # The nodes come first, the edges refer to them
+        elements.sort(key=lambda element: "source" in element["data"])
+
+        return ({"full": False, "elements": elements, "removed": removed}, new_state)
+
+    def get_view(self, window, cutoff, grouping, expanded):
+        """Return the elements of the graph grouped within the budget, {identifier: element}, the nodes first
+
+        The groups carrying the most bytes are kept, the other ones are merged into a single group. The children of
+        the expanded groups are shown inside them, the heaviest ones first while the budget allows, the remaining ones
+        as one node. The edges between groups are merged into one edge per pair of groups, the heaviest ones are kept."""
+        key = (window, grouping, tuple(expanded), self.version)
+        view = self.views.get(key)
+
+        if view is not None:
+            self.views.move_to_end(key)
+            return view
+
+        nodes = [id_ for id_ in self.nodes if cutoff is None or self.last_seen.get(id_, cutoff) >= cutoff]
+        edges = [edge for edge in self.edges.values() if self.is_visible(edge, cutoff)]
+        # Element identifier: bytes of its edges
+        traffic = {}
+
+        for edge in edges:
+            volume = edge["data"].get("bytes") or 0
+            for id_ in (edge["data"]["source"], edge["data"]["target"]):
+                traffic[id_] = traffic.get(id_, 0) + volume
+
+        # Group identifier: addresses of its nodes
+        members = {}
+
+        for id_ in nodes:
+            members.setdefault(f'group:{grouping}:{self.groups[id_][grouping]}', []).append(id_)
+
+        groups = sorted(members, key=lambda group: sum(traffic.get(id_, 0) for id_ in members[group]), reverse=True)
+        # Half of the budget for the nodes, half for the edges, and half of the nodes at most for the groups so that
+        # the expanded ones have room
+        node_budget = max(self.budget // 2, 4)
+        group_budget = node_budget // 2
+
+        if len(groups) > group_budget:
+            other = f"group:{grouping}:Other"
+            members[other] = [id_ for group in groups[group_budget - 1:] for id_ in members.pop(group)]
+            groups = groups[:group_budget - 1] + [other]
+
+        view = {}
+        # Address: identifier of the node it is shown as
+        display = {}
+
+        for group in groups:
+            view[group] = get_compound_node(group, f'{group.split(":", 2)[2]} ({len(members[group])})', len(members[group]))
+            for id_ in members[group]:
+                display[id_] = group
+
+        room = node_budget - len(view)
+
+        for group in expanded:
+            if group not in members or room <= 0:
+                continue
+
+            children = sorted(members[group], key=lambda id_: traffic.get(id_, 0), reverse=True)
+
+            # The remaining children are shown as one node
+            if len(children) > room:
+                rest = f"{group}:rest"
+                view[rest] = get_compound_node(rest, f"{len(children) - room + 1} more", len(children) - room + 1, group)
+                for id_ in children[room - 1:]:
+                    display[id_] = rest
+                children = children[:room - 1]
+                room -= 1
+
+            for id_ in children:
+                node = self.nodes[id_]
+                view[id_] = dict(node, data=dict(node["data"], parent=group))
+                display[id_] = id_
+
+            room -= len(children)
+
+        # Pair of displayed nodes: merged edge
+        merged = {}
+
+        for edge in edges:
+            data = edge["data"]
+            (source, target) = (display[data["source"]], display[data["target"]])
+
+            if source == target:
+                continue
+
+            if source == data["source"] and target == data["target"]:
+                merged[data["id"]] = edge
+                continue
+
+            (source, target) = sorted((source, target))
+            id_ = f"{source}|{target}"
+            aggregate = merged.get(id_)
+
+            if aggregate is None:
+                aggregate = merged[id_] = {'data': {'id': id_, 'source': source, 'target': target, 'weight': 0, 'bytes': 0},
+                                           'classes': "aggregate"}
+
+            aggregate["data"]["weight"] += data.get("weight") or 0
+            aggregate["data"]["bytes"] += data.get("bytes") or 0
+
+        edge_budget = max(self.budget - len(view), 0)
+
+        for edge in sorted(merged.values(), key=lambda edge: edge["data"].get("bytes") or 0, reverse=True)[:edge_budget]:
+            view[edge["data"]["id"]] = edge
+
+        self.views[key] = view
+
+        # A few views per browser are enough to compute their changes
+        while len(self.views) > 32:
+            self.views.popitem(last=False)
+
+        return view
+
+
+def get_compound_node(id_, label, count, parent=None):
+    """Return the node of a group of endpoints, their parent once the group is expanded"""
+    return {'data': {'id': id_, 'label': label, 'parent': parent, 'count': count, 'color': "#2a2d2f"},
+            'classes': "group"}
 
 
 class MapChart():
 
     layout = None
     points = None
+    positions = None
+    version = None
+    session = None
+    indexes = None
+    encodings = None
+    lock = None
 
     def __init__(self):
         """Create an empty world map"""
-        self.points = []
+        # Address: point
+        self.points = {}
+        # Address: (x, y) of its point in the Web Mercator projection, between 0 and 1
+        self.positions = {}
+        # Increased by each point added or removed, the clusters and their encodings are computed once per version
+        self.version = 0
+        # The versions start again with the application, a browser displaying the encoding of another session gets a new one
+        self.session = datetime.now().timestamp()
+        # (version, filter, zoom): clusters of the points, and (version, filter, zoom, cells in view): geobuf encoding,
+        # the most recent last
+        self.indexes = OrderedDict()
+        self.encodings = OrderedDict()
+        # The points are added by the application thread and read by the web server ones
+        self.lock = Lock()
 
         map_info = Toast(
             [P("This is the content of the toast", className="mb-0")],
@@ -195,6 +624,8 @@ class MapChart():
                 data=None,
                 format="geobuf",
                 id="geolocation",
+                # The clusters are drawn with their number of points (assets/js/map.js)
+                options=dict(pointToLayer=Namespace("cartographe", "map")("point_to_layer")),
                 hoverStyle=dict(
                     weight=5,
                     color='red',
@@ -203,30 +634,162 @@ class MapChart():
             ),
             map_info
         ],
+            id="map",
             zoom=2,
             center=(32, 10),
             style={'width': '100%', 'height': '500px'}
         )
 
-    def add_point(self, data):
+    def add_point(self, endpoint):
         """Add a pin to the map"""
-        if "latitude" in data.keys() and "longitude" in data.keys():
-            self.points.append(
-                {'lat': data["latitude"],
-                 'lon': data["longitude"],
-                 'data': data})
+        location = endpoint.location
+        if location is not None and location.latitude is not None and location.longitude is not None:
+            with self.lock:
+                # Only the fields displayed by the map are sent to the browser
+                self.points[endpoint.ip_addr] = {
+                    'lat': location.latitude,
+                    'lon': location.longitude,
+                    'data': endpoint.get_map_data()}
+                self.positions[endpoint.ip_addr] = project(location.latitude, location.longitude)
+                self.version += 1
+
+    def remove_points(self, ips):
+        """Remove the pins of expired endpoints"""
+        with self.lock:
+            for ip in ips:
+                if self.points.pop(ip, None) is not None:
+                    del self.positions[ip]
+                    self.version += 1
+
+    def get_data(self, ips=None, filter_key=None, zoom=None, bounds=None):
+        """Return the pins and clusters of pins in view at a zoom level, encoded to geobuf, and the key of the encoding
+
+        The pins are grouped per cell of a grid of CLUSTER_RADIUS pixels at the zoom level, a cell holding several
+        pins is sent as a single cluster with their number. Only the pins of the addresses ips are drawn, all of them if
+        None, filter_key identifies this set of addresses. Only the cells in the bounds, [[south, west], [north, east]],
+        are sent, all of them if None. The encoding is computed once per version of the pins, filter, zoom level and
+        cells in view, and the key changes only with it: a browser already displaying it is not sent it again."""
+        zoom = min(int(round(zoom if zoom is not None else 2)), MAX_CLUSTER_ZOOM)
+        # Side of the cells of the grid at this zoom level
+        cells = CLUSTER_RADIUS / TILE_SIZE / 2 ** zoom
+
+        if ips is None:
+            filter_key = None
+
+        with self.lock:
+            view = None
+
+            if bounds is not None:
+                ((south, west), (north, east)) = bounds
+                (x_min, y_max) = project(south, max(west, -180.0))
+                (x_max, y_min) = project(north, min(east, 180.0))
+                # One more cell around the view, the clusters near its edges are kept as it moves a little
+                view = (int(x_min // cells) - 1, int(y_min // cells) - 1, int(x_max // cells) + 1, int(y_max // cells) + 1)
+
+            key = (self.version, filter_key, zoom, view)
+            encoding = self.encodings.get(key)
+
+            # The key as read back from the browser, in JSON
+            state = [self.session, self.version, None if filter_key is None else list(filter_key), zoom,
+                     None if view is None else list(view)]
+
+            if encoding is not None:
+                self.encodings.move_to_end(key)
+                return (encoding, state)
+
+            # From the last zoom level the pins are merged only at the same position
+            clusters = self.get_clusters(ips, filter_key, zoom, cells if zoom < MAX_CLUSTER_ZOOM else 0.0)
+
+            if view is not None:
+                (left, top, right, bottom) = view
+                clusters = [cluster for cluster in clusters
+                            if left <= cluster["x"] // cells <= right and top <= cluster["y"] // cells <= bottom]
+
+            encoding = geojson_to_geobuf(dicts_to_geojson([cluster["point"] for cluster in clusters]))
+            self.encodings[key] = encoding
+
+            while len(self.encodings) > 64:
+                self.encodings.popitem(last=False)
+
+        return (encoding, state)
+
+    def get_clusters(self, ips, filter_key, zoom, cells):
+        """Return the clusters of the pins at a zoom level: their position and their point, a cluster or a pin alone"""
+        key = (self.version, filter_key, zoom)
+        clusters = self.indexes.get(key)
+
+        if clusters is not None:
+            self.indexes.move_to_end(key)
+            return clusters
+
+        # Cell: [sum of x, sum of y, addresses]
+        grid = {}
+
+        for (ip, (x, y)) in self.positions.items():
+            if ips is not None and ip not in ips:
+                continue
+
+            cell = (x // cells, y // cells) if cells > 0 else (x, y)
+            members = grid.get(cell)
+
+            if members is None:
+                grid[cell] = [x, y, [ip]]
+            else:
+                members[0] += x
+                members[1] += y
+                members[2].append(ip)
 
-    def get_data(self):
-        """Convert and return the data needed for the map"""
-        return geojson_to_geobuf(dicts_to_geojson(self.points))
+        clusters = []
+
+        for (sum_x, sum_y, members) in grid.values():
+            (x, y) = (sum_x / len(members), sum_y / len(members))
+
+            if len(members) == 1:
+                point = self.points[members[0]]
+            else:
+                (lat, lon) = unproject(x, y)
+                # The first addresses are listed when the cluster is hovered
+                point = {'lat': lat, 'lon': lon, 'cluster': True, 'point_count': len(members),
+                         'data': {'cluster': len(members), 'ip_addrs': sorted(members)[:10]}}
+
+            clusters.append({"x": x, "y": y, "point": point})
+
+        self.indexes[key] = clusters
+
+        while len(self.indexes) > 16:
+            self.indexes.popitem(last=False)
+
+        return clusters
+
+
+# Pixels of a map tile, and of a cell of the grid clustering the pins
+TILE_SIZE = 256
+CLUSTER_RADIUS = 60
+# Zoom level from which only the pins at the same position are clustered
+MAX_CLUSTER_ZOOM = 16
+# Latitude limit of the Web Mercator projection
+MAX_LATITUDE = 85.0511
+
+
+def project(lat, lon):
+    """Return the (x, y) Web Mercator position of a latitude and a longitude, both between 0 and 1"""
+    sine = sin(radians(max(min(lat, MAX_LATITUDE), -MAX_LATITUDE)))
+    return ((lon + 180) / 360, 0.5 - log((1 + sine) / (1 - sine)) / (4 * pi))
+
+
+def unproject(x, y):
+    """Return the (latitude, longitude) of a Web Mercator position"""
+    return (degrees(atan(sinh(pi * (1 - 2 * y)))), x * 360 - 180)
 
 
 class CaptureTable():
 
     data = None
     layout = None
+    directory = None
 
     def __init__(self):
+        self.directory = captures.CaptureDirectory()
         self.data = self.get_captures()
         self.layout = DataTable(
             id='capture_table',
@@ -245,9 +808,11 @@ class CaptureTable():
         captures = []
         files = sorted(Path(f'{config.get("prog_path")}/capture/').glob('*.pcap'), reverse=True)
 
-        for file in files:
-            start, end, interface = file.name.replace(
-                ".pcap", '').split('_')
+        # Segments currently written by tshark when the capture rotates
+        segments = [(start, "", interface, file) for (index, start, interface, file) in self.directory.get_segments(None)]
+        files = [tuple(file.name.replace(".pcap", '').split('_', 2)) + (file,) for file in files]
+
+        for (start, end, interface, file) in segments + files:
             start = datetime.fromtimestamp(int(start))
             if end == "":
                 now = datetime.now().timestamp()
@@ -266,7 +831,7 @@ class CaptureTable():
                 "capture_duration": duration,
                 "capture_interface": interface,
                 "capture_size": bytes2human(file.stat().st_size),
-                "capture_file": f'{config.get("prog_path")}/capture/{file.name}'})
+                "capture_file": str(file)})
 
         return captures
 
@@ -275,8 +840,10 @@ class InterfaceTable():
 
     data = None
     layout = None
+    sources = None
 
     def __init__(self):
+        self.sources = {}
         self.data = self.get_interfaces()
         self.layout = self.get_layout()
 
@@ -288,7 +855,9 @@ class InterfaceTable():
             "interface_mac": MAC,
             "interface_ip": IPv4,
             "interface_sent": sent,
-            "interface_received": received
+            "interface_received": received,
+            "interface_capture": "",
+            "interface_rate": ""
         }
         return interface_object
 
@@ -313,6 +882,16 @@ class InterfaceTable():
             received = bytes2human(received)
             interfaces.append(self.new_interface_object(
                 name, state, speed, MAC, IPv4, sent, received))
+
+        # Capture state and packet rate of the interfaces listened to
+        for (name, source) in self.sources.items():
+            interface = next((interface for interface in interfaces if interface["interface_name"] == name), None)
+            if interface is None:
+                interface = self.new_interface_object(name, "", "", "", "", "", "")
+                interfaces.append(interface)
+            interface["interface_capture"] = source.state
+            interface["interface_rate"] = int(source.get_rate())
+
         interfaces = sorted(
             interfaces, key=lambda interface: interface["interface_state"], reverse=True)
 
@@ -326,13 +905,15 @@ class InterfaceTable():
             style_data_conditional=[
                 {"if": {"filter_query": "{interface_state} = 'Down'"}, "opacity": "0.25"}],
             style_cell_conditional=[
-                {"if": {"column_id": "interface_name"}, "width": "20%"},
+                {"if": {"column_id": "interface_name"}, "width": "15%"},
                 {"if": {"column_id": "interface_state"}, "width": "10%"},
                 {"if": {"column_id": "interface_speed"}, "width": "10%"},
-                {"if": {"column_id": "interface_mac"}, "width": "20%"},
-                {"if": {"column_id": "interface_ip"}, "width": "20%"},
+                {"if": {"column_id": "interface_mac"}, "width": "15%"},
+                {"if": {"column_id": "interface_ip"}, "width": "15%"},
                 {"if": {"column_id": "interface_received"}, "width": "10%"},
-                {"if": {"column_id": "interface_sent"}, "width": "10%"}],
+                {"if": {"column_id": "interface_sent"}, "width": "10%"},
+                {"if": {"column_id": "interface_capture"}, "width": "10%"},
+                {"if": {"column_id": "interface_rate"}, "width": "5%"}],
             columns=[{"id": id_, "name": name} for (id_, name) in [
                 ("interface_name", "Name"),
                 ("interface_state", "State"),
@@ -340,7 +921,9 @@ class InterfaceTable():
                 ("interface_mac", "MAC"),
                 ("interface_ip", "IPv4"),
                 ("interface_sent", "Sent"),
-                ("interface_received", "Received")]])
+                ("interface_received", "Received"),
+                ("interface_capture", "Capture"),
+                ("interface_rate", "Packets/s")]])
 
         return layout
 
@@ -528,6 +1111,263 @@ class LogFileTable():
         return layout
 
 
+class CounterTable():
+    """Create a table with the counters exported by the modules of the program"""
+
+    data = None
+    layout = None
+    sources = None
+
+    def __init__(self):
+        """Initialize the layout of the table, the sources are added by the application"""
+        self.sources = []
+        self.data = self.get_counters()
+        self.layout = self.get_layout()
+
+    def new_counter_object(self, module, name, value):
+        """Create a custom counter object with all the needed information"""
+        counter_object = {
+            "counter_module": module,
+            "counter_name": name,
+            "counter_value": value
+        }
+        return counter_object
+
+    def get_counters(self):
+        """Get the list of custom counter objects"""
+        counters = []
+
+        for source in self.sources:
+            for (name, value) in source.get_counters():
+                counters.append(self.new_counter_object(source.name, name, value))
+
+        return counters
+
+    def get_layout(self):
+        """Get the HTML layout of the table"""
+        layout = DataTable(
+            id='counter_table',
+            data=self.data,
+            style_cell_conditional=[
+                {"if": {"column_id": "counter_module"}, "width": "30%"},
+                {"if": {"column_id": "counter_name"}, "width": "40%"}],
+            columns=[{"id": id_, "name": name} for (id_, name) in [
+                ("counter_module", "Module"),
+                ("counter_name", "Counter"),
+                ("counter_value", "Value")]])
+
+        return layout
+
+
+class LanTable():
+    """Create a table with the local and special endpoints, which have no place on the world map"""
+
+    endpoints = None
+    layout = None
+    lock = None
+
+    def __init__(self):
+        """Initialize an empty table"""
+        # Address: row
+        self.endpoints = {}
+        # The rows are added by the application thread and read by the web server ones
+        self.lock = Lock()
+        self.layout = DataTable(
+            id='lan_table',
+            data=[],
+            sort_action='native',
+            page_size=20,
+            columns=[{"id": id_, "name": name} for (id_, name) in [
+                ("lan_ip_addr", "Address"),
+                ("lan_hostname", "Hostname"),
+                ("lan_category", "Category")]])
+
+    def add_endpoint(self, endpoint):
+        """Add a row for a local endpoint"""
+        with self.lock:
+            self.endpoints[endpoint.ip_addr] = {
+                "lan_ip_addr": endpoint.ip_addr,
+                "lan_hostname": endpoint.hostname,
+                "lan_category": endpoint.category}
+
+    def remove_endpoints(self, ips):
+        """Remove the rows of expired endpoints"""
+        with self.lock:
+            for ip in ips:
+                self.endpoints.pop(ip, None)
+
+    def get_data(self, ips=None):
+        """Return the rows of the table, only the ones of the given addresses if set"""
+        with self.lock:
+            if ips is None:
+                return list(self.endpoints.values())
+
+            return [row for (ip, row) in self.endpoints.items() if ip in ips]
+
+
+class TopTable():
+    """Create a table with the heaviest endpoints or conversations by bytes, estimated by a sketch of the analyser"""
+
+    layout = None
+    rows = None
+    count = None
+    prefix = None
+
+    def __init__(self, id_, item_name, count=20):
+        """Initialize an empty table of the count heaviest items"""
+        self.count = count
+        self.prefix = id_
+        self.rows = []
+        self.layout = DataTable(
+            id=id_,
+            data=[],
+            columns=[{"id": f"{id_}_{key}", "name": name} for (key, name) in [
+                ("rank", "#"),
+                ("item", item_name),
+                ("bytes", "Bytes"),
+                ("share", "Share"),
+                ("error", "Error")]])
+
+    def set_sketch(self, sketch, label=str, total=None):
+        """Replace the rows by the heaviest items of a sketch, the error is the most the bytes may be underestimated"""
+        rows = []
+        total = sketch.total if total is None else total
+
+        for (rank, (item, lower, upper)) in enumerate(sketch.top(self.count), start=1):
+            rows.append({f"{self.prefix}_rank": rank,
+                         f"{self.prefix}_item": label(item),
+                         f"{self.prefix}_bytes": bytes2human(lower),
+                         f"{self.prefix}_share": f"{100 * lower / total:.1f} %" if total else "",
+                         f"{self.prefix}_error": f"+{bytes2human(upper - lower)}" if upper > lower else "exact"})
+
+        self.rows = rows
+
+    def get_data(self):
+        """Return the rows of the table"""
+        return self.rows
+
+
+class CardinalityTable():
+    """Create a table with the number of distinct external endpoints during the current minute and the current hour"""
+
+    layout = None
+    sketches = None
+    rows = None
+    limit = None
+
+    def __init__(self):
+        """Initialize an empty table"""
+        # (granularity, bucket): {(dimension, value): sketch}, only the last bucket of each granularity
+        self.sketches = {}
+        self.rows = []
+        self.limit = 50
+        self.layout = DataTable(
+            id='cardinality_table',
+            data=[],
+            sort_action='native',
+            page_size=20,
+            columns=[{"id": id_, "name": name} for (id_, name) in [
+                ("cardinality_dimension", "Per"),
+                ("cardinality_value", "Value"),
+                ("cardinality_minute", "This minute"),
+                ("cardinality_hour", "This hour")]])
+
+    def update(self, updates):
+        """Merge the sketches sent by the analyser, the ones of the shards of a sharded analyser add up"""
+        for (bucket, bucket_sketches) in updates.items():
+            current = self.sketches.setdefault(bucket, {})
+
+            for (dimension, sketch) in bucket_sketches.items():
+                if dimension in current:
+                    current[dimension].merge(sketch)
+                else:
+                    current[dimension] = sketch
+
+        latest = {}
+
+        for (granularity, start) in self.sketches:
+            latest[granularity] = max(latest.get(granularity, start), start)
+
+        self.sketches = {bucket: self.sketches[bucket] for bucket in latest.items()}
+        minute = self.sketches.get(("minute", latest.get("minute")), {})
+        hour = self.sketches.get(("hour", latest.get("hour")), {})
+        order = ["all", "interface", "country", "as"]
+        rows = []
+
+        for ((dimension, value), sketch) in hour.items():
+            rows.append({"cardinality_dimension": dimension if dimension != "all" else "All",
+                         "cardinality_value": value,
+                         "cardinality_minute": minute[(dimension, value)].estimate() if (dimension, value) in minute else 0,
+                         "cardinality_hour": sketch.estimate()})
+
+        rows.sort(key=lambda row: (order.index(row["cardinality_dimension"].lower()), -row["cardinality_hour"]))
+        self.rows = rows[:self.limit]
+
+    def get_data(self):
+        """Return the rows of the table"""
+        return self.rows
+
+
+class HistoryView():
+    """Create a graph and a table with the conversations of a past time window, read from the history"""
+
+    network = None
+    table = None
+    limit = None
+
+    def __init__(self, network_layout):
+        """Initialize an empty view, its graph looks like the network chart"""
+        # Conversations displayed, the ones with the most bytes first
+        self.limit = 500
+        self.network = Cytoscape(
+            id="history_network",
+            layout=network_layout.layout,
+            responsive=True,
+            elements=[],
+            style={'width': '100%', 'height': '600px'},
+            stylesheet=network_layout.stylesheet)
+        self.table = DataTable(
+            id='history_table',
+            data=[],
+            sort_action='native',
+            page_size=20,
+            columns=[{"id": id_, "name": name} for (id_, name) in [
+                ("history_ip_a", "Address A"),
+                ("history_ip_b", "Address B"),
+                ("history_packets_ab", "Packets A → B"),
+                ("history_packets_ba", "Packets B → A"),
+                ("history_bytes", "Bytes"),
+                ("history_first_seen", "First minute"),
+                ("history_last_seen", "Last minute")]])
+
+    def get_data(self, start, end, ip=None):
+        """Return the elements of the graph and the rows of the table of a time window, only the ones of an address if set"""
+        flows_data = history.query(start, end, ip)[:self.limit]
+        nodes = {}
+        edges = []
+        rows = []
+
+        for flow in flows_data:
+            for address in (flow["ip_a"], flow["ip_b"]):
+                nodes[address] = {'data': {'id': address, 'label': address, 'parent': None}, 'classes': "computer"}
+
+            edges.append({'data': {'id': flows.get_flow_id(flow["ip_a"], flow["ip_b"]),
+                                   'source': flow["ip_a"],
+                                   'target': flow["ip_b"],
+                                   'weight': flow["packets_ab"] + flow["packets_ba"],
+                                   'bytes': flow["bytes_ab"] + flow["bytes_ba"]},
+                          'classes': "bidirectional" if flow["packets_ab"] > 0 and flow["packets_ba"] > 0 else None})
+            rows.append({"history_ip_a": flow["ip_a"],
+                         "history_ip_b": flow["ip_b"],
+                         "history_packets_ab": flow["packets_ab"],
+                         "history_packets_ba": flow["packets_ba"],
+                         "history_bytes": bytes2human(flow["bytes_ab"] + flow["bytes_ba"]),
+                         "history_first_seen": datetime.fromtimestamp(flow["first_seen"]).strftime("%Y-%m-%d %H:%M"),
+                         "history_last_seen": datetime.fromtimestamp(flow["last_seen"]).strftime("%Y-%m-%d %H:%M")})
+
+        return list(nodes.values()) + edges, rows
+
+
 class VitalsGrid():
     """Create a grid with some stats about the system"""
     data = None
@@ -705,11 +1545,17 @@ layouts = {}
 current_layout = "dashboard"
 network_chart = NetworkChart()
 map_chart = MapChart()
+lan_list = LanTable()
+top_talker_list = TopTable("top_talkers", "Endpoint")
+top_conversation_list = TopTable("top_conversations", "Conversation")
+cardinality_list = CardinalityTable()
 capture_list = CaptureTable()
 log_list = LogTable()
 log_file_list = LogFileTable()
 interface_list = InterfaceTable()
 vitals_grid = VitalsGrid()
+counter_list = CounterTable()
+history_view = HistoryView(network_chart.layout)
 
 ##########################################################################
 #                            L  A  Y  O  U  T                            #
@@ -796,6 +1642,15 @@ sidebar = Nav([
                     Span([],
                          id="captures_badge",
                          className="badge")]),
+                NavItem([
+                    NavLink([Img(src='/assets/img/history.svg',
+                                 className="feather"), " History"],
+                            id="navlink_history",
+                            href="/history",
+                            className=""),
+                    Span([],
+                         id="history_badge",
+                         className="badge")]),
                 NavItem([
                     NavLink([Img(src='/assets/img/logs.svg',
                                  className="feather"), " Logs"],
@@ -848,15 +1703,90 @@ badge_update_clock = Interval(
     id='badge_update_clock',
     interval=interval)
 
+# Only the endpoints and conversations active during the last minutes are displayed, 0: all of them
+window = config.get_int("default_dashboard_window", 0)
+
+dashboard_window = Dropdown(
+    id='dashboard_window',
+    options=[{"label": "All the session", "value": 0}] + [
+        {"label": f"Last {label}", "value": minutes} for (label, minutes) in [
+            ("minute", 1), ("5 minutes", 5), ("15 minutes", 15), ("hour", 60), ("day", 1440)]],
+    value=window,
+    clearable=False,
+    searchable=False,
+    style={"width": "200px", "color": "#181a1b"})
+
+# Beyond the element budget the endpoints are shown by subnet, AS or country
+grouping = config.get("default_network_grouping") or "subnet"
+
+network_grouping = Dropdown(
+    id='network_grouping',
+    options=[{"label": label, "value": value} for (label, value) in [
+        ("Group by subnet", "subnet"), ("Group by AS", "as"), ("Group by country", "country")]],
+    value=grouping,
+    clearable=False,
+    searchable=False,
+    style={"width": "200px", "color": "#181a1b"})
+
 layouts["dashboard"] = [
     dashboard_update_clock,
-    Div(H2("Network"),
+    # Changes of the network graph applied by the browser, and version of the graph it displays
+    Store(id="network_delta"),
+    Store(id="network_state"),
+    # Groups whose endpoints are displayed
+    Store(id="network_expanded", data=[]),
+    # Key of the pins displayed by the map
+    Store(id="map_state"),
+    Div([H2("Network"), Div([network_grouping, dashboard_window], className="d-flex")],
         className="d-flex justify-content-between flex-wrap flex-md-nowrap align-items-center pt-3 pb-2 mb-3 border-bottom"),
     network_chart.layout,
     Div(H2("Map"),
         id="geo",
         className="d-flex justify-content-between flex-wrap flex-md-nowrap align-items-center pt-3 pb-2 mb-3 border-bottom"),
-    map_chart.layout
+    map_chart.layout,
+    Div(H2("Top talkers"),
+        className="d-flex justify-content-between flex-wrap flex-md-nowrap align-items-center pt-3 pb-2 mb-3 border-bottom"),
+    # Since the start of the capture, whatever the time window
+    Div([Div(top_talker_list.layout, className="col-md-6"),
+         Div(top_conversation_list.layout, className="col-md-6")],
+        className="row"),
+    Div(H2("Distinct external endpoints"),
+        className="d-flex justify-content-between flex-wrap flex-md-nowrap align-items-center pt-3 pb-2 mb-3 border-bottom"),
+    cardinality_list.layout,
+    Div(H2("Local network"),
+        className="d-flex justify-content-between flex-wrap flex-md-nowrap align-items-center pt-3 pb-2 mb-3 border-bottom"),
+    lan_list.layout
+]
+
+######################### H  I  S  T  O  R  Y #########################
+
+# Local time
+history_format = "%Y-%m-%d %H:%M"
+
+layouts["history"] = [
+    Div(H2("History"),
+        className="d-flex justify-content-between flex-wrap flex-md-nowrap align-items-center pt-3 pb-2 mb-3 border-bottom"),
+    Div([
+        TextInput(id="history_start",
+                  type="text",
+                  placeholder="From (YYYY-MM-DD HH:MM), an hour before the end if empty",
+                  className="form-control mr-2"),
+        TextInput(id="history_end",
+                  type="text",
+                  placeholder="To (YYYY-MM-DD HH:MM), now if empty",
+                  className="form-control mr-2"),
+        TextInput(id="history_address",
+                  type="text",
+                  placeholder="Address (all of them if empty)",
+                  className="form-control mr-2"),
+        Button("Search",
+               id="history_search",
+               className="btn btn-secondary")],
+        className="d-flex flex-nowrap mb-3"),
+    P(id="history_message"),
+    history_view.network,
+    Br(),
+    history_view.table
 ]
 
 ########################## V  I  T  A  L  S ##########################
@@ -877,7 +1807,11 @@ layouts["vitals"] = [
     vitals_update_clock,
     Div(H2("Vitals"),
         className="d-flex justify-content-between flex-wrap flex-md-nowrap align-items-center pt-3 pb-2 mb-3 border-bottom"),
-    vitals_grid.layout
+    vitals_grid.layout,
+    Br(),
+    Div(H2("Counters"),
+        className="d-flex justify-content-between flex-wrap flex-md-nowrap align-items-center pt-3 pb-2 mb-3 border-bottom"),
+    counter_list.layout
 ]
 
 ######################## C  A  P  T  U  R  E  S ########################
@@ -1001,6 +1935,7 @@ mydash.layout = layout
                  Output('navlink_dashboard', 'className'),
                  Output('navlink_vitals', 'className'),
                  Output('navlink_captures', 'className'),
+                 Output('navlink_history', 'className'),
                  Output('navlink_logs', 'className'),
                  Input('url', 'pathname'))
 def display_page(pathname):
@@ -1017,6 +1952,7 @@ def display_page(pathname):
     output.append(("active" if current == "dashboard" else ""))
     output.append(("active" if current == "vitals" else ""))
     output.append(("active" if current == "captures" else ""))
+    output.append(("active" if current == "history" else ""))
     output.append(("active" if current == "logs" else ""))
 
     return output
@@ -1074,11 +2010,21 @@ def update_badges(ignore, pathname, logs_badge):
     return vitals_badge, logs_badge
 
 
-@mydash.callback(Output('network', 'elements'),
-                 Output('geolocation', 'data'),
-                 Input('dashboard_update_clock', 'n_intervals'))
-def dashboard_update(n_intervals):
-    """Refresh the charts"""
+@mydash.callback(Output('network_delta', 'data'),
+                 Output('network_state', 'data'),
+                 Output('lan_table', 'data'),
+                 Output('top_talkers', 'data'),
+                 Output('top_conversations', 'data'),
+                 Output('cardinality_table', 'data'),
+                 Input('dashboard_update_clock', 'n_intervals'),
+                 Input('dashboard_window', 'value'),
+                 Input('network_grouping', 'value'),
+                 Input('network_expanded', 'data'),
+                 State('network_state', 'data'))
+def dashboard_update(n_intervals, window, grouping, expanded, network_state):
+    """Refresh the charts, only the changes of the network graph are sent"""
+    # A new time window, grouping or group expanded is applied at once
+    settings_changed = callback_context.triggered and not callback_context.triggered[0]["prop_id"].startswith("dashboard_update_clock")
 
     if network_chart.last_update is not None:
 
@@ -1086,12 +2032,70 @@ def dashboard_update(n_intervals):
             (datetime.now().timestamp() - network_chart.last_update))
         interval = int(config.get("default_dashboard_update_interval"))
 
-        if last_update >= (interval / 1000):
-            return network_chart.get_data(), map_chart.get_data()
+        if last_update >= (interval / 1000) or settings_changed:
+            (delta, network_state) = network_chart.get_delta(network_state, window, grouping, expanded or [])
+            # Without change the browser has nothing to apply
+            network = (no_update if delta is None else delta, network_state)
+            tables = (top_talker_list.get_data(), top_conversation_list.get_data(), cardinality_list.get_data())
+
+            if not window:
+                return network + (lan_list.get_data(),) + tables
+
+            ips = network_chart.get_node_ids(window)
+            return network + (lan_list.get_data(ips),) + tables
 
     raise PreventUpdate
 
 
+@mydash.callback(Output('geolocation', 'data'),
+                 Output('map_state', 'data'),
+                 Input('dashboard_update_clock', 'n_intervals'),
+                 Input('dashboard_window', 'value'),
+                 Input('map', 'zoom'),
+                 Input('map', 'bounds'),
+                 State('map_state', 'data'))
+def map_update(n_intervals, window, zoom, bounds, map_state):
+    """Refresh the pins and clusters in view, only if they changed since the ones displayed"""
+    if window:
+        # The nodes in the window change only with the version of the graph, read before them: a newer set of nodes
+        # under an older version is only computed again
+        filter_key = (network_chart.session, network_chart.version, window)
+        (data, key) = map_chart.get_data(network_chart.get_node_ids(window), filter_key, zoom, bounds)
+    else:
+        (data, key) = map_chart.get_data(None, None, zoom, bounds)
+
+    if key == map_state:
+        raise PreventUpdate
+
+    return data, key
+
+
+@mydash.callback(Output('network_expanded', 'data'),
+                 Input('network', 'tapNodeData'),
+                 Input('network_grouping', 'value'),
+                 State('network_expanded', 'data'),
+                 prevent_initial_call=True)
+def expand_group(node, grouping, expanded):
+    """Show or hide the endpoints of a tapped group, hide them all when the grouping changes"""
+    if not callback_context.triggered[0]["prop_id"].startswith("network."):
+        return []
+
+    if node is None or not node["id"].startswith("group:") or node["id"].endswith(":rest"):
+        raise PreventUpdate
+
+    if node["id"] in expanded:
+        return [group for group in expanded if group != node["id"]]
+
+    return expanded + [node["id"]]
+
+
+# The changes are applied to the elements displayed by the browser itself (assets/js/network.js)
+mydash.clientside_callback(ClientsideFunction(namespace="network", function_name="apply_delta"),
+                           Output('network', 'elements'),
+                           Input('network_delta', 'data'),
+                           State('network', 'elements'))
+
+
 @mydash.callback(Output('capture_list_storage', 'children'),
                  Output('interface_list_storage', 'children'),
                  Input('interface_table', 'data'),
@@ -1160,10 +2164,14 @@ def prepare_capture_list(interfaces, interfaces_sort_by, current, captures_sort_
      # Sort the captures
     if interfaces_sort_by:
         column, direction = interfaces_sort_by[0].values()
-        if column in ["interface_name", "interface_state", "interface_mac", "interface_ip"]:
+        if column in ["interface_name", "interface_state", "interface_mac", "interface_ip", "interface_capture"]:
             interfaces = sorted(interfaces,
                                 key=lambda interface: interface[column],
                                 reverse=(direction == "desc"))
+        elif column == "interface_rate":
+            interfaces = sorted(interfaces,
+                                key=lambda interface: interface[column] if interface[column] != "" else -1,
+                                reverse=(direction == "desc"))
         elif column in ["interface_speed", "interface_sent", "interface_received"]:
             interfaces = sorted(interfaces,
                                 key=lambda interface: int(interface[column]
@@ -1345,9 +2353,52 @@ def vitals_update(n_intervals, pathname):
 
     return data[0], data[1], data[2], data[3]
 
+
+@mydash.callback(Output('counter_table', 'data'),
+                 Input('vitals_update_clock', 'n_intervals'))
+def counters_update(n_intervals):
+    """Refresh the counters of the modules"""
+    return counter_list.get_counters()
+
 ##############################################################################
 
 
+@mydash.callback(Output('history_network', 'elements'),
+                 Output('history_table', 'data'),
+                 Output('history_message', 'children'),
+                 Input('history_search', 'n_clicks'),
+                 State('history_start', 'value'),
+                 State('history_end', 'value'),
+                 State('history_address', 'value'),
+                 prevent_initial_call=True)
+def history_search(n_clicks, start, end, address):
+    """Display the conversations of a past time window"""
+    try:
+        end = datetime.strptime(end.strip(), history_format).timestamp() if end else datetime.now().timestamp()
+        start = datetime.strptime(start.strip(), history_format).timestamp() if start else end - 3600
+    except ValueError:
+        return no_update, no_update, "The dates must be written as YYYY-MM-DD HH:MM."
+
+    address = (address or "").strip() or None
+
+    if address is not None:
+        try:
+            history.pack_address(address)
+        except OSError:
+            return no_update, no_update, f"{address} is not an IP address."
+
+    try:
+        elements, rows = history_view.get_data(start, end, address)
+    except OSError as e:
+        logger.log.error(f"The history cannot be read: {e}")
+        return [], [], f"The history cannot be read: {e}"
+
+    if len(rows) == history_view.limit:
+        return elements, rows, f"The {history_view.limit} conversations with the most bytes are displayed."
+
+    return elements, rows, f"{len(rows)} conversations."
+
+
 @mydash.callback(Output("map_info", "header"),
                  Output("map_info", "children"),
                  Input("geolocation", "hover_feature"))
@@ -1357,14 +2408,21 @@ def geolocation_hover(feature):
         data = feature["properties"]["data"]
         title = ""
         info = []
+        # A cluster lists its first addresses
+        if "cluster" in data.keys():
+            title = f'{data["cluster"]} adresses IP'
+            for ip in data["ip_addrs"]:
+                info += [ip, Br()]
+            if data["cluster"] > len(data["ip_addrs"]):
+                info += ["…", Br()]
         if "ip_addr" in data.keys():
-            title = f'Adresse IPv{data["network_address_version"]}: {data["ip_addr"]}'
+            title = f'Adresse IPv{data["version"]}: {data["ip_addr"]}'
 
         for name, key in [("Nom d'hôte", "hostname"),
                           ("Continent", "continent_name"),
                           ("Pays", "country_name"),
                           ("Ville", "city_name")]:
-            if key in data.keys():
+            if data.get(key) is not None:
                 info += [f'{name}: {data[key]}', Br()]
 
         info = (P(info,
@@ -1379,11 +2437,19 @@ class Application(Thread):
 
     running = None
 
-    def __init__(self, queue):
+    def __init__(self, queue, sniffer=None, counters=None):
         """Generate a ready to run WEB server hosting a custom web site"""
         Thread.__init__(self, daemon=True)
         self.queue = queue
         self.running = False
+
+        # Display the state of the capture sources in the interface table
+        if sniffer is not None:
+            interface_list.sources = sniffer.get_sources()
+
+        # Display the counters of the modules in the vitals page
+        if counters is not None:
+            counter_list.sources = counters
         logger.log.info("Application ready.")
 
     def go(self):
@@ -1406,8 +2472,13 @@ class Application(Thread):
         logger.log.info("Application running.")
 
         while self.running or not self.queue.empty():
-            data_type, data = self.queue.get()
-            self.dispatch_analysed_data(data_type, data)
+            try:
+                events = self.queue.get(timeout=1)
+            except Empty:
+                continue
+
+            for (data_type, data) in events:
+                self.dispatch_analysed_data(data_type, data)
             self.queue.task_done()
         logger.log.info("Application stoped.")
 
@@ -1419,7 +2490,41 @@ class Application(Thread):
         """Send the new data to the corresponding charts"""
         if data_type == "endpoint":
             network_chart.add_node(data)
+
+            # Local and special endpoints are listed apart from the world map
+            if data.category is not None:
+                lan_list.add_endpoint(data)
+
+        # The location of an endpoint is known once the GeoIP workers are done with it
+        elif data_type == "endpoint_enriched":
             map_chart.add_point(data)
+            network_chart.locate_node(data)
 
         elif data_type == "conversation":
             network_chart.add_edge(data)
+
+        elif data_type == "flow_update":
+            network_chart.update_edges(data)
+
+        elif data_type == "conversations_expired":
+            network_chart.remove_edges(data)
+
+        elif data_type == "heavy_hitters":
+            (talkers, conversations) = data
+            # The bytes of a packet count for both of its endpoints
+            top_talker_list.set_sketch(talkers, total=conversations.total)
+            top_conversation_list.set_sketch(conversations, label=lambda key: f"{key[0]} ↔ {key[1]}")
+
+        elif data_type == "cardinality":
+            cardinality_list.update(data)
+
+        elif data_type == "scan_alert":
+            # A warning is listed on the logs page and counted by its badge
+            date = datetime.fromtimestamp(data["time"]).strftime("%d/%m/%Y %H:%M:%S")
+            logger.log.warning(f"Possible scan from {data['source']}: about {data['count']} distinct {'destinations' if data['kind'] == 'destinations' else 'destination ports'} "
+                               f"contacted in {data['window']} s (until {date}).")
+
+        elif data_type == "endpoints_expired":
+            network_chart.remove_nodes(data)
+            map_chart.remove_points(data)
+            lan_list.remove_endpoints(data)
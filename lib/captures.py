@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+
+from os import rename, remove, stat, mkdir, path
+from shutil import move
+from pathlib import Path
+from datetime import datetime
+
+from . import logger
+from . import config
+
+config.load_config()
+
+
+class CaptureDirectory():
+    """Name, rotate and bound the capture files: <start>_<end>_<interface>.pcap"""
+
+    dir_ = None
+    segments_dir = None
+    file_format = None
+    segment_size = None
+    segment_duration = None
+    disk_budget = None
+    archive_dir = None
+
+    def __init__(self):
+        """Read the rotation and retention settings"""
+        self.dir_ = f'{config.get("prog_path")}/capture/'
+        # Tshark writes the current segment of each interface in this directory
+        self.segments_dir = f'{self.dir_}segments/'
+        self.file_format = "pcap"
+
+        # kB
+        self.segment_size = config.get_int("capture_file_size")
+        # Seconds
+        self.segment_duration = config.get_int("capture_file_duration")
+        # MB
+        self.disk_budget = config.get_int("capture_disk_budget")
+        self.archive_dir = config.get("capture_archive_path")
+
+        self.create_directory(self.dir_)
+        self.create_directory(self.segments_dir)
+
+        if self.archive_dir is not None:
+            self.create_directory(self.archive_dir)
+
+    def create_directory(self, dir_):
+        """Try to create a capture directory"""
+        try:
+            mkdir(dir_)
+            logger.log.info(f"The {dir_} directory is created.")
+
+        except FileExistsError:
+            pass
+
+        except Exception as e:
+            logger.log.error(e)
+
+    def rotates(self):
+        """Return True if the capture files are split in segments"""
+        return self.segment_size is not None or self.segment_duration is not None
+
+    def get_files(self):
+        """Get the list of file from the capture directory"""
+        return sorted(Path(self.dir_).glob(f'*.{self.file_format}'))
+
+    def get_segments(self, interface):
+        """Get the segments written by tshark for an interface, oldest first"""
+        # <interface>_<index>_<YYYYmmddHHMMSS>.pcap
+        segments = []
+
+        for file in Path(self.segments_dir).glob(f'*.{self.file_format}'):
+            try:
+                name, index, start = file.name[:-len(self.file_format) - 1].rsplit('_', 2)
+                start = int(datetime.strptime(start, "%Y%m%d%H%M%S").timestamp())
+            except ValueError:
+                continue
+
+            if interface is None or name == interface:
+                segments.append((int(index), start, name, file))
+
+        return sorted(segments)
+
+    def get_file_path(self, start, end, interface):
+        """Return the path of a capture file, the end is empty while the capture is in progress"""
+        return f'{self.dir_}{start}_{"" if end is None else end}_{interface}.{self.file_format}'
+
+    def get_tshark_options(self, interface):
+        """Return the tshark options writing the capture of an interface"""
+        if not self.rotates():
+            return ["-w", self.get_file_path(int(datetime.now().timestamp()), None, interface)]
+
+        options = ["-w", f'{self.segments_dir}{interface}.{self.file_format}']
+
+        if self.segment_size is not None:
+            options += ["-b", f"filesize:{self.segment_size}"]
+
+        if self.segment_duration is not None:
+            options += ["-b", f"duration:{self.segment_duration}"]
+
+        return options
+
+    def collect(self, interface, closing=False):
+        """Move the finished segments of an interface to the capture directory"""
+        segments = self.get_segments(interface)
+        # The last segment is still written by tshark
+        finished = segments if closing else segments[:-1]
+
+        for (position, (index, start, name, file)) in enumerate(finished):
+            # A segment ends when the next one starts
+            if position + 1 < len(segments):
+                end = segments[position + 1][1]
+            else:
+                end = int(datetime.now().timestamp())
+
+            try:
+                rename(file, self.get_file_path(start, end, name))
+
+            except Exception as e:
+                logger.log.error(f"The capture segment {file} cannot be moved to the capture directory: {e}")
+
+        if len(finished) > 0:
+            self.enforce_budget()
+
+    def close(self, file_path):
+        """Add the end timestamp to the name of a capture file"""
+        now = int(datetime.now().timestamp())
+        new_name = file_path.replace("__", f'_{now}_')
+
+        try:
+            rename(file_path, new_name)
+
+        except:
+            logger.log.error(f"Capture file {file_path} is already open in another process and therefor cannot be rename to include the capture end time. The file will be corrected the next time the program is run.")
+
+        self.enforce_budget()
+
+    def fix_files(self):
+        """Rename the corrupt file"""
+        files = self.get_files()
+
+        for file in files:
+            if "__" not in file.name:
+                continue
+
+            last_modified_date = int(stat(file).st_mtime)
+            new_file_name = file.name.replace("__", f"_{last_modified_date}_")
+
+            try:
+                rename(file, f"{self.dir_}{new_file_name}")
+
+            except Exception as e:
+                logger.log.error(e)
+
+            else:
+                logger.log.warning(
+                    f'Capture file "{file.name}" not have an end time. This could mean that the last execution of the program stopped after a critical error and therefore the file was not closed properly. The file is renamed "{new_file_name}" according to its last modification date')
+
+        # Segments left by a previous execution
+        for (index, start, name, file) in self.get_segments(None):
+            end = int(stat(file).st_mtime)
+
+            try:
+                rename(file, self.get_file_path(start, end, name))
+
+            except Exception as e:
+                logger.log.error(e)
+
+            else:
+                logger.log.warning(f'Capture segment "{file.name}" was not closed properly by the last execution of the program. It is moved to the capture directory according to its last modification date.')
+
+        self.enforce_budget()
+
+    def enforce_budget(self):
+        """Delete or archive the oldest capture files until the directory fits in the disk budget"""
+        if self.disk_budget is None:
+            return
+
+        # Captures in progress are never removed
+        files = sorted((file.name.split('_')[0], file, file.stat().st_size) for file in self.get_files() if "__" not in file.name)
+        total = sum(size for (start, file, size) in files)
+        budget = self.disk_budget * 1024 * 1024
+
+        for (start, file, size) in files:
+            if total <= budget:
+                break
+
+            try:
+                if self.archive_dir is None:
+                    remove(file)
+                    logger.log.info(f"Capture file {file.name} deleted to respect the disk budget of the capture directory.")
+                else:
+                    move(str(file), path.join(self.archive_dir, file.name))
+                    logger.log.info(f"Capture file {file.name} archived to respect the disk budget of the capture directory.")
+
+            except Exception as e:
+                logger.log.error(f"Capture file {file.name} cannot be removed from the capture directory: {e}")
+
+            else:
+                total -= size
+
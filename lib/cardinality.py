@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+from . import config
+from . import sketches
+
+config.load_config()
+
+
+# Seconds of each granularity of the counts
+GRANULARITIES = {"minute": 60, "hour": 3600}
+
+
+class EndpointCardinality():
+    """Distinct external endpoints per minute and per hour: in total, per interface, per country and per AS"""
+
+    precision = None
+    retention = None
+    sketches = None
+    updated = None
+    sealed = None
+    counted = None
+    counted_minute = None
+
+    def __init__(self):
+        """Read the precision of the sketches and the number of buckets kept of each granularity"""
+        # 2 ** precision registers per sketch at most
+        self.precision = config.get_int("cardinality_precision", 12)
+        # Granularity: number of buckets kept
+        self.retention = {"minute": config.get_int("cardinality_minutes", 120),
+                          "hour": config.get_int("cardinality_hours", 48)}
+        # (granularity, bucket): {(dimension, value): sketch}
+        self.sketches = {}
+        # (granularity, bucket) of the sketches changed since the last call to get_updates
+        self.updated = set()
+        # (granularity, bucket) already returned by seal
+        self.sealed = set()
+        # (address, interface) already counted during the current minute, a sketch is updated once per minute at most
+        self.counted = set()
+        self.counted_minute = 0.0
+
+    def add(self, endpoint, interface, timestamp):
+        """Count an external endpoint seen on an interface"""
+        if not self.counted_minute <= timestamp < self.counted_minute + 60:
+            self.counted = set()
+            self.counted_minute = timestamp - timestamp % 60
+
+        key = (endpoint.ip_addr, interface)
+
+        if key in self.counted:
+            return
+
+        self.counted.add(key)
+        dimensions = [("all", ""), ("interface", interface or "unknown")] + get_location_dimensions(endpoint)
+        self.add_hash(sketches.hash_item(endpoint.ip_addr), timestamp, dimensions)
+
+    def add_location(self, endpoint):
+        """Count a newly located endpoint in its country and its AS, at the time it was last seen"""
+        dimensions = get_location_dimensions(endpoint)
+
+        if len(dimensions) > 0:
+            self.add_hash(sketches.hash_item(endpoint.ip_addr), endpoint.last_seen, dimensions)
+
+    def add_hash(self, value, timestamp, dimensions):
+        """Add the hash of an endpoint to the sketches of its minute and its hour"""
+        for (granularity, seconds) in GRANULARITIES.items():
+            bucket = (granularity, timestamp - timestamp % seconds)
+            bucket_sketches = self.sketches.get(bucket)
+
+            if bucket_sketches is None:
+                bucket_sketches = self.sketches[bucket] = {}
+
+            for dimension in dimensions:
+                sketch = bucket_sketches.get(dimension)
+
+                if sketch is None:
+                    sketch = bucket_sketches[dimension] = sketches.HyperLogLog(self.precision)
+
+                sketch.add_hash(value)
+
+            self.updated.add(bucket)
+            # A late endpoint is written with the bucket again, the sketches read back are merged
+            self.sealed.discard(bucket)
+
+    def get_updates(self):
+        """Return copies of the sketches of the buckets changed since the last call: {(granularity, bucket): {(dimension, value): sketch}}"""
+        updates = {bucket: {dimension: sketch.copy() for (dimension, sketch) in self.sketches[bucket].items()}
+                   for bucket in self.updated if bucket in self.sketches}
+        self.updated = set()
+
+        return updates
+
+    def seal(self, clock, force=False):
+        """Return the buckets ended before the capture clock and not returned yet, all of them if forced, and forget the oldest ones"""
+        sealed = {}
+
+        for (granularity, start) in sorted(self.sketches):
+            bucket = (granularity, start)
+
+            if (force or start + GRANULARITIES[granularity] <= clock) and bucket not in self.sealed:
+                sealed[bucket] = self.sketches[bucket]
+                self.sealed.add(bucket)
+
+        for (granularity, seconds) in GRANULARITIES.items():
+            cutoff = clock - self.retention[granularity] * seconds
+
+            for bucket in [bucket for bucket in self.sketches if bucket[0] == granularity and bucket[1] < cutoff]:
+                del self.sketches[bucket]
+                self.sealed.discard(bucket)
+
+        return sealed
+
+
+def get_location_dimensions(endpoint):
+    """Return the (dimension, value) of the country and the AS of an endpoint, the known ones"""
+    dimensions = []
+
+    if endpoint.location is not None:
+        country = endpoint.location.country_code
+        autonomous_system = endpoint.location.autonomous_system_organization
+
+        if country is not None:
+            dimensions.append(("country", country))
+        if autonomous_system is not None:
+            dimensions.append(("as", autonomous_system))
+
+    return dimensions
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+from os import replace, remove, fsync, mkdir, path
+from pickle import dumps, loads, HIGHEST_PROTOCOL
+from time import monotonic, perf_counter
+from threading import Thread, Lock
+
+from . import logger
+from . import config
+
+config.load_config()
+
+
+class Checkpoint():
+    """Snapshot of a state written in the background, it replaces the previous one only once complete"""
+
+    file_path = None
+    interval = None
+    last_save = None
+    writer = None
+    lock = None
+    saves = None
+    last_duration = None
+    last_size = None
+
+    def __init__(self, name):
+        """Read the interval between two snapshots, the file is <program>/checkpoint/<name>.pickle"""
+        directory = f'{config.get("prog_path")}/checkpoint/'
+        self.file_path = f'{directory}{name}.pickle'
+        # Seconds, None: no snapshot
+        self.interval = config.get_int("checkpoint_interval")
+        self.last_save = monotonic()
+        self.lock = Lock()
+        self.saves = 0
+        self.last_duration = 0.0
+        self.last_size = 0
+
+        if self.interval is not None and not path.isdir(directory):
+            mkdir(directory)
+
+    def is_enabled(self):
+        """Return True if the snapshots are enabled"""
+        return self.interval is not None
+
+    def is_due(self):
+        """Return True if the last snapshot is older than the interval and none is being written"""
+        return self.interval is not None and monotonic() - self.last_save >= self.interval and \
+            (self.writer is None or not self.writer.is_alive())
+
+    def save(self, state, wait=False):
+        """Write a state in a background thread, wait for it to be written if asked"""
+        self.last_save = monotonic()
+
+        # A snapshot is never written by two threads at once
+        if self.writer is not None:
+            self.writer.join()
+
+        self.writer = Thread(target=self.write, args=(state,), name="Checkpoint", daemon=True)
+        self.writer.start()
+
+        if wait:
+            self.writer.join()
+
+    def write(self, state):
+        """Serialize a state to a temporary file, then rename it over the previous snapshot"""
+        start = perf_counter()
+        temporary_path = f"{self.file_path}.tmp"
+
+        try:
+            data = dumps(state, protocol=HIGHEST_PROTOCOL)
+
+            with open(temporary_path, "wb") as file:
+                file.write(data)
+                file.flush()
+                fsync(file.fileno())
+
+            # Atomic: a crash leaves either the previous snapshot or the new one
+            replace(temporary_path, self.file_path)
+        except Exception as e:
+            logger.log.error(f"The checkpoint {self.file_path} cannot be written: {e}")
+            if path.isfile(temporary_path):
+                remove(temporary_path)
+            return
+
+        with self.lock:
+            self.saves += 1
+            self.last_duration = perf_counter() - start
+            self.last_size = len(data)
+
+    def load(self):
+        """Return the state of the last snapshot, None if there is none"""
+        if self.interval is None or not path.isfile(self.file_path):
+            return None
+
+        start = perf_counter()
+
+        try:
+            with open(self.file_path, "rb") as file:
+                state = loads(file.read())
+        except Exception as e:
+            logger.log.error(f"The checkpoint {self.file_path} cannot be read, starting without it: {e}")
+            return None
+
+        logger.log.info(f"Checkpoint {self.file_path} loaded in {perf_counter() - start:.3f} s.")
+
+        return state
+
+    def get_counters(self):
+        """Return the counters of the snapshots as (name, value) pairs"""
+        with self.lock:
+            return [("Checkpoints written", self.saves),
+                    ("Last checkpoint duration (ms)", round(self.last_duration * 1000)),
+                    ("Last checkpoint size (kB)", self.last_size // 1000)]
@@ -20,7 +20,7 @@ def load_config():
             elif line[0] == "#":
                 continue
             else:
-                key, value = line.split('=')
+                key, value = line.split('=', 1)
                 key = key.strip()
 
                 if ',' in value:
@@ -43,5 +43,18 @@ def get(key):
     if key in CONFIG.keys():
         return CONFIG[key]
     else:
-        logger.log.error(f"The key {key} does not exist in the configuration file, or it is not set properly. Please, check the configuration file ({CONFIG_PATH}) and make sure that there is the following line: '{key} = ...'.")
+        logger.log.error(f"The key {key} does not exist in the configuration file, or it is not set properly. Please, check the configuration file ({CONFIG['prog_path']}/config/config.txt) and make sure that there is the following line: '{key} = ...'.")
         return None
+
+
+def exists(key):
+    """Return True if the key is set in the configuration file"""
+    return key in CONFIG.keys() and CONFIG[key] is not None
+
+
+def get_int(key, default=None):
+    """Return the value corresponding to the given key as an integer, or the default value if it is not set"""
+    try:
+        return int(get(key))
+    except (TypeError, ValueError):
+        return default
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+from array import array
+from zlib import crc32
+
+
+class FlowTable():
+    """Counters of the conversations between two addresses, both directions share the same entry"""
+
+    indexes = None
+    keys = None
+    packets_ab = None
+    packets_ba = None
+    bytes_ab = None
+    bytes_ba = None
+    first_seen = None
+    last_seen = None
+    updated = None
+
+    def __init__(self):
+        """Initialize an empty table, the counters of flow i are at position i of each column"""
+        # (a, b) with a < b: index
+        self.indexes = {}
+        self.keys = []
+        # Packets and bytes sent from a to b, and from b to a
+        self.packets_ab = array("Q")
+        self.packets_ba = array("Q")
+        self.bytes_ab = array("Q")
+        self.bytes_ba = array("Q")
+        # Epoch timestamps
+        self.first_seen = array("d")
+        self.last_seen = array("d")
+        # Flows updated since the last call to get_updates
+        self.updated = set()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, src, dst, length, timestamp, weight=1):
+        """Count a packet from src to dst, return the index of its flow and True if the flow is new"""
+        if src < dst:
+            key = (src, dst)
+            forward = True
+        else:
+            key = (dst, src)
+            forward = False
+
+        index = self.indexes.get(key)
+        new = index is None
+
+        if new:
+            index = len(self.keys)
+            self.indexes[key] = index
+            self.keys.append(key)
+            self.packets_ab.append(0)
+            self.packets_ba.append(0)
+            self.bytes_ab.append(0)
+            self.bytes_ba.append(0)
+            self.first_seen.append(timestamp)
+            self.last_seen.append(timestamp)
+
+        if forward:
+            self.packets_ab[index] += weight
+            self.bytes_ab[index] += length * weight
+        else:
+            self.packets_ba[index] += weight
+            self.bytes_ba[index] += length * weight
+
+        if timestamp > self.last_seen[index]:
+            self.last_seen[index] = timestamp
+
+        self.updated.add(index)
+
+        return (index, new)
+
+    def expire(self, cutoff):
+        """Remove the flows without packets since the cutoff timestamp, return their keys"""
+        if len(self.keys) == 0 or min(self.last_seen) >= cutoff:
+            return []
+
+        kept = [index for index in range(len(self.keys)) if self.last_seen[index] >= cutoff]
+        expired = [key for (key, last_seen) in zip(self.keys, self.last_seen) if last_seen < cutoff]
+        # Old index: new index of the flows kept
+        positions = {index: position for (position, index) in enumerate(kept)}
+
+        self.keys = [self.keys[index] for index in kept]
+        self.indexes = {key: position for (position, key) in enumerate(self.keys)}
+        for column in ["packets_ab", "packets_ba", "bytes_ab", "bytes_ba", "first_seen", "last_seen"]:
+            values = getattr(self, column)
+            setattr(self, column, array(values.typecode, (values[index] for index in kept)))
+        self.updated = {positions[index] for index in self.updated if index in positions}
+
+        return expired
+
+    def get_state(self):
+        """Return a copy of the table, the snapshot of a checkpoint"""
+        state = {"keys": list(self.keys)}
+
+        for column in ["packets_ab", "packets_ba", "bytes_ab", "bytes_ba", "first_seen", "last_seen"]:
+            state[column] = getattr(self, column)[:]
+
+        return state
+
+    def set_state(self, state):
+        """Replace the table by a snapshot, its flows are sent with the next updates"""
+        self.keys = state["keys"]
+        self.indexes = {key: index for (index, key) in enumerate(self.keys)}
+
+        for column in ["packets_ab", "packets_ba", "bytes_ab", "bytes_ba", "first_seen", "last_seen"]:
+            setattr(self, column, state[column])
+
+        self.updated = set(range(len(self.keys)))
+
+    def get_flow(self, index):
+        """Return the counters of a flow as a dict"""
+        (a, b) = self.keys[index]
+        return {"ip_a": a,
+                "ip_b": b,
+                "packets_ab": self.packets_ab[index],
+                "packets_ba": self.packets_ba[index],
+                "bytes_ab": self.bytes_ab[index],
+                "bytes_ba": self.bytes_ba[index],
+                "first_seen": self.first_seen[index],
+                "last_seen": self.last_seen[index]}
+
+    def get_updates(self):
+        """Return the flows updated since the last call"""
+        updated = self.updated
+        self.updated = set()
+
+        return [self.get_flow(index) for index in sorted(updated)]
+
+
+def get_flow_id(ip_a, ip_b):
+    """Return the identifier of the edge of a flow"""
+    return f"{ip_a}-{ip_b}"
+
+
+def get_flow_hash(packet):
+    """Hash the pair of addresses of a packet, both directions of a conversation get the same hash"""
+    layer = "ip" if "ip.src" in packet else "ipv6"
+    src = packet.get(f"{layer}.src", "")
+    dst = packet.get(f"{layer}.dst", "")
+
+    if src > dst:
+        src, dst = dst, src
+
+    return crc32(f"{src} {dst}".encode())
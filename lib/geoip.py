@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+
+from sys import intern
+from threading import Lock
+from collections import OrderedDict
+from ipaddress import ip_address
+
+from geoip2.database import Reader, MODE_MMAP
+from geoip2.errors import AddressNotFoundError
+
+from . import logger
+from . import config
+
+config.load_config()
+
+
+class GeoIPDatabase():
+    """Shared GeoIP2 reader answering the addresses of an already known network from memory"""
+
+    name = None
+    database_path = None
+    reader = None
+    cache = None
+    cache_size = None
+    prefixlens = None
+    lock = None
+    hits = None
+    misses = None
+    negative_hits = None
+    evictions = None
+
+    def __init__(self, database_path):
+        """Open the database once, it is mapped in memory and shared by all the lookups"""
+        self.name = "GeoIP"
+        self.database_path = database_path
+        # (version, network address >> host bits, prefix length): location, or False if the network is not in the database
+        self.cache = OrderedDict()
+        self.cache_size = config.get_int("geoip_cache_size", 65536)
+        # Prefix lengths of the cached networks, most specific first
+        self.prefixlens = {4: [], 6: []}
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+        self.evictions = 0
+
+        if database_path is None:
+            logger.log.warning("No GeoLite2 City database is set, the endpoints will not be located. Please edit the /config/config.txt file.")
+            return
+
+        try:
+            self.reader = Reader(database_path, mode=MODE_MMAP)
+            logger.log.info(f"GeoIP database {database_path} opened.")
+
+        except Exception as e:
+            logger.log.error(f"The GeoLite2 City database {database_path} cannot be opened, the endpoints will not be located: {e}")
+
+    def close(self):
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+
+    def lookup(self, ip):
+        """Return the location shared by the addresses of the network of an address, None if it is unknown"""
+        if self.reader is None:
+            return None
+
+        try:
+            address = ip_address(ip)
+        except ValueError:
+            return None
+
+        location = self.get_cached(address)
+
+        if location is not None:
+            return location or None
+
+        try:
+            city = self.reader.city(address)
+            network = city.traits.network
+            location = Location(city)
+
+        except AddressNotFoundError as e:
+            # The error tells the largest network without data around the address
+            network = getattr(e, "network", None)
+            location = False
+
+        except Exception as e:
+            logger.log.debug(f"GeoIP lookup of {ip} failed: {e}")
+            return None
+
+        self.add_cached(address, network, location)
+
+        return location or None
+
+    def get_cached(self, address):
+        """Return the cached location of the network of an address, False if it is not in the database, or None"""
+        value = int(address)
+        bits = address.max_prefixlen
+
+        with self.lock:
+            for prefixlen in self.prefixlens[address.version]:
+                key = (address.version, value >> (bits - prefixlen), prefixlen)
+                location = self.cache.get(key)
+
+                if location is not None:
+                    self.cache.move_to_end(key)
+                    self.hits += 1
+                    if location is False:
+                        self.negative_hits += 1
+                    return location
+
+            self.misses += 1
+
+        return None
+
+    def add_cached(self, address, network, location):
+        """Cache the location of a network, the least recently used one is evicted when the cache is full"""
+        # The address alone is cached when the database does not give its network
+        if network is None or network.version != address.version:
+            version, value, prefixlen = address.version, int(address), address.max_prefixlen
+        else:
+            version, value, prefixlen = network.version, int(network.network_address), network.prefixlen
+
+        key = (version, value >> (network_bits(version) - prefixlen), prefixlen)
+
+        with self.lock:
+            if prefixlen not in self.prefixlens[version]:
+                self.prefixlens[version] = sorted(self.prefixlens[version] + [prefixlen], reverse=True)
+
+            self.cache[key] = location
+            self.cache.move_to_end(key)
+
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+                self.evictions += 1
+
+    def get_counters(self):
+        """Return the counters of the cache as (name, value) pairs"""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return [("Cached networks", f"{len(self.cache)} / {self.cache_size}"),
+                    ("Hits", self.hits),
+                    ("Hits on networks not in the database", self.negative_hits),
+                    ("Misses", self.misses),
+                    ("Hit ratio", f"{100 * self.hits / lookups:.1f} %" if lookups > 0 else "-"),
+                    ("Evictions", self.evictions)]
+
+
+def network_bits(version):
+    """Return the number of bits of an address"""
+    return 32 if version == 4 else 128
+
+
+class Location():
+    """Facts of a GeoIP2 City record, shared by all the endpoints of its network"""
+
+    __slots__ = ("network", "city_name", "continent_code", "continent_name", "country_code", "country_name",
+                 "is_country_in_european_union", "registered_country_code", "registered_country_name",
+                 "represented_country_code", "represented_country_name", "represented_country_type",
+                 "subdivisions", "postal_code", "time_zone", "latitude", "longitude", "coordinates_accuracy_radius",
+                 "metro_code", "autonomous_system_organization", "isp", "organization", "domain",
+                 "connection_type", "user_type", "is_anonymous", "is_anonymous_proxy", "is_anonymous_vpn", "is_hosting_provider",
+                 "is_legitimate_proxy", "is_public_proxy", "is_satellite_provider", "is_tor_exit_node")
+
+    # Addresses of the network whose attributes are derived on demand: <address>_<attribute>
+    addresses = ("network_address", "broadcast_address", "hostmask", "netmask")
+
+    def __init__(self, geoip2_city):
+        """Keep the raw facts of the record, the names repeated by many networks are interned"""
+        traits = geoip2_city.traits
+        self.network = traits.network
+
+        self.city_name = name(geoip2_city.city.name)
+        self.continent_code = name(geoip2_city.continent.code)
+        self.continent_name = name(geoip2_city.continent.name)
+        self.country_code = name(geoip2_city.country.iso_code)
+        self.country_name = name(geoip2_city.country.name)
+        self.is_country_in_european_union = geoip2_city.country.is_in_european_union
+        self.registered_country_code = name(geoip2_city.registered_country.iso_code)
+        self.registered_country_name = name(geoip2_city.registered_country.name)
+        self.represented_country_code = name(geoip2_city.represented_country.iso_code)
+        self.represented_country_name = name(geoip2_city.represented_country.name)
+        self.represented_country_type = name(geoip2_city.represented_country.type)
+        self.subdivisions = tuple((name(subdivision.iso_code), name(subdivision.name)) for subdivision in geoip2_city.subdivisions)
+        self.postal_code = geoip2_city.postal.code
+
+        location = geoip2_city.location
+        self.time_zone = name(location.time_zone)
+        self.latitude = location.latitude
+        self.longitude = location.longitude
+        self.coordinates_accuracy_radius = location.accuracy_radius
+        self.metro_code = location.metro_code
+
+        self.autonomous_system_organization = name(traits.autonomous_system_organization)
+        self.isp = name(traits.isp)
+        self.organization = name(traits.organization)
+        self.domain = name(traits.domain)
+        self.connection_type = name(traits.connection_type)
+        self.user_type = name(traits.user_type)
+        self.is_anonymous = traits.is_anonymous
+        self.is_anonymous_proxy = traits.is_anonymous_proxy
+        self.is_anonymous_vpn = traits.is_anonymous_vpn
+        self.is_hosting_provider = traits.is_hosting_provider
+        self.is_legitimate_proxy = traits.is_legitimate_proxy
+        self.is_public_proxy = traits.is_public_proxy
+        self.is_satellite_provider = traits.is_satellite_provider
+        self.is_tor_exit_node = traits.is_tor_exit_node
+
+    def get(self, key, default=None):
+        """Return a fact of the record or an attribute derived from its network (with_prefixlen, netmask_exploded...)"""
+        if key == "as":
+            key = "autonomous_system_organization"
+
+        if key in self.__slots__:
+            return getattr(self, key)
+
+        for address in self.addresses:
+            if key.startswith(f"{address}_"):
+                return getattr(getattr(self.network, address), key[len(address) + 1:], default)
+
+        return getattr(self.network, key, default)
+
+    def to_dict(self):
+        """Return every fact and derived attribute as the flat record of the previous versions"""
+    # Example : {'city_confidence': None, 'city_name': 'Dublin', 'continent_code': 'EU', 'continent_name': 'Europe', 'country_confidence': None, 'is_country_in_european_union': True, 'country_code': 'IE', 'country_name': 'Ireland', 'local_average_income': None, 'coordinates_accuracy_radius': 1000, 'latitude': 53.3331, 'longitude': -6.2489, 'metro_code': None, 'population_density': None, 'time_zone': 'Europe/Dublin', 'postal_code': 'D02', 'registered_country_confidence': None, 'is_registered_country_in_european_union': False, 'registered_country_code': 'US', 'registered_country_name': 'United States', 'represented_country_confidence': None, 'is_represented_country_in_european_union': False, 'represented_country_code': None, 'represented_country_name': None, 'represented_country_type': None, 'subdivisions': [{'subdivision_confidence': None, 'subdivision_code': 'L', 'subdivision_name': 'Leinster'}], 'as': None, 'connection_type': None, 'domain': None, 'is_anonymous': False, 'is_anonymous_proxy': False, 'is_anonymous_vpn': False, 'is_hosting_provider': False, 'is_legitimate_proxy': False, 'is_public_proxy': False, 'is_satellite_provider': False, 'is_tor_exit_node': False, 'isp': None, 'organization': None, 'static_ip_score': None, 'user_count': None, 'user_type': None, 'is_multicast': False, 'is_private': False, 'is_unspecified': False, 'is_reserved': False, 'is_loopback': False, 'is_link_local': False, 'with_prefixlen': IPv4Network('52.48.0.0/14'), 'compressed': '52.48.0.0/14', 'exploded': '52.48.0.0/14', 'with_netmask': '52.48.0.0/255.252.0.0', 'with_hostmask': '52.48.0.0/0.3.255.255', 'num_addresses': 262144, 'prefixlen': 14, 'network_address_version': 4, 'network_address_max_prefixlen': 32, 'network_address_compressed': '52.48.0.0', 'network_address_exploded': '52.48.0.0', 'network_address_reverse_pointer': '0.0.48.52.in-addr.arpa', 'network_address_is_multicast': False, 'network_address_is_private': False, 'network_address_is_global': True, 'network_address_is_unspecified': False, 'network_address_is_reserved': False, 'network_address_is_loopback': False, 'network_address_is_link_local': False, 'broadcast_address_version': 4, 'broadcast_address_max_prefixlen': 32, 'broadcast_address_compressed': '52.51.255.255', 'broadcast_address_exploded': '52.51.255.255', 'broadcast_address_reverse_pointer': '255.255.51.52.in-addr.arpa', 'broadcast_address_is_multicast': False, 'broadcast_address_is_private': False, 'broadcast_address_is_global': True, 'broadcast_address_is_unspecified': False, 'broadcast_address_is_reserved': False, 'broadcast_address_is_loopback': False, 'broadcast_address_is_link_local': False, 'hostmask_version': 4, 'hostmask_max_prefixlen': 32, 'hostmask_compressed': '0.3.255.255', 'hostmask_exploded': '0.3.255.255', 'hostmask_reverse_pointer': '255.255.3.0.in-addr.arpa', 'hostmask_is_multicast': False, 'hostmask_is_private': True, 'hostmask_is_global': False, 'hostmask_is_unspecified': False, 'hostmask_is_reserved': False, 'hostmask_is_loopback': False, 'hostmask_is_link_local': False, 'netmask_version': 4, 'netmask_max_prefixlen': 32, 'netmask_compressed': '255.252.0.0', 'netmask_exploded': '255.252.0.0', 'netmask_reverse_pointer': '0.0.252.255.in-addr.arpa', 'netmask_is_multicast': False, 'netmask_is_private': True, 'netmask_is_global': False, 'netmask_is_unspecified': False, 'netmask_is_reserved': True, 'netmask_is_loopback': False, 'netmask_is_link_local': False}
+        data = {key: getattr(self, key) for key in self.__slots__ if key not in ["network", "autonomous_system_organization"]}
+        data["as"] = self.autonomous_system_organization
+        data["subdivisions"] = [{"subdivision_code": code, "subdivision_name": name} for (code, name) in self.subdivisions]
+
+        for key in ["is_multicast", "is_private", "is_unspecified", "is_reserved", "is_loopback", "is_link_local",
+                    "with_prefixlen", "compressed", "exploded", "with_netmask", "with_hostmask", "num_addresses", "prefixlen"]:
+            data[key] = self.get(key)
+
+        for address in self.addresses:
+            for key in ["version", "max_prefixlen", "compressed", "exploded", "reverse_pointer", "is_multicast",
+                        "is_private", "is_global", "is_unspecified", "is_reserved", "is_loopback", "is_link_local"]:
+                data[f"{address}_{key}"] = self.get(f"{address}_{key}")
+
+        return data
+
+
+def name(value):
+    """Intern a name of the database, None is kept as is"""
+    return intern(value) if isinstance(value, str) else value
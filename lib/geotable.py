@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+
+from os import mkdir, path
+from json import dumps, loads
+from socket import inet_pton, AF_INET, AF_INET6
+from random import randrange
+from time import perf_counter
+from ipaddress import ip_address, IPv4Network, IPv6Network
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from maxminddb import open_database
+from geoip2.models import City
+
+from . import logger
+from . import config
+from . import geoip
+
+config.load_config()
+
+
+class GeoTable():
+    """GeoLite2 City database exported to sorted interval arrays, looked up in bulk with searchsorted"""
+
+    directory = None
+    intervals = None
+    records = None
+    locations = None
+
+    def __init__(self, directory):
+        """Map the interval arrays of an exported database, read its location records"""
+        self.directory = directory
+        # Version: (starts, ends, record ids, prefix lengths)
+        self.intervals = {}
+        # Version, interval: location shared by the endpoints of the network
+        self.locations = {}
+
+        for version in [4, 6]:
+            self.intervals[version] = tuple(numpy.load(path.join(directory, f"ipv{version}_{name}.npy"), mmap_mode="r")
+                                            for name in ["starts", "ends", "records", "prefixlens"])
+
+        with open(path.join(directory, "records.json"), "r") as file:
+            self.records = loads(file.read())
+
+        logger.log.info(f"GeoIP interval table {directory} loaded: {len(self.intervals[4][0])} IPv4 and {len(self.intervals[6][0])} IPv6 networks.")
+
+    def lookup_many(self, ips):
+        """Return the location of each address of a list, None for the unknown ones"""
+        results = [None] * len(ips)
+
+        for (version, positions, values) in split_addresses(ips):
+            if len(values) == 0:
+                continue
+
+            starts, ends, records, prefixlens = self.intervals[version]
+            values = numpy.array(values, dtype=starts.dtype)
+            # Last network starting at or before each address
+            intervals = numpy.searchsorted(starts, values, side="right") - 1
+            found = (intervals >= 0) & (values <= ends[numpy.maximum(intervals, 0)])
+
+            for (position, interval) in zip(numpy.array(positions)[found], intervals[found]):
+                results[position] = self.get_location(version, int(interval))
+
+        return results
+
+    def get_location(self, version, interval):
+        """Return the location of an interval, created once and shared"""
+        location = self.locations.get((version, interval))
+
+        if location is None:
+            starts, ends, records, prefixlens = self.intervals[version]
+            start = int(starts[interval])
+            network = IPv4Network((start, int(prefixlens[interval]))) if version == 4 else \
+                IPv6Network((start << 64, int(prefixlens[interval])))
+            location = geoip.Location(get_city(self.records[int(records[interval])], network))
+            self.locations[(version, interval)] = location
+
+        return location
+
+
+def split_addresses(ips):
+    """Return (version, positions, integer values) of the addresses of a list, IPv6 addresses by their upper 64 bits"""
+    ipv4 = ([], [])
+    ipv6 = ([], [])
+
+    for (position, ip) in enumerate(ips):
+        try:
+            if ":" in ip:
+                (addresses, value) = (ipv6, int.from_bytes(inet_pton(AF_INET6, ip.split('%')[0])[:8], "big"))
+            else:
+                (addresses, value) = (ipv4, int.from_bytes(inet_pton(AF_INET, ip), "big"))
+        except OSError:
+            continue
+
+        addresses[0].append(position)
+        addresses[1].append(value)
+
+    return [(4, ipv4[0], ipv4[1]), (6, ipv6[0], ipv6[1])]
+
+
+def get_city(record, network):
+    """Build the GeoIP2 City model of a raw database record"""
+    try:
+        return City(["en"], **record, ip_address=network.network_address, prefix_len=network.prefixlen)
+
+    # geoip2 < 5
+    except TypeError:
+        traits = dict(record.get("traits", {}), ip_address=str(network.network_address), prefix_len=network.prefixlen)
+        return City(dict(record, traits=traits), ["en"])
+
+
+def export(database_path, directory):
+    """Write the networks of a GeoLite2 City database as sorted interval arrays and a table of distinct records
+
+    The IPv6 intervals hold the upper 64 bits of the addresses: a network longer than /64 stands for its whole /64,
+    and a single one of the networks sharing a /64 is kept. The addresses of the other ones get its location."""
+    intervals = {4: [], 6: []}
+    records = []
+    record_ids = {}
+
+    with open_database(database_path) as database:
+        for (network, record) in database:
+            key = dumps(record, sort_keys=True)
+            record_id = record_ids.get(key)
+
+            if record_id is None:
+                record_id = record_ids[key] = len(records)
+                records.append(record)
+
+            start = int(network.network_address)
+
+            if network.version == 4:
+                intervals[4].append((start, start + network.num_addresses - 1, record_id, network.prefixlen))
+
+            # Only the upper 64 bits of the IPv6 addresses are kept, the networks are seldom more specific
+            elif network.prefixlen <= 64:
+                start >>= 64
+                intervals[6].append((start, start + (1 << (64 - network.prefixlen)) - 1, record_id, network.prefixlen))
+
+            else:
+                intervals[6].append((start >> 64, start >> 64, record_id, 64))
+
+    if not path.isdir(directory):
+        mkdir(directory)
+
+    for (version, dtype) in [(4, numpy.uint32), (6, numpy.uint64)]:
+        rows = sorted(intervals[version])
+        # Keep a single network for each start, the most specific IPv6 networks share their upper 64 bits
+        rows = [row for (index, row) in enumerate(rows) if index == 0 or row[0] != rows[index - 1][0]]
+
+        for (column, name, column_dtype) in [(0, "starts", dtype), (1, "ends", dtype),
+                                             (2, "records", numpy.uint32), (3, "prefixlens", numpy.uint8)]:
+            numpy.save(path.join(directory, f"ipv{version}_{name}.npy"), numpy.array([row[column] for row in rows], dtype=column_dtype))
+
+    with open(path.join(directory, "records.json"), "w") as file:
+        file.write(dumps(records))
+
+    print(f"{len(intervals[4])} IPv4 and {len(intervals[6])} IPv6 networks, {len(records)} distinct records written to {directory}")
+
+
+def get_sample(table, size):
+    """Return random addresses, half IPv4 and half IPv6 in the global unicast range, half of each inside the networks
+    of the table and half anywhere"""
+    ips = []
+
+    for (version, shift, anywhere) in [(4, 0, lambda: randrange(1 << 32)),
+                                       (6, 64, lambda: (1 << 125) + randrange(1 << 125))]:
+        starts, ends = table.intervals[version][:2]
+
+        for index in range(size // 4):
+            if len(starts) > 0:
+                interval = randrange(len(starts))
+                # The IPv6 intervals hold the upper 64 bits, the lower ones are random
+                upper = randrange(int(starts[interval]), int(ends[interval]) + 1)
+                ips.append(str(ip_address((upper << shift) + randrange(1 << shift))))
+            ips.append(str(ip_address(anywhere())))
+
+    return ips
+
+
+def verify(database_path, directory, size):
+    """Compare the bulk lookup with the lookup of the analyser on a sample of addresses"""
+    table = GeoTable(directory)
+    database = geoip.GeoIPDatabase(database_path)
+    ips = get_sample(table, size)
+    # Version: [addresses checked, differences]
+    counts = {4: [0, 0], 6: [0, 0]}
+
+    for (ip, location) in zip(ips, table.lookup_many(ips)):
+        expected = database.lookup(ip)
+        fields = ["network", "country_code", "city_name", "latitude", "longitude", "autonomous_system_organization"]
+        version_counts = counts[6 if ":" in ip else 4]
+        version_counts[0] += 1
+
+        if (expected is None) != (location is None) or \
+                (expected is not None and any(expected.get(field) != location.get(field) for field in fields)):
+            version_counts[1] += 1
+            print(f"{ip}: {expected and expected.to_dict()} != {location and location.to_dict()}")
+
+    for (version, (checked, differences)) in counts.items():
+        print(f"IPv{version}: {checked} addresses checked, {differences} differences")
+
+    return counts[4][1] == 0 and counts[6][1] == 0
+
+
+def benchmark(database_path, directory, size):
+    """Time the bulk lookup against the lookup of the analyser, each one with an empty cache"""
+    ips = get_sample(GeoTable(directory), size)
+
+    start = perf_counter()
+    GeoTable(directory).lookup_many(ips)
+    bulk = perf_counter() - start
+
+    database = geoip.GeoIPDatabase(database_path)
+    start = perf_counter()
+    for ip in ips:
+        database.lookup(ip)
+    single = perf_counter() - start
+
+    print(f"{len(ips)} addresses: {bulk:.3f} s in bulk, {single:.3f} s one by one ({single / bulk:.1f}x)")
+
+
+def main(arguments):
+    """python geotable.py export|verify|benchmark [database] [directory] [sample size]"""
+    if numpy is None:
+        print("NumPy is needed to export and read the GeoIP interval table.")
+        return 1
+
+    if len(arguments) < 1 or arguments[0] not in ["export", "verify", "benchmark"]:
+        print(main.__doc__)
+        return 1
+
+    database_path = arguments[1] if len(arguments) > 1 else config.get("geolite2_city_database")
+    directory = arguments[2] if len(arguments) > 2 else config.get("geoip_table_path")
+    size = int(arguments[3]) if len(arguments) > 3 else 100000
+
+    if directory is None:
+        directory = f"{path.splitext(database_path)[0]}_table"
+
+    if arguments[0] == "export":
+        export(database_path, directory)
+    elif arguments[0] == "verify":
+        return 0 if verify(database_path, directory, size) else 1
+    else:
+        benchmark(database_path, directory, size)
+
+    return 0
@@ -0,0 +1,534 @@
+# -*- coding: utf-8 -*-
+
+from os import listdir, makedirs, remove, replace, path
+from array import array
+from struct import Struct
+from pickle import dumps, loads, HIGHEST_PROTOCOL
+from socket import inet_pton, inet_ntop, AF_INET, AF_INET6
+from threading import Lock
+from collections import OrderedDict
+
+from . import logger
+from . import config
+from . import sketches
+from . import cardinality
+
+config.load_config()
+
+
+# Time bucket, address a, address b, packets and bytes from a to b and from b to a
+RECORD = Struct("<d16s16sQQQQ")
+# First and last time bucket, number of records of the block
+BLOCK = Struct("<ddQ")
+# Time bucket, seconds of the bucket, precision, length of the dimension and of the registers, followed by both
+SKETCH = Struct("<dIBHI")
+# IPv4 addresses are stored as IPv4-mapped IPv6 addresses
+IPV4_PREFIX = bytes(10) + b"\xff\xff"
+
+
+class FlowHistory():
+    """Append-only store of the flow counters per time bucket, in one directory of segment files per analyser
+
+    A segment <start>-<end>.flows covers a range of capture time, it is a sequence of blocks: a BLOCK header then its
+    records. Once complete, its <start>-<end>.index maps each address to the offsets of its records. The distinct
+    endpoints sketches of the time buckets of the segment are appended to <start>-<end>.hll."""
+
+    directory = None
+    bucket_size = None
+    segment_duration = None
+    retention = None
+    recorded = None
+    buckets = None
+    segment = None
+    file = None
+    addresses = None
+    lock = None
+    records_written = None
+    bytes_written = None
+
+    def __init__(self, name):
+        """Read the settings of the history, the segments are written to <program>/history/<name>/"""
+        self.directory = f'{get_directory()}{name}/'
+        # Seconds, None: no history
+        self.bucket_size = config.get_int("history_bucket")
+        self.segment_duration = config.get_int("history_segment_duration", 3600)
+        # Days, None: forever
+        self.retention = config.get_int("history_retention")
+        # Flow key: counters already written
+        self.recorded = {}
+        # (time bucket, flow key): [packets_ab, packets_ba, bytes_ab, bytes_ba] not written yet
+        self.buckets = {}
+        # (start, end) of the open segment
+        self.segment = None
+        # Packed address: offsets of its records in the open segment
+        self.addresses = {}
+        self.lock = Lock()
+        self.records_written = 0
+        self.bytes_written = 0
+
+        if self.bucket_size is not None and not path.isdir(self.directory):
+            makedirs(self.directory)
+
+    def is_enabled(self):
+        """Return True if the history is enabled"""
+        return self.bucket_size is not None
+
+    def add(self, flows_data):
+        """Add the counters of updated flows, since their last update, to the bucket of their last packet"""
+        if self.bucket_size is None:
+            return
+
+        for flow in flows_data:
+            key = (flow["ip_a"], flow["ip_b"])
+            counters = (flow["packets_ab"], flow["packets_ba"], flow["bytes_ab"], flow["bytes_ba"])
+            previous = self.recorded.get(key, (0, 0, 0, 0))
+            self.recorded[key] = counters
+
+            if counters == previous:
+                continue
+
+            bucket = flow["last_seen"] - flow["last_seen"] % self.bucket_size
+            totals = self.buckets.setdefault((bucket, key), [0, 0, 0, 0])
+
+            for index in range(4):
+                totals[index] += counters[index] - previous[index]
+
+    def get_state(self):
+        """Return the counters written of each flow and the size of the segments, the snapshot of a checkpoint"""
+        if self.bucket_size is None:
+            return None
+
+        written = dict(self.recorded)
+
+        for ((bucket, key), totals) in self.buckets.items():
+            if key in written:
+                written[key] = tuple(count - total for (count, total) in zip(written[key], totals))
+
+        return {"written": written,
+                "sizes": {path.basename(file_path): path.getsize(file_path) for (segment, file_path) in list_segments(self.directory)}}
+
+    def restore(self, state, flows_data):
+        """Write the counters of the flows of a snapshot that were not written, the ones of a restored checkpoint
+
+        The records appended to the segments after the snapshot were written before the restart, they are counted as
+        written: nothing is written twice, and what the snapshot had not written yet is not lost."""
+        if self.bucket_size is None:
+            return
+
+        written = state["written"]
+
+        for (segment, file_path) in list_segments(self.directory):
+            for (offset, record) in read_blocks(file_path, offset=state["sizes"].get(path.basename(file_path), 0)):
+                key = (unpack_address(record[1]), unpack_address(record[2]))
+                written[key] = tuple(count + total for (count, total) in zip(written.get(key, (0, 0, 0, 0)), record[3:]))
+
+        for flow in flows_data:
+            counters = (flow["packets_ab"], flow["packets_ba"], flow["bytes_ab"], flow["bytes_ba"])
+            key = (flow["ip_a"], flow["ip_b"])
+            # The records written after the snapshot may hold the packets that followed it as well
+            self.recorded[key] = tuple(map(min, written.get(key, (0, 0, 0, 0)), counters))
+
+        self.add(flows_data)
+
+    def mark_recorded(self, flows_data):
+        """Take the counters of flows as already written, the ones of a restored checkpoint"""
+        for flow in flows_data:
+            self.recorded[(flow["ip_a"], flow["ip_b"])] = (flow["packets_ab"], flow["packets_ba"], flow["bytes_ab"], flow["bytes_ba"])
+
+    def forget(self, keys):
+        """Forget expired flows, a new flow between the same addresses counts from zero"""
+        for key in keys:
+            self.recorded.pop(key, None)
+
+    def flush(self, clock, force=False):
+        """Write the buckets ended before the capture clock, all of them if forced"""
+        if self.bucket_size is None:
+            return
+
+        complete = sorted(key for key in self.buckets if force or key[0] + self.bucket_size <= clock)
+
+        if len(complete) == 0:
+            return
+
+        # One block per segment, the records of a block are sorted by time bucket
+        blocks = {}
+
+        for (bucket, flow_key) in complete:
+            start = bucket - bucket % self.segment_duration
+            blocks.setdefault((start, start + self.segment_duration), []).append((bucket, flow_key, self.buckets.pop((bucket, flow_key))))
+
+        for (segment, records) in sorted(blocks.items()):
+            try:
+                self.write_block(segment, records)
+            except (OSError, ValueError) as e:
+                logger.log.error(f"{len(records)} flow records cannot be written to the history {self.directory}: {e}")
+
+        self.expire(clock)
+
+    def write_block(self, segment, records):
+        """Append a block of records to a segment"""
+        self.open_segment(segment)
+        offset = self.file.tell()
+        data = [BLOCK.pack(records[0][0], records[-1][0], len(records))]
+
+        for (position, (bucket, (ip_a, ip_b), totals)) in enumerate(records):
+            (address_a, address_b) = (pack_address(ip_a), pack_address(ip_b))
+            data.append(RECORD.pack(bucket, address_a, address_b, *totals))
+            record_offset = offset + BLOCK.size + position * RECORD.size
+            self.addresses.setdefault(address_a, array("Q")).append(record_offset)
+            self.addresses.setdefault(address_b, array("Q")).append(record_offset)
+
+        data = b"".join(data)
+        # A block is written at once, a reader never sees a header without its records but at the end of the file
+        self.file.write(data)
+        self.file.flush()
+
+        with self.lock:
+            self.records_written += len(records)
+            self.bytes_written += len(data)
+
+    def write_sketches(self, buckets):
+        """Append the distinct endpoints sketches of time buckets: {(granularity, bucket): {(dimension, value): sketch}}"""
+        if self.bucket_size is None or len(buckets) == 0:
+            return
+
+        segments = {}
+
+        for ((granularity, bucket), bucket_sketches) in buckets.items():
+            seconds = cardinality.GRANULARITIES[granularity]
+            start = bucket - bucket % self.segment_duration
+            records = segments.setdefault((start, start + self.segment_duration), [])
+
+            for ((dimension, value), sketch) in bucket_sketches.items():
+                key = f"{dimension}\t{value}".encode()
+                registers = sketch.to_bytes()
+                records.append(SKETCH.pack(bucket, seconds, sketch.precision, len(key), len(registers)) + key + registers)
+
+        for (segment, records) in segments.items():
+            file_path = f"{get_segment_path(self.directory, segment)[:-len('.flows')]}.hll"
+
+            try:
+                with open(file_path, "ab") as file:
+                    file.write(b"".join(records))
+            except OSError as e:
+                logger.log.error(f"{len(records)} distinct endpoints sketches cannot be written to the history {file_path}: {e}")
+                continue
+
+            with self.lock:
+                self.bytes_written += sum(len(record) for record in records)
+
+    def open_segment(self, segment):
+        """Open the segment of a range of capture time, reopen it if it was sealed"""
+        if self.segment == segment:
+            return
+
+        self.seal()
+        file_path = get_segment_path(self.directory, segment)
+        index_path = get_index_path(file_path)
+
+        # The index of a reopened segment is rebuilt from its records, with the new ones
+        if path.isfile(index_path):
+            remove(index_path)
+
+        self.addresses = {}
+        end = 0
+
+        if path.isfile(file_path):
+            for (offset, record) in read_blocks(file_path):
+                self.addresses.setdefault(record[1], array("Q")).append(offset)
+                self.addresses.setdefault(record[2], array("Q")).append(offset)
+                end = offset + RECORD.size
+
+            # A block cut by a crash is dropped
+            if path.getsize(file_path) != end:
+                with open(file_path, "r+b") as file:
+                    file.truncate(end)
+
+        self.file = open(file_path, "ab")
+        self.segment = segment
+
+    def seal(self):
+        """Close the open segment and write its address index"""
+        if self.file is None:
+            return
+
+        self.file.close()
+        index_path = get_index_path(get_segment_path(self.directory, self.segment))
+
+        try:
+            with open(f"{index_path}.tmp", "wb") as file:
+                file.write(dumps(self.addresses, protocol=HIGHEST_PROTOCOL))
+            replace(f"{index_path}.tmp", index_path)
+        except OSError as e:
+            logger.log.error(f"The index of the history segment {index_path} cannot be written: {e}")
+
+        self.file = None
+        self.segment = None
+        self.addresses = {}
+
+    def expire(self, clock):
+        """Delete the segments older than the retention"""
+        if self.retention is None:
+            return
+
+        cutoff = clock - self.retention * 86400
+
+        for (segment, file_path) in list_segments(self.directory):
+            if segment[1] < cutoff and segment != self.segment:
+                for file in [file_path, get_index_path(file_path), f"{file_path[:-len('.flows')]}.hll"]:
+                    if path.isfile(file):
+                        remove(file)
+
+                with indexes_lock:
+                    indexes.pop(get_index_path(file_path), None)
+                logger.log.info(f"History segment {file_path} deleted (older than {self.retention} days).")
+
+    def close(self):
+        """Write every bucket and seal the open segment"""
+        self.flush(0, force=True)
+        self.seal()
+
+    def get_counters(self):
+        """Return the counters of the history as (name, value) pairs"""
+        with self.lock:
+            return [("History records written", self.records_written),
+                    ("History size written (kB)", self.bytes_written // 1000)]
+
+
+def get_directory():
+    """Return the directory of the history"""
+    return f'{config.get("prog_path")}/history/'
+
+
+def get_segment_path(directory, segment):
+    """Return the path of the file of a segment"""
+    return f"{directory}{int(segment[0])}-{int(segment[1])}.flows"
+
+
+def get_index_path(file_path):
+    """Return the path of the address index of a segment"""
+    return f"{file_path[:-len('.flows')]}.index"
+
+
+def list_segments(directory):
+    """Return the ((start, end), path) of the segments of a directory"""
+    segments = []
+
+    for file in listdir(directory):
+        if not file.endswith(".flows"):
+            continue
+
+        try:
+            (start, end) = (int(value) for value in file[:-len(".flows")].split("-"))
+        except ValueError:
+            continue
+
+        segments.append(((start, end), f"{directory}{file}"))
+
+    return sorted(segments)
+
+
+def pack_address(ip):
+    """Return the 16 bytes of an address"""
+    if ":" in ip:
+        return inet_pton(AF_INET6, ip.split('%')[0])
+
+    return IPV4_PREFIX + inet_pton(AF_INET, ip)
+
+
+def unpack_address(data):
+    """Return the text of the 16 bytes of an address"""
+    if data[:12] == IPV4_PREFIX:
+        return inet_ntop(AF_INET, data[12:])
+
+    return inet_ntop(AF_INET6, data)
+
+
+def read_blocks(file_path, start=None, end=None, offset=0):
+    """Yield the (offset, record) of a segment from the block at an offset, the blocks outside of [start, end) are
+    skipped without being read"""
+    with open(file_path, "rb") as file:
+        size = path.getsize(file_path)
+        file.seek(offset)
+
+        while offset + BLOCK.size <= size:
+            (first_bucket, last_bucket, count) = BLOCK.unpack(file.read(BLOCK.size))
+            offset += BLOCK.size
+
+            # The last block is being written, or was cut by a crash
+            if offset + count * RECORD.size > size:
+                break
+
+            if (start is not None and last_bucket < start) or (end is not None and first_bucket >= end):
+                offset += count * RECORD.size
+                file.seek(offset)
+                continue
+
+            data = file.read(count * RECORD.size)
+
+            for (position, record) in enumerate(RECORD.iter_unpack(data)):
+                yield (offset + position * RECORD.size, record)
+
+            offset += count * RECORD.size
+
+
+def read_records(file_path, offsets):
+    """Yield the records at the given offsets of a segment"""
+    with open(file_path, "rb") as file:
+        for offset in sorted(offsets):
+            file.seek(offset)
+            data = file.read(RECORD.size)
+
+            if len(data) == RECORD.size:
+                yield RECORD.unpack(data)
+
+
+# Index path of a sealed segment: (modification time, address index), the most recently used last
+indexes = OrderedDict()
+indexes_lock = Lock()
+# Indexes kept in memory, a day of segments of an hour
+MAX_INDEXES = 24
+
+
+def get_index(file_path):
+    """Return the address index of a sealed segment, None if it is still open"""
+    index_path = get_index_path(file_path)
+
+    try:
+        modified = path.getmtime(index_path)
+    except OSError:
+        # The segment is open, or was deleted
+        with indexes_lock:
+            indexes.pop(index_path, None)
+        return None
+
+    with indexes_lock:
+        cached = indexes.get(index_path)
+
+        if cached is not None and cached[0] == modified:
+            indexes.move_to_end(index_path)
+            return cached[1]
+
+    with open(index_path, "rb") as file:
+        cached = (modified, loads(file.read()))
+
+    with indexes_lock:
+        indexes[index_path] = cached
+
+        while len(indexes) > MAX_INDEXES:
+            indexes.popitem(last=False)
+
+    return cached[1]
+
+
+def query(start, end, ip=None):
+    """Return the flows of the time range [start, end) as the flows of the analyser, only the ones of an address if set"""
+    directory = get_directory()
+    # Flow key: flow
+    results = {}
+
+    if not path.isdir(directory):
+        return []
+
+    address = None if ip is None else pack_address(ip)
+
+    for store in sorted(listdir(directory)):
+        if not path.isdir(f"{directory}{store}"):
+            continue
+
+        for (segment, file_path) in list_segments(f"{directory}{store}/"):
+            if segment[1] <= start or segment[0] >= end:
+                continue
+
+            index = None if address is None else get_index(file_path)
+
+            # The index of a sealed segment gives the records of the address, the open one is scanned
+            if index is not None:
+                records = read_records(file_path, index.get(address, []))
+            else:
+                records = (record for (offset, record) in read_blocks(file_path, start, end))
+
+            for (bucket, address_a, address_b, packets_ab, packets_ba, bytes_ab, bytes_ba) in records:
+                if bucket < start or bucket >= end or (address is not None and address not in (address_a, address_b)):
+                    continue
+
+                key = (address_a, address_b)
+                flow = results.get(key)
+
+                if flow is None:
+                    flow = results[key] = {"ip_a": unpack_address(address_a),
+                                           "ip_b": unpack_address(address_b),
+                                           "packets_ab": 0,
+                                           "packets_ba": 0,
+                                           "bytes_ab": 0,
+                                           "bytes_ba": 0,
+                                           "first_seen": bucket,
+                                           "last_seen": bucket}
+
+                flow["packets_ab"] += packets_ab
+                flow["packets_ba"] += packets_ba
+                flow["bytes_ab"] += bytes_ab
+                flow["bytes_ba"] += bytes_ba
+                flow["first_seen"] = min(flow["first_seen"], bucket)
+                flow["last_seen"] = max(flow["last_seen"], bucket)
+
+    return sorted(results.values(), key=lambda flow: flow["bytes_ab"] + flow["bytes_ba"], reverse=True)
+
+
+def read_sketches(file_path, start, end, seconds):
+    """Yield the (bucket, dimension, value, sketch) of a segment whose buckets last seconds and start in [start, end)"""
+    with open(file_path, "rb") as file:
+        data = file.read()
+
+    position = 0
+
+    while position + SKETCH.size <= len(data):
+        (bucket, bucket_seconds, precision, key_length, registers_length) = SKETCH.unpack_from(data, position)
+        position += SKETCH.size
+
+        # The last record is being written, or was cut by a crash
+        if position + key_length + registers_length > len(data):
+            break
+
+        if bucket_seconds == seconds and start <= bucket < end:
+            (dimension, value) = data[position:position + key_length].decode().split("\t", 1)
+            registers = data[position + key_length:position + key_length + registers_length]
+            yield (bucket, dimension, value, sketches.HyperLogLog.from_bytes(precision, registers))
+
+        position += key_length + registers_length
+
+
+def query_cardinality(start, end, dimension, granularity="minute"):
+    """Return the number of distinct external endpoints of the time range [start, end) per value of a dimension (all,
+    interface, country or as), counted in the buckets of a granularity, as {value: estimate}
+
+    The sketches of the buckets of the range, of every analyser and of every sensor whose history is copied in the
+    directory are merged: an endpoint seen several times is counted once."""
+    directory = get_directory()
+    merged = {}
+
+    if not path.isdir(directory):
+        return {}
+
+    seconds = cardinality.GRANULARITIES[granularity]
+
+    for store in sorted(listdir(directory)):
+        if not path.isdir(f"{directory}{store}"):
+            continue
+
+        for (segment, file_path) in list_segments(f"{directory}{store}/"):
+            sketches_path = f"{file_path[:-len('.flows')]}.hll"
+
+            if segment[1] <= start or segment[0] >= end or not path.isfile(sketches_path):
+                continue
+
+            for (bucket, bucket_dimension, value, sketch) in read_sketches(sketches_path, start, end, seconds):
+                if bucket_dimension != dimension:
+                    continue
+
+                if value in merged:
+                    merged[value].merge(sketch)
+                else:
+                    merged[value] = sketch
+
+    return {value: sketch.estimate() for (value, sketch) in merged.items()}
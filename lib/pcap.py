@@ -0,0 +1,330 @@
+# -*- coding: utf-8 -*-
+
+from mmap import mmap, ACCESS_READ
+from struct import Struct
+from socket import inet_ntop, AF_INET, AF_INET6
+
+from . import logger
+
+
+# Link layer types (http://www.tcpdump.org/linktypes.html)
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LOOP = 108
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4 = 228
+LINKTYPE_IPV6 = 229
+LINKTYPE_LINUX_SLL2 = 276
+
+# Ethernet types
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_IPV6 = 0x86dd
+ETHERTYPE_VLAN = (0x8100, 0x88a8, 0x9100)
+
+PCAP_MAGIC = {
+    b"\xd4\xc3\xb2\xa1": ("<", 1000000),
+    b"\xa1\xb2\xc3\xd4": (">", 1000000),
+    b"\x4d\x3c\xb2\xa1": ("<", 1000000000),
+    b"\xa1\xb2\x3c\x4d": (">", 1000000000)}
+PCAPNG_MAGIC = b"\x0a\x0d\x0d\x0a"
+
+PCAPNG_INTERFACE_DESCRIPTION_BLOCK = 1
+PCAPNG_SIMPLE_PACKET_BLOCK = 3
+PCAPNG_ENHANCED_PACKET_BLOCK = 6
+PCAPNG_SECTION_HEADER_BLOCK = 0x0a0d0d0a
+PCAPNG_OPTION_TSRESOL = 9
+
+# IP protocol numbers of the transport layers whose ports are read
+TRANSPORT_PROTOCOLS = {6: "tcp", 17: "udp"}
+
+ETHERTYPE = Struct("!H")
+PORTS = Struct("!HH")
+PCAP_HEADER = Struct("<IHHiIII")
+PCAP_RECORD_HEADER = Struct("<IIII")
+
+
+class PcapReader():
+    """Memory-mapped reader of pcap and pcapng files"""
+
+    file_path = None
+    file = None
+    map = None
+
+    def __init__(self, file_path):
+        """Map the capture file in memory"""
+        self.file_path = file_path
+        self.file = open(file_path, "rb")
+
+        try:
+            self.map = mmap(self.file.fileno(), 0, access=ACCESS_READ)
+
+        # Empty file
+        except ValueError:
+            self.map = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Unmap and close the capture file"""
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+        self.file.close()
+
+    def packets(self):
+        """Yield (timestamp, link type, frame, original length) for each record of the file"""
+        if self.map is None or len(self.map) < 24:
+            return
+
+        magic = self.map[:4]
+
+        if magic in PCAP_MAGIC:
+            yield from self.pcap_packets(*PCAP_MAGIC[magic])
+
+        elif magic == PCAPNG_MAGIC:
+            yield from self.pcapng_packets()
+
+        else:
+            logger.log.error(f"The file {self.file_path} is neither a pcap nor a pcapng file.")
+
+    def pcap_packets(self, byte_order, resolution):
+        """Parse the global header then the records of a pcap file"""
+        data = memoryview(self.map)
+        linktype = Struct(f"{byte_order}I").unpack_from(data, 20)[0] & 0x0fffffff
+        record_header = Struct(f"{byte_order}IIII")
+        offset = 24
+        size = len(data)
+
+        try:
+            while offset + 16 <= size:
+                seconds, fraction, captured_length, original_length = record_header.unpack_from(data, offset)
+                offset += 16
+
+                if offset + captured_length > size:
+                    logger.log.warning(f"The last record of {self.file_path} is truncated.")
+                    break
+
+                yield (seconds + fraction / resolution,
+                       linktype,
+                       data[offset:offset + captured_length],
+                       original_length)
+                offset += captured_length
+
+        finally:
+            data.release()
+
+    def pcapng_packets(self):
+        """Parse the blocks of a pcapng file"""
+        data = memoryview(self.map)
+        interfaces = []
+        byte_order = "<"
+        offset = 0
+        size = len(data)
+
+        try:
+            while offset + 12 <= size:
+                block_type = Struct(f"{byte_order}I").unpack_from(data, offset)[0]
+
+                # The byte order of each section is given by its header
+                if block_type == PCAPNG_SECTION_HEADER_BLOCK:
+                    byte_order = "<" if data[offset + 8:offset + 12] == b"\x4d\x3c\x2b\x1a" else ">"
+                    interfaces = []
+
+                block_length = Struct(f"{byte_order}I").unpack_from(data, offset + 4)[0]
+
+                if block_length < 12 or offset + block_length > size:
+                    logger.log.warning(f"The last block of {self.file_path} is truncated.")
+                    break
+
+                body = offset + 8
+
+                if block_type == PCAPNG_INTERFACE_DESCRIPTION_BLOCK:
+                    linktype = Struct(f"{byte_order}H").unpack_from(data, body)[0]
+                    resolution = self.pcapng_resolution(data[body + 8:offset + block_length - 4], byte_order)
+                    interfaces.append((linktype, resolution))
+
+                elif block_type == PCAPNG_ENHANCED_PACKET_BLOCK:
+                    if block_length < 32:
+                        logger.log.warning(f"A packet block of {self.file_path} is too short, it is skipped.")
+                        offset += block_length
+                        continue
+
+                    interface, high, low, captured_length, original_length = Struct(f"{byte_order}IIIII").unpack_from(data, body)
+
+                    # A bad block is skipped, the next one starts at its length
+                    if interface >= len(interfaces):
+                        logger.log.warning(f"A packet block of {self.file_path} refers to an undeclared interface ({interface}), it is skipped.")
+                    elif captured_length > block_length - 32:
+                        logger.log.warning(f"A packet block of {self.file_path} is longer than its block, it is skipped.")
+                    else:
+                        linktype, resolution = interfaces[interface]
+                        yield (((high << 32) | low) / resolution,
+                               linktype,
+                               data[body + 20:body + 20 + captured_length],
+                               original_length)
+
+                elif block_type == PCAPNG_SIMPLE_PACKET_BLOCK:
+                    if len(interfaces) == 0:
+                        logger.log.warning(f"A simple packet block of {self.file_path} precedes the description of its interface, it is skipped.")
+                    elif block_length < 16:
+                        logger.log.warning(f"A simple packet block of {self.file_path} is too short, it is skipped.")
+                    else:
+                        original_length = Struct(f"{byte_order}I").unpack_from(data, body)[0]
+                        captured_length = min(original_length, block_length - 16)
+                        linktype, resolution = interfaces[0]
+                        yield (None,
+                               linktype,
+                               data[body + 4:body + 4 + captured_length],
+                               original_length)
+
+                offset += block_length
+
+        finally:
+            data.release()
+
+    def pcapng_resolution(self, options, byte_order):
+        """Return the number of timestamp units per second of a pcapng interface"""
+        option_header = Struct(f"{byte_order}HH")
+        offset = 0
+
+        while offset + 4 <= len(options):
+            code, length = option_header.unpack_from(options, offset)
+
+            if code == 0:
+                break
+
+            if code == PCAPNG_OPTION_TSRESOL:
+                value = options[offset + 4]
+                # The most significant bit tells if the resolution is a power of 2 or 10
+                return 2 ** (value & 0x7f) if value & 0x80 else 10 ** value
+
+            # Options are padded to 32 bits
+            offset += 4 + ((length + 3) & ~3)
+
+        return 1000000
+
+
+class PcapWriter():
+    """Buffered writer of pcap files with nanosecond timestamps"""
+
+    file_path = None
+    file = None
+    size = None
+
+    def __init__(self, file_path, linktype, snaplen=262144):
+        """Create the capture file and write its global header"""
+        self.file_path = file_path
+        self.file = open(file_path, "wb", buffering=1024 * 1024)
+        self.file.write(PCAP_HEADER.pack(0xa1b23c4d, 2, 4, 0, 0, snaplen, linktype))
+        self.size = PCAP_HEADER.size
+
+    def write(self, seconds, nanoseconds, frame, original_length):
+        """Append a frame to the capture file"""
+        self.file.write(PCAP_RECORD_HEADER.pack(seconds, nanoseconds, len(frame), original_length))
+        self.file.write(frame)
+        self.size += PCAP_RECORD_HEADER.size + len(frame)
+
+    def close(self):
+        self.file.close()
+
+
+def decode(linktype, frame):
+    """Return (IP version, source address, destination address, transport, source port, destination port) of a frame, or None
+
+    The transport is "tcp" or "udp" and the ports ints when the frame carries the start of one, all None otherwise."""
+    if linktype == LINKTYPE_ETHERNET:
+        if len(frame) < 14:
+            return None
+        ethertype = ETHERTYPE.unpack_from(frame, 12)[0]
+        offset = 14
+
+        # 802.1Q and 802.1ad tags
+        while ethertype in ETHERTYPE_VLAN and len(frame) >= offset + 4:
+            ethertype = ETHERTYPE.unpack_from(frame, offset + 2)[0]
+            offset += 4
+
+    elif linktype == LINKTYPE_LINUX_SLL:
+        if len(frame) < 16:
+            return None
+        ethertype = ETHERTYPE.unpack_from(frame, 14)[0]
+        offset = 16
+
+    elif linktype == LINKTYPE_LINUX_SLL2:
+        if len(frame) < 20:
+            return None
+        ethertype = ETHERTYPE.unpack_from(frame, 0)[0]
+        offset = 20
+
+    elif linktype in (LINKTYPE_NULL, LINKTYPE_LOOP):
+        # The address family is in the byte order of the capturing host, only its version matters
+        ethertype = None
+        offset = 4
+
+    elif linktype in (LINKTYPE_RAW, LINKTYPE_IPV4, LINKTYPE_IPV6, 12, 14):
+        ethertype = None
+        offset = 0
+
+    else:
+        return None
+
+    if len(frame) <= offset:
+        return None
+
+    if ethertype is None:
+        version = frame[offset] >> 4
+        ethertype = ETHERTYPE_IPV4 if version == 4 else ETHERTYPE_IPV6 if version == 6 else None
+
+    if ethertype == ETHERTYPE_IPV4 and len(frame) >= offset + 20:
+        # Only the first fragment holds the transport header
+        first_fragment = ETHERTYPE.unpack_from(frame, offset + 6)[0] & 0x1fff == 0
+        transport = TRANSPORT_PROTOCOLS.get(frame[offset + 9]) if first_fragment else None
+        return (4,
+                inet_ntop(AF_INET, frame[offset + 12:offset + 16]),
+                inet_ntop(AF_INET, frame[offset + 16:offset + 20])) + \
+            decode_ports(frame, offset + (frame[offset] & 0x0f) * 4, transport)
+
+    if ethertype == ETHERTYPE_IPV6 and len(frame) >= offset + 40:
+        # The extension headers are not walked, the ports of the packets carrying some are not read
+        return (6,
+                inet_ntop(AF_INET6, frame[offset + 8:offset + 24]),
+                inet_ntop(AF_INET6, frame[offset + 24:offset + 40])) + \
+            decode_ports(frame, offset + 40, TRANSPORT_PROTOCOLS.get(frame[offset + 6]))
+
+    return None
+
+
+def decode_ports(frame, offset, transport):
+    """Return (transport, source port, destination port) of the TCP or UDP header at an offset, all None if there is none"""
+    if transport is None or len(frame) < offset + 4:
+        return (None, None, None)
+
+    return (transport,) + PORTS.unpack_from(frame, offset)
+
+
+def packet_fields(addresses, length, timestamp=None, interface=None):
+    """Return the decoded addresses and ports of a frame as the tshark fields read by the analyser"""
+    version, src, dst, transport, src_port, dst_port = addresses
+    layer = "ip" if version == 4 else "ipv6"
+    fields = {"frame.len": length,
+              f"{layer}.src": src,
+              f"{layer}.dst": dst,
+              f"{layer}.src_host": src,
+              f"{layer}.dst_host": dst}
+
+    if transport is not None:
+        fields[f"{transport}.srcport"] = src_port
+        fields[f"{transport}.dstport"] = dst_port
+
+    if timestamp is not None:
+        fields["frame.time_epoch"] = timestamp
+
+    if interface is not None:
+        fields["frame.interface_name"] = interface
+
+    return fields
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+
+from queue import Queue, Full, Empty
+from threading import Lock
+from time import monotonic
+
+from . import logger
+from . import config
+from . import flows
+
+config.load_config()
+
+
+class BatchQueue():
+    """Bounded queue exchanging lists of items between two modules"""
+
+    name = None
+    queue = None
+    size = None
+    batch_size = None
+    policy = None
+    sample_ratio = None
+    lock = None
+    batches_in = None
+    items_in = None
+    items_out = None
+    dropped = None
+    sampler = None
+
+    def __init__(self, name, policy=None, sampler=None):
+        """Initialize an empty queue, the policy tells what to do with the batches that do not fit"""
+        self.name = name
+        self.sampler = sampler
+        self.size = config.get_int("queue_size", 256)
+        self.batch_size = config.get_int("queue_batch_size", 512)
+        self.sample_ratio = config.get_int("queue_sample_ratio", 10)
+        self.policy = policy if policy is not None else config.get("queue_policy")
+
+        # block: slow down the producer, drop-oldest: forget the oldest batch, sample: keep a fraction of the batch
+        if self.policy not in ["block", "drop-oldest", "sample"]:
+            self.policy = "block"
+
+        self.queue = Queue(self.size)
+        self.lock = Lock()
+        self.batches_in = 0
+        self.items_in = 0
+        self.items_out = 0
+        self.dropped = 0
+
+    def put(self, batch):
+        """Send a list of items, split in batches of queue_batch_size items at most"""
+        if self.sampler is not None:
+            batch = self.sampler.sample(batch, self.queue.qsize() / self.size)
+
+        for start in range(0, len(batch), self.batch_size):
+            self.put_batch(batch[start:start + self.batch_size])
+
+    def put_batch(self, batch):
+        """Send a single batch according to the queue policy"""
+        dropped = 0
+
+        if self.policy == "block":
+            self.queue.put(batch)
+
+        elif self.policy == "drop-oldest":
+            while True:
+                try:
+                    self.queue.put_nowait(batch)
+                    break
+                except Full:
+                    try:
+                        dropped += len(self.queue.get_nowait())
+                        self.queue.task_done()
+                    except Empty:
+                        pass
+
+        elif self.policy == "sample":
+            # Thin the batches once the queue is half full
+            if self.queue.qsize() >= self.size // 2:
+                sampled = batch[::self.sample_ratio]
+                dropped += len(batch) - len(sampled)
+                batch = sampled
+                # A packet kept stands for the ones dropped, on top of the sampling of the Sampler
+                for packet in batch:
+                    packet["sample_weight"] = packet.get("sample_weight", 1) * self.sample_ratio
+            try:
+                self.queue.put_nowait(batch)
+            except Full:
+                dropped += len(batch)
+                batch = []
+
+        with self.lock:
+            self.batches_in += 1
+            self.items_in += len(batch)
+            self.dropped += dropped
+
+    def get(self, timeout=None):
+        """Return the oldest batch, raise queue.Empty after the timeout"""
+        batch = self.queue.get(timeout=timeout)
+
+        with self.lock:
+            self.items_out += len(batch)
+
+        return batch
+
+    def task_done(self):
+        self.queue.task_done()
+
+    def empty(self):
+        return self.queue.empty()
+
+    def qsize(self):
+        """Return the number of batches waiting in the queue"""
+        return self.queue.qsize()
+
+    def get_counters(self):
+        """Return the counters of the queue as (name, value) pairs"""
+        with self.lock:
+            return [("Policy", self.policy),
+                    ("Depth (batches)", f"{self.queue.qsize()} / {self.size}"),
+                    ("Items received", self.items_in),
+                    ("Items processed", self.items_out),
+                    ("Items dropped", self.dropped),
+                    ("Average batch size", round(self.items_in / self.batches_in, 1) if self.batches_in > 0 else 0)]
+
+
+class Sampler():
+    """Keep a fraction of the packets, the rate adapts to the depth of the packet queue"""
+
+    name = None
+    mode = None
+    min_rate = None
+    max_rate = None
+    rate = None
+    threshold = None
+    offset = None
+    last_adjustment = None
+    lock = None
+    packets_in = None
+    packets_out = None
+
+    def __init__(self, mode, min_rate=1, max_rate=64):
+        """Initialize a sampler keeping 1 packet (packet mode) or 1 flow (flow mode) out of rate"""
+        self.name = "Sampler"
+        self.mode = mode
+        self.min_rate = max(min_rate, 1)
+        self.max_rate = max(max_rate, self.min_rate)
+        self.offset = 0
+        self.last_adjustment = monotonic()
+        # The sniffer threads of several interfaces share the sampler of the packet queue
+        self.lock = Lock()
+        self.packets_in = 0
+        self.packets_out = 0
+        self.set_rate(self.min_rate)
+
+    def set_rate(self, rate):
+        """Change the sampling rate, a flow is kept if its hash is below the threshold"""
+        self.rate = rate
+        # The flows kept at a given rate are also kept at any lower rate
+        self.threshold = 0x100000000 // rate
+
+    def adjust(self, depth):
+        """Double the rate while the queue is half full, halve it back once the queue is almost empty"""
+        now = monotonic()
+
+        # Let the analyser catch up before measuring the effect of the last change
+        if now - self.last_adjustment < 1:
+            return
+
+        if depth >= 0.5 and self.rate < self.max_rate:
+            self.set_rate(min(self.rate * 2, self.max_rate))
+            logger.log.info(f"The packet queue is filling up, 1 {self.mode} out of {self.rate} is now analysed.")
+        elif depth <= 0.1 and self.rate > self.min_rate:
+            self.set_rate(max(self.rate // 2, self.min_rate))
+            logger.log.debug(f"The packet queue is draining, 1 {self.mode} out of {self.rate} is now analysed.")
+        else:
+            return
+
+        self.last_adjustment = now
+
+    def sample(self, packets, depth):
+        """Return the packets kept, each one weighs the number of packets it stands for"""
+        with self.lock:
+            self.adjust(depth)
+            (rate, threshold, offset) = (self.rate, self.threshold, self.offset)
+
+            if rate > 1 and self.mode != "flow":
+                # The position of the next packet to keep is carried over to the next batch
+                self.offset = (offset - len(packets)) % rate
+
+        if rate == 1:
+            sampled = packets
+
+        elif self.mode == "flow":
+            sampled = [packet for packet in packets if flows.get_flow_hash(packet) < threshold]
+
+        else:
+            sampled = packets[offset::rate]
+
+        # Counts read by the analyser are scaled back up with the weight
+        if rate > 1:
+            for packet in sampled:
+                packet["sample_weight"] = rate
+
+        with self.lock:
+            self.packets_in += len(packets)
+            self.packets_out += len(sampled)
+
+        return sampled
+
+    def get_counters(self):
+        """Return the counters of the sampler as (name, value) pairs"""
+        with self.lock:
+            return [("Mode", self.mode),
+                    ("Rate", f"1 / {self.rate}"),
+                    ("Packets received", self.packets_in),
+                    ("Packets analysed", self.packets_out)]
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+
+from os import path
+from time import monotonic
+from threading import Thread, Event
+
+from . import logger
+from . import config
+from . import pcap
+from .sniffer import PacketCounter
+
+config.load_config()
+
+
+class Replay(Thread):
+
+    ready = None
+    running = None
+    queue = None
+    file_path = None
+    interface = None
+    realtime = None
+    state = None
+    counter = None
+    stopped = None
+
+    def __init__(self, queue, file_path, realtime=False):
+        """Initialize a sniffer reading the packets of a capture file instead of an interface"""
+        Thread.__init__(self, daemon=True)
+
+        self.queue = queue
+        # Set by stop, interrupts the wait for the next packet of a real time replay
+        self.stopped = Event()
+        self.file_path = file_path
+        self.realtime = realtime
+        self.ready = False
+        self.running = False
+        self.state = "Not ready"
+        self.counter = PacketCounter()
+
+        # A file name alone refers to the capture directory
+        if not path.isfile(self.file_path):
+            self.file_path = f'{config.get("prog_path")}/capture/{path.basename(file_path)}'
+
+        if path.isfile(self.file_path):
+            # <start>_<end>_<interface>.pcap, the name of an interface may hold dots (VLAN) and underscores
+            fields = path.basename(self.file_path).rsplit('.', 1)[0].split('_', 2)
+            self.interface = fields[-1]
+            self.ready = True
+            self.state = "Ready"
+            logger.log.info(f"Replay of {self.file_path} ready.")
+        else:
+            logger.log.error(f"The capture file to replay ({file_path}) does not exist. Please edit the /config/config.txt file.")
+
+    def sniff(self):
+        """Start replaying the capture file"""
+        if not self.ready:
+            logger.log.error("The replay cannot start because it is not ready.")
+            return False
+
+        self.running = True
+        self.state = "Replaying"
+        self.start()
+
+    def get_sources(self):
+        """Return the replay as the only capture source"""
+        return {self.interface: self}
+
+    def get_rate(self):
+        """Return the number of packets per second read from the capture file"""
+        return self.counter.get_rate()
+
+    def run(self):
+        """Decode the packets of the capture file and send them to the analyser"""
+        logger.log.info(f"Replaying {self.file_path} ({'original timing' if self.realtime else 'maximum speed'}).")
+
+        count = 0
+        batch = []
+        first_timestamp = None
+        start = monotonic()
+
+        with pcap.PcapReader(self.file_path) as reader:
+            packets = reader.packets()
+
+            for (timestamp, linktype, frame, length) in packets:
+                if not self.running:
+                    frame.release()
+                    break
+
+                # Wait until the packet is due according to the capture timestamps
+                if self.realtime and timestamp is not None:
+                    if first_timestamp is None:
+                        first_timestamp = timestamp
+                    delay = (timestamp - first_timestamp) - (monotonic() - start)
+                    if delay > 0:
+                        self.send(batch)
+                        batch = []
+                        self.stopped.wait(delay)
+
+                addresses = pcap.decode(linktype, frame)
+                frame.release()
+
+                if addresses is None:
+                    continue
+
+                batch.append(pcap.packet_fields(addresses, length, timestamp, self.interface))
+                count += 1
+
+                if len(batch) >= self.queue.batch_size:
+                    self.send(batch)
+                    batch = []
+
+            self.send(batch)
+
+            # Release the mapped memory before closing the file
+            packets.close()
+
+        duration = monotonic() - start
+        logger.log.info(f"Replay of {self.file_path} finished: {count} packets in {duration:.1f} seconds.")
+        self.running = False
+        self.state = "Stopped"
+
+    def send(self, batch):
+        """Send a batch of packets to the analyser"""
+        if len(batch) > 0:
+            self.queue.put(batch)
+            self.counter.add(len(batch))
+
+    def stop(self):
+        """Stop replaying"""
+        self.running = False
+        self.stopped.set()
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+
+from . import config
+from . import sketches
+
+config.load_config()
+
+
+# Registers of the sketches of each source: 256 bytes at most, standard error 6.5 %
+SCAN_PRECISION = 8
+
+# New (source, destination, port) of a source seen during a slot before the window of the source is estimated, the
+# estimate is made again each time their number doubles and when the slot ends
+CHECK_INTERVAL = 64
+
+# Alerts of a packet raising none
+NO_ALERTS = ()
+
+# 64 bits of the hash of an item
+MASK = (1 << 64) - 1
+
+# Port number: string hashed, the hash of a small int is the int itself
+PORT_ITEMS = [str(port) for port in range(65536)]
+
+
+class ScanDetector():
+    """Sources contacting many distinct destinations or destination ports during a sliding window
+
+    The window is a wheel of slots, each one holding a pair of small HyperLogLog sketches per source. The estimate of
+    a source over the window is the union of its sketches of every slot, the oldest slot is dropped as a new one
+    starts. A triple (source, destination, port) already seen during the slot costs a set lookup, a new one two hashes,
+    and a source is estimated a few times per slot at most, once the window holds enough of its triples to exceed a
+    threshold: the cost per packet does not depend on the traffic. The sketches never leave the process, the
+    items are hashed by the (salted) hash of Python rather than by hash_item."""
+
+    window = None
+    shards = None
+    slot_duration = None
+    destination_threshold = None
+    port_threshold = None
+    max_sources = None
+    slots = None
+    slot_start = None
+    seen = None
+    max_seen = None
+    new_triples = None
+    window_triples = None
+    alerted = None
+    alerts = None
+    dropped = None
+    min_threshold = None
+
+    def __init__(self, shards=1):
+        """Read the window and the thresholds, the destination one divided between the shards analysing a share of the flows each"""
+        # Seconds of capture of the window, and number of slots it is divided into
+        self.window = config.get_int("scan_window", 60)
+        slot_count = max(config.get_int("scan_window_slots", 6), 1)
+        self.slot_duration = self.window / slot_count
+        # Distinct destinations or destination ports of a source during the window raising an alert, None: not watched
+        self.destination_threshold = config.get_int("scan_destination_threshold")
+        self.port_threshold = config.get_int("scan_port_threshold")
+
+        # The flows are sharded by address pair: each shard sees a share of the destinations of a source, but every
+        # port of a destination
+        self.shards = shards
+
+        if shards > 1 and self.destination_threshold is not None:
+            self.destination_threshold = max(self.destination_threshold // shards, 1)
+
+        # Sources tracked in a slot, the new ones beyond are ignored until the next slot
+        self.max_sources = config.get_int("scan_max_sources", 5000)
+        # Source: [destinations sketch, ports sketch, new triples], the current slot first
+        self.slots = [{} for slot in range(slot_count)]
+        self.slot_start = 0.0
+        # (source, destination, port) of the current slot, a bounded number of them
+        self.seen = set()
+        self.max_seen = 64 * self.max_sources
+        # Sources with new triples during the current slot
+        self.new_triples = set()
+        # Source: new triples of its slots in the window, an upper bound of its distinct destinations and ports
+        self.window_triples = {}
+        # Lowest threshold set
+        self.min_threshold = min(threshold for threshold in (self.destination_threshold, self.port_threshold, 1 << 62)
+                                 if threshold is not None)
+        # (source, kind): capture time of its last alert, a source is reported once per window
+        self.alerted = {}
+        self.alerts = 0
+        self.dropped = 0
+
+    def is_enabled(self):
+        """Return True if a threshold is set"""
+        return self.destination_threshold is not None or self.port_threshold is not None
+
+    def add(self, src, dst, port, timestamp):
+        """Count a packet sent by a source to a destination and a port (None if unknown), return the alerts raised"""
+        alerts = NO_ALERTS
+
+        if not self.slot_start <= timestamp < self.slot_start + self.slot_duration:
+            if timestamp < self.slot_start:
+                # A late packet is counted in the current slot
+                timestamp = self.slot_start
+            else:
+                alerts = self.rotate(timestamp)
+
+        triple = (src, dst, port)
+
+        if triple in self.seen:
+            return alerts
+
+        if len(self.seen) < self.max_seen:
+            self.seen.add(triple)
+
+        source_sketches = self.slots[0].get(src)
+
+        if source_sketches is None:
+            if len(self.slots[0]) >= self.max_sources:
+                self.dropped += 1
+                return alerts
+
+            source_sketches = self.slots[0][src] = [sketches.HyperLogLog(SCAN_PRECISION), sketches.HyperLogLog(SCAN_PRECISION), 0]
+
+        source_sketches[0].add_hash(hash(dst) & MASK)
+
+        if port is not None:
+            source_sketches[1].add_hash(hash(PORT_ITEMS[port]) & MASK)
+
+        source_sketches[2] += 1
+        self.new_triples.add(src)
+        count = self.window_triples.get(src, 0) + 1
+        self.window_triples[src] = count
+
+        # Fewer triples than the threshold in the window cannot be more distinct destinations or ports
+        slot_count = source_sketches[2]
+
+        if count >= self.min_threshold and slot_count >= CHECK_INTERVAL and slot_count & (slot_count - 1) == 0:
+            alerts = [*alerts, *self.check(src, timestamp)]
+
+        return alerts
+
+    def rotate(self, timestamp):
+        """Check the sources of the slot ending, then start the slot of a timestamp and drop the slots older than the window"""
+        alerts = []
+
+        for src in self.new_triples:
+            if self.window_triples[src] >= self.min_threshold:
+                alerts += self.check(src, self.slot_start + self.slot_duration)
+
+        # Slots elapsed since the current one started, all of them if the capture was idle longer than the window
+        elapsed = min(int((timestamp - self.slot_start) // self.slot_duration), len(self.slots))
+
+        for slot in self.slots[len(self.slots) - elapsed:]:
+            for (src, source_sketches) in slot.items():
+                count = self.window_triples[src] - source_sketches[2]
+                if count > 0:
+                    self.window_triples[src] = count
+                else:
+                    del self.window_triples[src]
+
+        self.slots = [{} for slot in range(elapsed)] + self.slots[:len(self.slots) - elapsed]
+        self.slot_start = timestamp - timestamp % self.slot_duration
+        self.seen = set()
+        self.new_triples = set()
+        self.alerted = {key: time for (key, time) in self.alerted.items() if time + self.window > timestamp}
+
+        return alerts
+
+    def check(self, src, timestamp):
+        """Estimate the distinct destinations and ports of a source over the window, return an alert per threshold exceeded"""
+        alerts = []
+
+        for (kind, position, threshold, scale) in [("destinations", 0, self.destination_threshold, self.shards),
+                                                   ("ports", 1, self.port_threshold, 1)]:
+            if threshold is None or (src, kind) in self.alerted:
+                continue
+
+            union = sketches.HyperLogLog(SCAN_PRECISION)
+
+            for slot in self.slots:
+                source_sketches = slot.get(src)
+                if source_sketches is not None:
+                    union.merge(source_sketches[position])
+
+            count = union.estimate()
+
+            if count >= threshold:
+                self.alerted[(src, kind)] = timestamp
+                self.alerts += 1
+                # The share of the destinations seen by a shard stands for the whole
+                alerts.append({"time": timestamp, "source": src, "kind": kind, "count": count * scale, "window": self.window})
+
+        return alerts
+
+    def get_counters(self):
+        """Return the counters of the detector as (name, value) pairs"""
+        return [("Scan sources tracked", len(self.window_triples)),
+                ("Scan alerts", self.alerts),
+                ("Scan sources ignored", self.dropped)]
@@ -6,7 +6,11 @@ from queue import Queue
 from . import logger
 from . import config
 from . import sniffer
+from . import afpacket
+from . import replay
+from . import pipeline
 from . import analyser
+from . import shards
 from . import application
 
 config.load_config()
@@ -21,24 +25,70 @@ class Server():
 
     def __init__(self):
         """Initialize the server"""
-        pakets_queue = Queue()
-        data_queue = Queue()
-        self.sniffer = sniffer.Sniffer(pakets_queue, fix_files=True)
-        self.analyser = analyser.Analyser(pakets_queue, data_queue)
-        self.application = application.Application(data_queue)
+        sampler = self.get_sampler()
+        pakets_queue = pipeline.BatchQueue("Packets", sampler=sampler)
+        # Losing an event would lose an endpoint or a conversation for good
+        data_queue = pipeline.BatchQueue("Events", policy="block")
+        replay_file = config.get("replay_file")
+
+        # Replay a capture file instead of listening to an interface
+        if replay_file is not None:
+            self.sniffer = replay.Replay(pakets_queue, replay_file, realtime=(config.get("replay_timing") == "original"))
+        else:
+            # afpacket: read the frames from the Linux kernel without tshark
+            backend = afpacket.RawSniffer if config.get("capture_backend") == "afpacket" else sniffer.Sniffer
+            self.sniffer = sniffer.SnifferPool(pakets_queue, self.get_interfaces(), analyser.Analyser.fields, backend=backend)
+        processes = config.get_int("analyser_processes", 0)
+
+        # Analyse the packets in several processes when the capture is too much for a single thread
+        if processes > 0:
+            self.analyser = shards.ShardedAnalyser(pakets_queue, data_queue, processes)
+        else:
+            self.analyser = analyser.Analyser(pakets_queue, data_queue)
+
+        counters = [pakets_queue, data_queue, self.analyser]
+
+        # Each process of a sharded analyser has its own GeoIP cache
+        if self.analyser.geoip is not None:
+            counters.append(self.analyser.geoip)
+
+        if sampler is not None:
+            counters.insert(0, sampler)
+
+        self.application = application.Application(data_queue, self.sniffer, counters)
         self.running = False
         logger.log.info("Server ready.")
 
-    def start(self):
-        """Run the application with all the modules needed"""
-        interface = config.get("default_listening_interface")
+    def get_sampler(self):
+        """Return the sampler of the packets sent to the analyser, or None to analyse them all"""
+        mode = config.get("sampling_mode")
 
-        if interface is None:
-            interface = "Wi-Fi"
+        if mode not in ["packet", "flow"]:
+            return None
 
+        sampler = pipeline.Sampler(mode, config.get_int("sampling_rate", 1), config.get_int("sampling_max_rate", 64))
+        logger.log.info(f"Sampling of the packets enabled: 1 {mode} out of {sampler.min_rate} to {sampler.max_rate}.")
+
+        return sampler
+
+    def get_interfaces(self):
+        """Return the list of network interfaces to listen to"""
+        interfaces = config.get("default_listening_interface")
+
+        if interfaces is None:
+            interfaces = "Wi-Fi"
+
+        if type(interfaces) is not list:
+            interfaces = [interfaces]
+
+        return interfaces
+
+    def start(self):
+        """Run the application with all the modules needed"""
         self.running = True
-        self.sniffer.sniff(interface)
+        # The analyser waits for the packets before the capture starts
         self.analyser.analyse()
+        self.sniffer.sniff()
         self.application.go()
         logger.log.info("Server running.")
 
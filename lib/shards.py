@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+
+from time import monotonic
+from threading import Thread, Lock
+from multiprocessing import Process, Queue
+from queue import Empty
+
+from . import config
+from . import logger
+from . import flows
+from . import scans
+from .analyser import Analyser
+
+config.load_config()
+
+
+class ShardedAnalyser(Thread):
+    """Analyse the packets in several processes, each one owns the flows whose address pair hash falls in its shard"""
+
+    name = None
+    sniffers_queue = None
+    application_queue = None
+    shard_queues = None
+    events_queue = None
+    processes = None
+    collector = None
+    running = None
+    lock = None
+    endpoints = None
+    located_endpoints = None
+    locations = None
+    shard_counters = None
+    heavy_hitters = None
+    scan_alerts = None
+    geoip = None
+
+    def __init__(self, sniffers_queue, application_queue, process_count):
+        """Initialize the shards, their processes start with the analyse"""
+        Thread.__init__(self, daemon=True)
+        self.name = "Analyser"
+        self.sniffers_queue = sniffers_queue
+        self.application_queue = application_queue
+        self.running = False
+        self.lock = Lock()
+        # Endpoints already sent to the application: shards seeing them, an endpoint expires once no shard sees it
+        self.endpoints = {}
+        # Located endpoint: network of its location
+        self.located_endpoints = {}
+        # Network: [location shared by the endpoints located by different shards, number of these endpoints]
+        self.locations = {}
+        self.shard_counters = [[] for index in range(process_count)]
+        # Last top talkers and conversations sketches of each shard
+        self.heavy_hitters = [None] * process_count
+        # (source, kind): capture time of the last scan alert forwarded, the shards seeing a scan each raise one
+        self.scan_alerts = {}
+
+        queue_size = config.get_int("queue_size", 256)
+        self.shard_queues = [Queue(queue_size) for index in range(process_count)]
+        self.events_queue = Queue()
+        self.processes = [Process(target=run_shard, args=(index, process_count, self.shard_queues[index], self.events_queue), daemon=True)
+                          for index in range(process_count)]
+        self.collector = Thread(target=self.collect, daemon=True)
+        logger.log.info(f"Analyser ready ({process_count} processes).")
+
+    def analyse(self):
+        """Start the shards, then dispatch the packets"""
+        self.running = True
+
+        for process in self.processes:
+            process.start()
+
+        self.collector.start()
+        self.start()
+
+    def run(self):
+        """Send each packet to the shard of its flow"""
+        logger.log.info("Analyser running.")
+        shard_count = len(self.shard_queues)
+
+        while self.running or not self.sniffers_queue.empty():
+            try:
+                packets = self.sniffers_queue.get(timeout=1)
+            except Empty:
+                continue
+
+            shards = [[] for index in range(shard_count)]
+
+            for packet in packets:
+                shards[flows.get_flow_hash(packet) % shard_count].append(packet)
+
+            for (queue, shard) in zip(self.shard_queues, shards):
+                if len(shard) > 0:
+                    queue.put(shard)
+
+            self.sniffers_queue.task_done()
+
+        # Tell the shards there is nothing left to analyse
+        for queue in self.shard_queues:
+            queue.put(None)
+
+        logger.log.info("Analyser stoped.")
+
+    def collect(self):
+        """Forward the events of the shards to the application, the endpoints only once"""
+        while True:
+            try:
+                (shard, events) = self.events_queue.get(timeout=1)
+            except Empty:
+                # The last events of the shards are sent before their process ends
+                if not self.running and not any(process.is_alive() for process in self.processes):
+                    break
+                continue
+
+            forwarded = []
+
+            for (data_type, data) in events:
+                if data_type == "shard_counters":
+                    (index, counters) = data
+                    with self.lock:
+                        self.shard_counters[index] = counters
+                    continue
+
+                if data_type == "heavy_hitters":
+                    self.heavy_hitters[shard] = data
+                    data = self.merge_heavy_hitters()
+
+                elif data_type == "scan_alert":
+                    key = (data["source"], data["kind"])
+                    last_alert = self.scan_alerts.get(key)
+                    if last_alert is not None and data["time"] < last_alert + data["window"]:
+                        continue
+                    # The alerts are rare, the old ones are forgotten at each new one
+                    self.scan_alerts = {other: time for (other, time) in self.scan_alerts.items()
+                                        if time + data["window"] > data["time"]}
+                    self.scan_alerts[key] = data["time"]
+
+                elif data_type == "endpoint":
+                    shards = self.endpoints.setdefault(data.ip_addr, set())
+                    shards.add(shard)
+                    if len(shards) > 1:
+                        continue
+
+                elif data_type == "endpoints_expired":
+                    data = [ip for ip in data if self.expire_endpoint(ip, shard)]
+                    if len(data) == 0:
+                        continue
+
+                elif data_type == "endpoint_enriched":
+                    if data.ip_addr in self.located_endpoints:
+                        continue
+                    network = data.location.network
+                    self.located_endpoints[data.ip_addr] = network
+                    # Each shard sends its own copy of the location of a network
+                    location = self.locations.setdefault(network, [data.location, 0])
+                    location[1] += 1
+                    data.location = location[0]
+
+                forwarded.append((data_type, data))
+
+            if len(forwarded) > 0:
+                self.application_queue.put(forwarded)
+
+    def merge_heavy_hitters(self):
+        """Return the top talkers and conversations sketches of all the shards merged, an endpoint is seen by several"""
+        merged = None
+
+        for shard_sketches in self.heavy_hitters:
+            if shard_sketches is None:
+                continue
+
+            if merged is None:
+                merged = tuple(sketch.copy() for sketch in shard_sketches)
+            else:
+                for (sketch, other) in zip(merged, shard_sketches):
+                    sketch.merge(other)
+
+        return merged
+
+    def expire_endpoint(self, ip, shard):
+        """Forget that a shard sees an endpoint, return True if no other shard sees it"""
+        shards = self.endpoints.get(ip)
+
+        if shards is None:
+            return False
+
+        shards.discard(shard)
+
+        if len(shards) > 0:
+            return False
+
+        del self.endpoints[ip]
+        network = self.located_endpoints.pop(ip, None)
+
+        # The location of a network is forgotten with its last endpoint
+        if network is not None:
+            location = self.locations[network]
+            location[1] -= 1
+            if location[1] == 0:
+                del self.locations[network]
+
+        return True
+
+    def stop(self):
+        """Stop dispatching the packets, the shards stop once their queue is empty"""
+        self.running = False
+
+    def get_counters(self):
+        """Return the counters of the shards added up, as (name, value) pairs"""
+        totals = {}
+
+        with self.lock:
+            for counters in self.shard_counters:
+                for (name, value) in counters:
+                    totals[name] = totals.get(name, 0) + value
+
+            counters = [("Processes", f"{sum(process.is_alive() for process in self.processes)} / {len(self.processes)}")]
+
+            for name in ["Packets analysed", "Packets captured (estimated)", "Endpoints waiting for their location", "Conversations",
+                         "Checkpoints written", "History records written", "Scan alerts"]:
+                counters.append((name, totals.get(name, 0)))
+
+            counters.append(("Endpoints", len(self.endpoints)))
+
+            for (index, shard) in enumerate(self.shard_counters):
+                counters.append((f"Packets analysed by shard {index}", dict(shard).get("Packets analysed", 0)))
+
+        return counters
+
+
+def run_shard(index, shard_count, packets_queue, events_queue):
+    """Analyse the packets of a shard, run in its own process"""
+    # A checkpoint is restored only by the same number of shards, the flows of a shard depend on it, the history
+    # of each shard is a directory of its own
+    analyser = Analyser(None, None, f"analyser_{index + 1}of{shard_count}")
+    # Each shard sees the flows of a source to a share of its destinations
+    analyser.scans = scans.ScanDetector(shard_count)
+    last_counters = monotonic()
+    events = analyser.restore()
+
+    if len(events) > 0:
+        events_queue.put((index, events))
+
+    while True:
+        try:
+            packets = packets_queue.get(timeout=1)
+        except Empty:
+            packets = []
+
+        if packets is None:
+            break
+
+        if len(packets) > 0:
+            events = analyser.analyse_packets(packets)
+        else:
+            events = analyser.get_pending_events()
+
+        # The counters of the shard are read by the main process
+        if monotonic() - last_counters >= 1:
+            last_counters = monotonic()
+            events.append(("shard_counters", (index, analyser.get_counters())))
+
+        if len(events) > 0:
+            events_queue.put((index, events))
+
+    # Send the last counters of the flows
+    analyser.last_flow_update = 0
+    events = analyser.get_pending_events()
+    events.append(("shard_counters", (index, analyser.get_counters())))
+    events_queue.put((index, events))
+    analyser.close()
+    analyser.stop()
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+
+from math import log
+from hashlib import blake2b
+
+
+class FrequentItems():
+    """Heaviest items of a weighted stream in a bounded number of counters (Misra-Gries with median purges)
+
+    At most 2 * size counters are kept. When they are all used, the median count is subtracted from every counter and
+    the counters left without weight are dropped. The true weight of an item is between its count and its count plus
+    the offset, the sum of the medians subtracted, and the offset never exceeds total / (size + 1): an item weighing
+    more than 1 / (size + 1) of the stream is always kept."""
+
+    __slots__ = ("size", "counters", "offset", "total", "purges")
+
+    def __init__(self, size):
+        """Initialize an empty sketch"""
+        self.size = size
+        # Item: count, lower bound of its weight
+        self.counters = {}
+        self.offset = 0
+        self.total = 0
+        self.purges = 0
+
+    def add(self, item, weight=1):
+        """Add the weight of an item, amortised constant time: a purge frees at least size counters"""
+        count = self.counters.get(item)
+
+        if count is not None:
+            self.counters[item] = count + weight
+        else:
+            self.counters[item] = weight
+            if len(self.counters) > 2 * self.size:
+                self.purge()
+
+        self.total += weight
+
+    def purge(self):
+        """Subtract the median count from every counter, forget the counters left empty"""
+        counts = sorted(self.counters.values())
+        # Half of the counters are at most the median, they are dropped
+        median = counts[len(counts) // 2]
+        self.counters = {item: count - median for (item, count) in self.counters.items() if count > median}
+        self.offset += median
+        self.purges += 1
+
+    def merge(self, other):
+        """Add the counters of another sketch, the bounds of both hold for the merged one"""
+        for (item, count) in other.counters.items():
+            self.counters[item] = self.counters.get(item, 0) + count
+
+        self.offset += other.offset
+        self.total += other.total
+
+        while len(self.counters) > 2 * self.size:
+            self.purge()
+
+    def copy(self):
+        """Return an independent copy of the sketch"""
+        sketch = FrequentItems(self.size)
+        sketch.counters = dict(self.counters)
+        sketch.offset = self.offset
+        sketch.total = self.total
+        sketch.purges = self.purges
+
+        return sketch
+
+    def top(self, count):
+        """Return the (item, lower bound, upper bound) of the heaviest items, heaviest first"""
+        items = sorted(self.counters.items(), key=lambda item: item[1], reverse=True)[:count]
+
+        return [(item, weight, weight + self.offset) for (item, weight) in items]
+
+    def __len__(self):
+        return len(self.counters)
+
+
+# 2 ** -rank of every possible rank of a HyperLogLog register
+POWERS = [2.0 ** -rank for rank in range(65)]
+
+
+class HyperLogLog():
+    """Number of distinct items of a stream in at most 2 ** precision bytes (HyperLogLog)
+
+    The standard error of the estimate is 1.04 / sqrt(2 ** precision), 1.6 % with 4096 registers. The sketch of the
+    union of two streams is the maximum of their registers: the sketches of several time buckets, shards or sensors
+    are merged without counting twice the items they share. A sketch with few registers set keeps them in a dict."""
+
+    __slots__ = ("precision", "sparse", "registers")
+
+    def __init__(self, precision=12):
+        """Initialize an empty sketch"""
+        self.precision = precision
+        # Register index: rank, until it would weigh more than the dense registers
+        self.sparse = {}
+        self.registers = None
+
+    def add(self, item):
+        """Add an item, a string"""
+        self.add_hash(hash_item(item))
+
+    def add_hash(self, value):
+        """Add an item by its 64-bit hash, the same item hashed once may be added to several sketches"""
+        bits = 64 - self.precision
+        index = value >> bits
+        # Position of the first 1 bit after the index bits
+        rank = bits - (value & ((1 << bits) - 1)).bit_length() + 1
+
+        if self.registers is not None:
+            if rank > self.registers[index]:
+                self.registers[index] = rank
+
+        elif rank > self.sparse.get(index, 0):
+            self.sparse[index] = rank
+            # A dict entry weighs about 64 registers
+            if len(self.sparse) > (1 << self.precision) // 64:
+                self.densify()
+
+    def densify(self):
+        """Move the registers from the dict to a byte array"""
+        self.registers = bytearray(1 << self.precision)
+
+        for (index, rank) in self.sparse.items():
+            self.registers[index] = rank
+
+        self.sparse = None
+
+    def merge(self, other):
+        """Add the items of another sketch, the one of higher precision is folded down to the precision of the other"""
+        if other.precision > self.precision:
+            other = other.fold(self.precision)
+        elif other.precision < self.precision:
+            folded = self.fold(other.precision)
+            (self.precision, self.sparse, self.registers) = (folded.precision, folded.sparse, folded.registers)
+
+        if other.registers is not None:
+            if self.registers is None:
+                self.densify()
+            self.registers = bytearray(map(max, self.registers, other.registers))
+            return
+
+        for (index, rank) in other.sparse.items():
+            if self.registers is not None:
+                if rank > self.registers[index]:
+                    self.registers[index] = rank
+            elif rank > self.sparse.get(index, 0):
+                self.sparse[index] = rank
+
+        if self.registers is None and len(self.sparse) > (1 << self.precision) // 64:
+            self.densify()
+
+    def fold(self, precision):
+        """Return the sketch of the same items at a lower precision
+
+        The index bits dropped become the first bits after the index: the rank of a register is the position of their
+        first 1 bit, or its rank shifted by their number if they are all 0."""
+        shift = self.precision - precision
+        sketch = HyperLogLog(precision)
+        registers = enumerate(self.registers) if self.registers is not None else self.sparse.items()
+
+        for (index, rank) in registers:
+            if rank == 0:
+                continue
+
+            dropped = index & ((1 << shift) - 1)
+            rank = shift - dropped.bit_length() + 1 if dropped else rank + shift
+            index >>= shift
+
+            if sketch.registers is not None:
+                if rank > sketch.registers[index]:
+                    sketch.registers[index] = rank
+            elif rank > sketch.sparse.get(index, 0):
+                sketch.sparse[index] = rank
+                if len(sketch.sparse) > (1 << precision) // 64:
+                    sketch.densify()
+
+        return sketch
+
+    def copy(self):
+        """Return an independent copy of the sketch"""
+        sketch = HyperLogLog(self.precision)
+        sketch.sparse = None if self.sparse is None else dict(self.sparse)
+        sketch.registers = None if self.registers is None else bytearray(self.registers)
+
+        return sketch
+
+    def estimate(self):
+        """Return the estimated number of distinct items"""
+        size = 1 << self.precision
+
+        if self.registers is not None:
+            zeros = self.registers.count(0)
+            total = sum(map(POWERS.__getitem__, self.registers))
+        else:
+            zeros = size - len(self.sparse)
+            total = zeros + sum(map(POWERS.__getitem__, self.sparse.values()))
+
+        estimate = 0.7213 / (1 + 1.079 / size) * size * size / total
+
+        # Linear counting is more accurate for the small cardinalities
+        if estimate <= 2.5 * size and zeros > 0:
+            estimate = size * log(size / zeros)
+
+        return round(estimate)
+
+    def to_bytes(self):
+        """Return the registers as bytes: all of them, or the (index, rank) pairs of a sparse sketch"""
+        if self.registers is not None:
+            return bytes(self.registers)
+
+        return b"".join(index.to_bytes(3, "little") + bytes([rank]) for (index, rank) in self.sparse.items())
+
+    @classmethod
+    def from_bytes(cls, precision, data):
+        """Return the sketch of registers written by to_bytes"""
+        sketch = cls(precision)
+
+        if len(data) == 1 << precision:
+            sketch.registers = bytearray(data)
+            sketch.sparse = None
+        else:
+            sketch.sparse = {int.from_bytes(data[position:position + 3], "little"): data[position + 3]
+                             for position in range(0, len(data), 4)}
+
+        return sketch
+
+
+def hash_item(item):
+    """Return a 64-bit hash of a string, the same in every process and on every sensor"""
+    return int.from_bytes(blake2b(item.encode(), digest_size=8).digest(), "big")
@@ -1,21 +1,176 @@
 # -*- coding: utf-8 -*-
 
 import signal
-from os import rename, stat, mkdir, path, name
-from json import loads
-from pathlib import Path
+from re import compile, MULTILINE
+from os import path, name, read
+from json import JSONDecoder, JSONDecodeError
+from codecs import getincrementaldecoder
 
-from datetime import datetime
+from time import monotonic
 from threading import Thread
 from queue import Queue
+from selectors import DefaultSelector, EVENT_READ
 from subprocess import Popen, PIPE
+from socket import AF_INET, AF_INET6
+from psutil import net_if_addrs
 
 from . import logger
 from . import config
+from . import captures
 
 config.load_config()
 
 
+# Tshark indents the packets of its JSON array by 2 spaces: a packet starts and ends with a brace at this indentation
+PACKET_START = compile(r"^  \{", MULTILINE)
+PACKET_END = "\n  }"
+# Characters of an incomplete packet beyond which it is dropped
+MAX_PACKET_SIZE = 16 * 1024 * 1024
+
+
+class JsonStream():
+    """Incremental decoder of the JSON array printed by 'tshark -T json'"""
+
+    decoder = None
+    text_decoder = None
+    buffer = None
+    searched = None
+    dropping = None
+    errors = None
+
+    def __init__(self):
+        """Initialize an empty stream"""
+        self.decoder = JSONDecoder()
+        self.text_decoder = getincrementaldecoder("utf-8")(errors="replace")
+        self.buffer = ""
+        # Characters of the buffer already searched for the end of the packet
+        self.searched = 0
+        # True while the rest of a packet too large is dropped
+        self.dropping = False
+        self.errors = 0
+
+    def feed(self, chunk):
+        """Decode the bytes read from tshark and return the complete packets
+
+        A packet is decoded once its closing brace is received, a malformed one is skipped up to the start of the next."""
+        packets = []
+        buffer = self.buffer + self.text_decoder.decode(chunk)
+        position = 0
+        length = len(buffer)
+
+        if self.dropping:
+            match = PACKET_START.search(buffer)
+
+            if match is None:
+                # The start of a packet may be cut between two chunks
+                self.buffer = buffer[-len(PACKET_END):]
+                return packets
+
+            position = match.start()
+            self.dropping = False
+
+        while True:
+            # Skip the array delimiters and the whitespaces between two packets
+            while position < length and buffer[position] in "[],\r\n\t ":
+                position += 1
+
+            if position == length:
+                break
+
+            end = buffer.find(PACKET_END, max(position, self.searched))
+
+            if end < 0:
+                # The packet is not complete yet, the search goes on from here with the next chunk
+                self.searched = max(position, length - len(PACKET_END) + 1)
+                break
+
+            end += len(PACKET_END)
+
+            try:
+                (packet, packet_end) = self.decoder.raw_decode(buffer[position:end])
+                if packet_end != end - position:
+                    raise JSONDecodeError("Extra data", buffer, position + packet_end)
+            except JSONDecodeError as e:
+                # The end found may be the one of the next packet
+                match = PACKET_START.search(buffer, position + 1)
+                position = match.start() if match is not None and match.start() < end else end
+                self.skip(f"malformed packet ({e.msg})")
+                continue
+
+            packets.append(packet)
+            position = end
+
+        if length - position > MAX_PACKET_SIZE:
+            # Not even the end of a packet was received, the rest of it is dropped up to the start of the next
+            self.skip(f"packet of more than {MAX_PACKET_SIZE} characters")
+            self.dropping = True
+            position = length
+
+        self.buffer = buffer[position:]
+        self.searched = max(self.searched - position, 0)
+
+        return packets
+
+    def skip(self, reason):
+        """Count a part of the stream that cannot be decoded"""
+        self.errors += 1
+        logger.log.warning(f"Tshark output skipped: {reason}.")
+
+
+class FieldStream():
+    """Incremental decoder of the tab separated records printed by 'tshark -T fields'"""
+
+    fields = None
+    buffer = None
+
+    def __init__(self, fields):
+        """Initialize an empty stream for the given list of fields"""
+        self.fields = fields
+        self.buffer = b""
+
+    def feed(self, chunk):
+        """Decode the bytes read from tshark and return the complete packets"""
+        packets = []
+        lines = (self.buffer + chunk).split(b"\n")
+        # The last line is not complete yet, wait for the next chunk
+        self.buffer = lines.pop()
+
+        for line in lines:
+            values = line.decode("utf-8", "replace").rstrip("\r").split("\t")
+            packets.append({field: value for (field, value) in zip(self.fields, values) if value != ""})
+
+        return packets
+
+
+class PacketCounter():
+    """Count the packets of a capture source and measure its rate"""
+
+    count = None
+    rate = None
+    last_count = None
+    last_time = None
+
+    def __init__(self):
+        self.count = 0
+        self.rate = 0.0
+        self.last_count = 0
+        self.last_time = monotonic()
+
+    def add(self, count):
+        self.count += count
+
+    def get_rate(self):
+        """Return the number of packets per second since the previous measure (one second minimum)"""
+        now = monotonic()
+
+        if now - self.last_time >= 1:
+            self.rate = (self.count - self.last_count) / (now - self.last_time)
+            self.last_count = self.count
+            self.last_time = now
+
+        return self.rate
+
+
 class Sniffer(Thread):
 
     ready = None
@@ -23,43 +178,52 @@ class Sniffer(Thread):
     queue = None
     file_name = None
     dir_ = None
-
-    def __init__(self, queue, fix_files=False):
+    fields = None
+    output_format = None
+    interface = None
+    capture = None
+    stream = None
+    state = None
+    counter = None
+    directory = None
+    last_rotation = None
+    fd = None
+
+    def __init__(self, queue, interface, fields, fix_files=False):
         """Initialize a Tshark based sniffer"""
         Thread.__init__(self)
 
         self.tshark_path = config.get("tshark_path")
         self.queue = queue
-        self.dir_ = f'{config.get("prog_path")}/capture/'
-        self.file_format = "pcap"
+        self.interface = interface
+        self.fields = fields
+        self.output_format = config.get("tshark_output_format")
+
+        # fields: only dissect the fields read by the analyser, json: full dissection (debug)
+        if self.output_format not in ["fields", "json"]:
+            self.output_format = "fields"
+        self.directory = captures.CaptureDirectory()
+        self.dir_ = self.directory.dir_
         self.ready = False
         self.running = False
-
-        self.create_directory()
+        self.state = "Not ready"
+        self.counter = PacketCounter()
+        self.last_rotation = monotonic()
 
         if fix_files:
-            self.fix_files()
+            self.directory.fix_files()
 
         # Windows
         if name == "nt":
             if self.check_tshark_path():
                 self.ready = True
-                logger.log.info("Sniffer ready.")
         # Linux
         else:
             self.ready = True
 
-    def create_directory(self):
-        """Try to create the capture directory"""
-        try:
-            mkdir(self.dir_)
-            logger.log.info(f"The {self.dir_} directory is created.")
-
-        except FileExistsError:
-            pass
-
-        except Exception as e:
-            logger.log.error(e)
+        if self.ready:
+            self.state = "Ready"
+            logger.log.info(f"Sniffer of the {self.interface} interface ready.")
 
     def check_tshark_path(self):
         """Check if the path from the config file is valid"""
@@ -71,83 +235,268 @@ class Sniffer(Thread):
 
         return check
 
-    def get_files(self):
-        """Get the list of file from the capture directory"""
-        return sorted(Path(self.dir_).glob(f'*.{self.file_format}'))
+    def sniff(self):
+        """Start listening to the network interface in a dedicated thread"""
+        if not self.ready:
+            logger.log.error(f"The sniffer of the {self.interface} interface cannot start because it is not ready.")
+            return False
 
-    def fix_files(self):
-        """Rename the corrupt file"""
-        files = self.get_files()
+        self.running = True
+        self.start()
 
-        for file in files:
-            if "__" not in file.name:
-                continue
+    def get_command(self):
+        """Return the tshark command line corresponding to the output format"""
+        options = self.directory.get_tshark_options(self.interface)
+        # Current capture file, or prefix of the segments when the capture rotates
+        self.file_path = options[1]
+        command = [self.tshark_path, "-q", "-Q", "-i", self.interface, "-l", "-F", "pcap"] + options
+        capture_filter = self.get_capture_filter()
 
-            last_modified_date = int(stat(file).st_mtime)
-            new_file_name = file.name.replace("__", f"_{last_modified_date}_")
+        # The filter is compiled to BPF and applied by the capture driver
+        if capture_filter is not None:
+            command += ["-f", capture_filter]
 
-            try:
-                rename(file, f"{self.dir_}{new_file_name}")
+        if self.output_format == "json":
+            command += ["-T", "json"]
+        else:
+            command += ["-T", "fields", "-E", "separator=/t", "-E", "occurrence=f", "-E", "quote=n"]
+            for field in self.fields:
+                command += ["-e", field]
 
-            except Exception as e:
-                logger.log.error(e)
+        return command
 
-            else:
-                logger.log.warning(
-                    f'Capture file "{file.name}" not have an end time. This could mean that the last execution of the program stopped after a critical error and therefore the file was not closed properly. The file is renamed "{new_file_name}" according to its last modification date')
+    def get_capture_filter(self):
+        """Return the BPF expression of the packets to capture, None to capture everything"""
+        filters = []
 
-    def sniff(self, interface):
-        """Start listening to a network interface"""
-        if not self.ready:
-            logger.log.error("The sniffer cannot start because it is not ready.")
+        if config.exists(f"capture_filter_{self.interface}"):
+            user_filter = config.get(f"capture_filter_{self.interface}")
+        else:
+            user_filter = config.get("capture_filter")
+
+        if user_filter is not None:
+            filters.append(f"({user_filter})")
+
+        if config.get("capture_exclude_dashboard") != "no":
+            dashboard_filter = self.get_dashboard_filter()
+            if dashboard_filter is not None:
+                filters.append(dashboard_filter)
+
+        if len(filters) == 0:
+            return None
+
+        return " and ".join(filters)
+
+    def get_dashboard_filter(self):
+        """Return the BPF expression excluding the traffic of the Cartographe web server"""
+        host = config.get("server_host")
+        port = config.get("server_port")
+
+        if host is None:
+            host = "127.0.0.1"
+
+        if port is None:
+            port = 80
+
+        # The web server listens to all the addresses of the interface
+        if host in ["0.0.0.0", "::"]:
+            addresses = [address.address.split('%')[0] for address in net_if_addrs().get(self.interface, [])
+                         if address.family in (AF_INET, AF_INET6)]
+        else:
+            addresses = [host]
+
+        if len(addresses) == 0:
+            return None
+
+        # Only the server side of the connections, the local clients of remote servers on the same port are kept
+        return " and ".join(f"not ((src host {address} and tcp src port {port}) or (dst host {address} and tcp dst port {port}))"
+                            for address in addresses)
+
+    def project(self, packet):
+        """Keep the fields read by the analyser from a full JSON dissection"""
+        layers = packet["_source"]["layers"]
+        projection = {"_source": packet["_source"]}
+
+        for field in self.fields:
+            layer = layers.get(field.split('.')[0])
+            if layer is not None and field in layer:
+                projection[field] = layer[field]
+
+        return projection
+
+    def open(self):
+        """Start the tshark process and return the file descriptor of its output"""
+        try:
+            self.capture = Popen(self.get_command(), stdout=PIPE)
+
+        except Exception as e:
+            logger.log.error(f"Tshark cannot listen to the {self.interface} interface: {e}")
+            self.state = "Failed"
+            return None
+
+        if self.output_format == "json":
+            self.stream = JsonStream()
+        else:
+            self.stream = FieldStream(self.fields)
+
+        self.state = "Running"
+        logger.log.info(f"Sniffing the {self.interface} interface ({self.output_format} output).")
+        self.fd = self.capture.stdout.fileno()
+
+        return self.fd
+
+    def receive(self):
+        """Read the available tshark output, return False once tshark has exited"""
+        chunk = read(self.fd, 65536)
+
+        if not chunk:
             return False
 
-        self.interface = interface
-        self.running = True
-        self.start()
+        self.feed(chunk)
+        return True
+
+    def feed(self, chunk):
+        """Decode the bytes read from tshark and send the packets to the analyser"""
+        packets = self.stream.feed(chunk)
+
+        if self.output_format == "json":
+            packets = [self.project(packet) for packet in packets]
+
+        # Tshark listens to a single interface, the packets are tagged with it here rather than by a field
+        for packet in packets:
+            packet["frame.interface_name"] = self.interface
+
+        # All the packets of a chunk are sent as a single batch
+        self.queue.put(packets)
+        self.counter.add(len(packets))
+
+    def close(self):
+        """Stop the tshark process and add the end timestamp to the name of the capture file"""
+        if self.capture is None:
+            return
+
+        self.capture.terminate()
+        self.capture.wait()
+        self.capture.stdout.close()
+
+        # Tshark exited by itself
+        if self.running:
+            logger.log.error(f"Tshark stopped listening to the {self.interface} interface unexpectedly (exit code {self.capture.returncode}).")
+            self.running = False
+            self.state = "Failed"
+        else:
+            self.state = "Stopped"
+
+        self.capture = None
+        logger.log.info(f"Stop sniffing the {self.interface} interface.")
+
+        if self.directory.rotates():
+            self.directory.collect(self.interface, closing=True)
+        else:
+            self.directory.close(self.file_path)
+
+    def rotate(self):
+        """Move the capture segments finished by tshark to the capture directory"""
+        if not self.directory.rotates() or monotonic() - self.last_rotation < 5:
+            return
+
+        self.last_rotation = monotonic()
+        self.directory.collect(self.interface)
+
+    def get_rate(self):
+        """Return the number of packets per second received from the interface"""
+        return self.counter.get_rate()
 
     def run(self):
         """Get the tshark data and send them to the analyser"""
+        if self.open() is None:
+            return
 
-        now = int(datetime.now().timestamp())
-        self.file_path = f'{self.dir_}{now}__{self.interface}.{self.file_format}'
+        while self.running and self.receive():
+            self.rotate()
 
-        logger.log.info("Sniffer running.")
+        self.close()
+        logger.log.info(f"Sniffer of the {self.interface} interface stoped.")
 
-        with Popen([self.tshark_path, "-q", "-Q", "-i", self.interface, "-l", "-T", "json", "-w", self.file_path], stdout=PIPE) as capture:
-            packet = ""
-            logger.log.info(f"Sniffing the {self.interface} interface.")
+    def stop(self):
+        """Stop sniffing"""
+        self.running = False
 
-            while self.running:
-                line = capture.stdout.readline().decode()
 
-                if line == "[\r\n":
-                    pass
+class SnifferPool(Thread):
 
-                elif line == "  },\r\n":
-                    packet += '}'
-                    packet = loads(packet)
-                    self.queue.put(packet)
-                    packet = ""
+    running = None
+    sniffers = None
+    selector = None
 
-                else:
-                    packet += line.strip()
+    def __init__(self, queue, interfaces, fields, backend=None):
+        """Initialize one sniffer per network interface, all feeding the same queue"""
+        Thread.__init__(self)
 
-            capture.terminate()
-            logger.log.info(f"Stop sniffing the {self.interface} interface.")
+        self.running = False
+        self.sniffers = {}
 
-        # Add the end timestamp to the name of the file
-        now = int(datetime.now().timestamp())
-        new_name = self.file_path.replace("__", f'_{now}_')
+        # Sniffer class reading the interfaces, tshark by default
+        if backend is None:
+            backend = Sniffer
 
-        try:
-            rename(self.file_path, new_name)
+        for (index, interface) in enumerate(interfaces):
+            # The interrupted captures only need to be fixed once
+            self.sniffers[interface] = backend(queue, interface, fields, fix_files=(index == 0))
+
+    def sniff(self, interfaces=None):
+        """Start listening to all the network interfaces"""
+        self.running = True
 
-        except:
-            logger.log.error(f"Capture file {self.file_path} is already open in another process and therefor cannot be rename to include the capture end time. The file will be corrected the next time the program is run.")
+        # Pipes cannot be multiplexed on Windows, each sniffer reads its own tshark output
+        if name == "nt":
+            for sniffer in self.sniffers.values():
+                sniffer.sniff()
+        else:
+            self.start()
+
+    def get_sources(self):
+        """Return the sniffers by interface name"""
+        return self.sniffers
+
+    def run(self):
+        """Read the outputs of all the capture processes and sockets from a single thread"""
+        self.selector = DefaultSelector()
+
+        for sniffer in self.sniffers.values():
+            if not sniffer.ready:
+                logger.log.error(f"The sniffer of the {sniffer.interface} interface cannot start because it is not ready.")
+                continue
+
+            sniffer.running = True
+            fd = sniffer.open()
 
-        logger.log.info("Sniffer stoped.")
+            if fd is not None:
+                self.selector.register(fd, EVENT_READ, sniffer)
+
+        logger.log.info(f"Sniffers running on {len(self.selector.get_map())} interface(s).")
+
+        while self.running and len(self.selector.get_map()) > 0:
+            for (key, events) in self.selector.select(timeout=1):
+                # The capture process or socket is closed
+                if not key.data.receive():
+                    self.selector.unregister(key.fd)
+                    key.data.close()
+
+            for key in self.selector.get_map().values():
+                key.data.rotate()
+
+        for key in list(self.selector.get_map().values()):
+            self.selector.unregister(key.fd)
+            key.data.running = False
+            key.data.close()
+
+        self.selector.close()
+        logger.log.info("Sniffers stoped.")
 
     def stop(self):
-        """Stop sniffing"""
+        """Stop sniffing all the network interfaces"""
         self.running = False
+
+        for sniffer in self.sniffers.values():
+            sniffer.stop()